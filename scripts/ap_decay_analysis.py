@@ -0,0 +1,182 @@
+import numpy as np
+import awkward as ak
+import uproot
+
+### Columnar analysis of the A' decays in the SimParticles of the eat_vis
+### signal samples (see gen_signal_samples.py). The particles of each event
+### are read into a jagged array of records, [event][particle], and everything
+### is computed for all A's of all events at once.
+### In the event files, SimParticles_eat_vis.first holds the ids of the
+### particles of each event and SimParticles_eat_vis.second.<field>_ the
+### particles themselves; parents_ and daughters_ hold particle ids, which are
+### turned into positions within the event by local_index.
+
+events_tree = "LDMX_Events"
+sim_particles_collection = "SimParticles_eat_vis"
+ap_pdg_id = 622
+
+def branch_name(field, collection=sim_particles_collection):
+    if field == "id":
+        return collection + ".first"
+    return "{}.second.{}_".format(collection, field)
+
+# arrays as read by uproot (e.g. from tree.arrays or uproot.iterate) ->
+# [event][particle] records with the given fields and the particle id
+def particles_from_arrays(arrays, fields, collection=sim_particles_collection):
+    return ak.zip({field : arrays[branch_name(field, collection)]
+                       for field in ["id"] + fields},
+                  depth_limit=2)
+
+# only the branches of the given fields are read from the file
+def load_sim_particles(fname, fields, collection=sim_particles_collection,
+                       entry_start=None, entry_stop=None):
+    with uproot.open(fname) as f:
+        arrays = f[events_tree].arrays(
+            filter_name=[branch_name(field, collection) for field in ["id"] + fields],
+            entry_start=entry_start, entry_stop=entry_stop)
+    return particles_from_arrays(arrays, fields, collection)
+
+# position within its event of each id in query ([event][id], None allowed),
+# or -1 if there is no particle with that id in the event
+# every (event, id) pair is made into one integer key, so all the lookups are
+# one sort of the particle keys and one binary search of the query keys
+def local_index(ids, query):
+    n_ids = ak.to_numpy(ak.num(ids))
+    offsets = np.cumsum(n_ids) - n_ids
+    flat_ids = ak.to_numpy(ak.flatten(ids)).astype(np.int64)
+    n_query = ak.to_numpy(ak.num(query))
+    flat_query = ak.to_numpy(ak.flatten(ak.fill_none(query, -1))).astype(np.int64)
+
+    stride = max(flat_ids.max(initial=-1), flat_query.max(initial=-1)) + 1
+    keys = np.repeat(np.arange(len(n_ids)), n_ids) * stride + flat_ids
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    query_events = np.repeat(np.arange(len(n_query)), n_query)
+    query_keys = query_events * stride + flat_query
+
+    index = np.full(len(flat_query), -1, dtype=np.int64)
+    if len(sorted_keys) > 0:
+        pos = np.minimum(np.searchsorted(sorted_keys, query_keys), len(sorted_keys) - 1)
+        found = (flat_query >= 0) & (sorted_keys[pos] == query_keys)
+        index[found] = order[pos[found]] - offsets[query_events[found]]
+    return ak.unflatten(index, n_query)
+
+# the particles with the ids in query, which is [event][id] or
+# [event][particle][id]; None where the id is not in the event
+def lookup(particles, query):
+    if query.ndim == 3:
+        # look up the ids of each event as one list, then split them back up
+        query = ak.fill_none(query, [], axis=1)
+        n_outer = ak.to_numpy(ak.num(query, axis=1))
+        n_inner = ak.to_numpy(ak.flatten(ak.num(query, axis=2)))
+        found = ak.flatten(lookup(particles, ak.flatten(query, axis=2)))
+        return ak.unflatten(ak.unflatten(found, n_inner), n_outer)
+    index = local_index(particles.id, query)
+    return particles[ak.mask(index, index >= 0)]
+
+def double(array):
+    return ak.values_astype(array, np.float64)
+
+def select_aps(particles):
+    return particles[particles.pdgID == ap_pdg_id]
+
+# the particle each A' came from (its first parent)
+def parents_of(particles, aps):
+    return lookup(particles, ak.firsts(aps.parents, axis=2))
+
+### quantities of each A': name -> ([fields needed], function(particles, aps))
+### the results are [event][A'] arrays (or [event][A'][daughter] for the
+### momentum imbalances), None where a particle is not in the event record
+
+def decay_distance(particles, aps):
+    return np.sqrt(np.square(double(aps.endX) - aps.x)
+                   + np.square(double(aps.endY) - aps.y)
+                   + np.square(double(aps.endZ) - aps.z))
+
+def start_z(particles, aps):
+    return aps.z
+
+def end_z(particles, aps):
+    return aps.endZ
+
+def n_daughters(particles, aps):
+    return ak.num(aps.daughters, axis=2)
+
+def parent_found(particles, aps):
+    return ~ak.is_none(parents_of(particles, aps), axis=1)
+
+# energy of the incident particle at the point where it made the A'
+def parent_end_energy(particles, aps):
+    parents = parents_of(particles, aps)
+    return np.sqrt(np.square(double(parents.endpx)) + np.square(double(parents.endpy))
+                   + np.square(double(parents.endpz)) + np.square(double(parents.mass)))
+
+# daughters that are not in the event record are left out of the sums
+def daughter_invariant_mass(particles, aps):
+    daughters = lookup(particles, aps.daughters)
+    energy = ak.sum(double(daughters.energy), axis=2)
+    px = ak.sum(double(daughters.px), axis=2)
+    py = ak.sum(double(daughters.py), axis=2)
+    pz = ak.sum(double(daughters.pz), axis=2)
+    return np.sqrt(np.square(energy) - (np.square(px) + np.square(py) + np.square(pz)))
+
+# A' momentum + momentum of the other daughters of its parent that start
+# where the parent ends (within max_distance [mm]) - parent momentum at its
+# end, for checking that the A' and recoil lepton balance the incident lepton
+def momentum_imbalance(particles, aps, component, max_distance=1e-3):
+    parents = parents_of(particles, aps)
+    siblings = lookup(particles, parents.daughters)
+    distance = np.sqrt(np.square(double(siblings.x) - parents.endX)
+                       + np.square(double(siblings.y) - parents.endY)
+                       + np.square(double(siblings.z) - parents.endZ))
+    keep = ak.fill_none((siblings.pdgID != ap_pdg_id) & (distance < max_distance), False)
+    imbalance = (double(aps[component]) + siblings[component]
+                 - parents["end" + component])
+    return imbalance[keep]
+
+def px_imbalance(particles, aps):
+    return momentum_imbalance(particles, aps, "px")
+
+def py_imbalance(particles, aps):
+    return momentum_imbalance(particles, aps, "py")
+
+def pz_imbalance(particles, aps):
+    return momentum_imbalance(particles, aps, "pz")
+
+imbalance_fields = ["parents", "daughters", "x", "y", "z", "endX", "endY", "endZ",
+                    "endpx", "endpy", "endpz"]
+ap_quantities = {
+    "decay_distance" : (["x", "y", "z", "endX", "endY", "endZ"], decay_distance),
+    "start_z" : (["z"], start_z),
+    "end_z" : (["endZ"], end_z),
+    "n_daughters" : (["daughters"], n_daughters),
+    "parent_found" : (["parents"], parent_found),
+    "parent_end_energy" : (["parents", "endpx", "endpy", "endpz", "mass"], parent_end_energy),
+    "daughter_invariant_mass" : (["daughters", "energy", "px", "py", "pz"], daughter_invariant_mass),
+    "px_imbalance" : (imbalance_fields + ["px"], px_imbalance),
+    "py_imbalance" : (imbalance_fields + ["py"], py_imbalance),
+    "pz_imbalance" : (imbalance_fields + ["pz"], pz_imbalance)
+}
+
+# the fields (and so branches) needed for the given quantities
+def fields_for(quantities):
+    fields = ["pdgID"]
+    for name in quantities:
+        fields += [field for field in ap_quantities[name][0] if field not in fields]
+    return fields
+
+# name -> array for each of the given quantities
+def compute_ap_quantities(particles, quantities):
+    aps = select_aps(particles)
+    return {name : ap_quantities[name][1](particles, aps) for name in quantities}
+
+# fill a hist.Hist with every value of a (jagged) array at once, skipping Nones
+def fill_hist(h, values):
+    values = ak.flatten(values, axis=None)
+    h.fill(ak.to_numpy(values[~ak.is_none(values)]))
+
+# load only what the quantities need from fname and compute them
+def analyze_file(fname, quantities, entry_start=None, entry_stop=None):
+    particles = load_sim_particles(fname, fields_for(quantities),
+                                   entry_start=entry_start, entry_stop=entry_stop)
+    return compute_ap_quantities(particles, quantities)
@@ -0,0 +1,268 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import dblib_catalog
+import pipeline_stats
+
+### Assemble the combined library of one A' mass,
+###   {dblib_dir}/all_mA_{mass}_run_{run_number}.csv
+### that gen_signal_samples.py gives to G4DarkBreM, from the per-energy csv
+### libraries in the catalog (see dblib_catalog): the unscaled libraries of the
+### given materials and, with include_scaled, the scaled ones too.
+### The input files are read in parallel, n_workers at a time, each streamed in
+### blocks into a part file with only the rows that are kept (the rows are
+### copied as they are, not parsed), and the parts are then concatenated into
+### the output, so memory use does not depend on the size of the library.
+### The events of each incident energy can be subsampled (subsample_fraction)
+### and capped (max_events_per_energy); the rows kept are drawn at random, with
+### a fixed seed, from all the files of that energy in proportion to their
+### number of events.
+### With write_sidecar, a small binary sidecar (numpy .npz) is written next to
+### the output with the fingerprint of the inputs and options (catalog
+### checksums of the inputs, subsampling, seed), the rows kept from each input
+### and the size and modification time of the output; a later assembly with
+### the same fingerprint and an unchanged output does nothing.
+
+def combined_fname_for(dblib_dir, mass, run_number):
+    return "{dblib_dir}/all_mA_{mass}_run_{run_number}.csv".format(
+        dblib_dir=dblib_dir, mass=mass, run_number=run_number)
+
+def sidecar_fname_for(output_fname):
+    return os.path.splitext(output_fname)[0] + ".sidecar.npz"
+
+# the catalog rows of the libraries that go into the combined library, in a
+# fixed order (by incident energy, then path)
+def find_inputs(catalog, materials, mass, run_number, include_scaled=False,
+                energies=None):
+    kinds = ["unscaled", "scaled"] if include_scaled else ["unscaled"]
+    inputs = []
+    for kind in kinds:
+        for material in materials:
+            inputs += dblib_catalog.find_files(catalog, kind, material, mass,
+                                               run_number=run_number, lepton="electron")
+    if energies is not None:
+        energies = [float(energy) for energy in energies]
+        inputs = [row for row in inputs if row["incident_energy"] in energies]
+    return sorted(inputs, key=lambda row: (row["incident_energy"], row["path"]))
+
+# split total rows over files with n_events events in proportion to their
+# size (largest remainders get the rows left over by rounding down)
+def allocate(n_events, total):
+    n_events = np.asarray(n_events, dtype=np.int64)
+    shares = n_events * (total / n_events.sum())
+    counts = np.floor(shares).astype(np.int64)
+    left = total - counts.sum()
+    if left > 0:
+        counts[np.argsort(counts - shares, kind='stable')[:left]] += 1
+    return np.minimum(counts, n_events)
+
+# for each input, the sorted row numbers (from 0, not counting the header) to
+# keep, or None to keep every row
+def rows_to_keep(inputs, max_events_per_energy=None, subsample_fraction=None, seed=1):
+    if max_events_per_energy is None and subsample_fraction is None:
+        return [None] * len(inputs)
+    rows = [None] * len(inputs)
+    by_energy = {}
+    for i, row in enumerate(inputs):
+        by_energy.setdefault(row["incident_energy"], []).append(i)
+    for energy, indices in by_energy.items():
+        n_events = [inputs[i]["n_events"] for i in indices]
+        total = sum(n_events)
+        if subsample_fraction is not None:
+            total = int(round(total * subsample_fraction))
+        if max_events_per_energy is not None:
+            total = min(total, max_events_per_energy)
+        if total >= sum(n_events):
+            continue
+        for i, n_keep in zip(indices, allocate(n_events, total)):
+            rng = np.random.default_rng([seed, i])
+            rows[i] = np.sort(rng.choice(inputs[i]["n_events"], n_keep, replace=False)).astype(np.uint32)
+    return rows
+
+# copy the header and the given rows (all of them if rows is None) of a csv
+# file into part_fname, reading block_size bytes at a time
+# returns (header, number of rows written)
+def copy_rows(fname, rows, part_fname, block_size=1 << 22):
+    with pipeline_stats.stage("copy_rows", file=os.path.basename(fname)) as stats:
+        header, n_written = copy_file_rows(fname, rows, part_fname, block_size)
+        stats["rows"] = n_written
+    return header, n_written
+
+def copy_file_rows(fname, rows, part_fname, block_size):
+    n_written = 0
+    with open(fname, "rb") as fin, open(part_fname, "wb") as fout:
+        header = fin.readline()
+        last = b"\n"
+        if rows is None:
+            for block in iter(lambda: fin.read(block_size), b""):
+                fout.write(block)
+                n_written += block.count(b"\n")
+                last = block[-1:]
+            if last != b"\n":
+                fout.write(b"\n")
+                n_written += 1
+            return header, n_written
+
+        first_row = 0
+        next_keep = 0
+        leftover = b""
+        for block in iter(lambda: fin.read(block_size), b""):
+            lines = (leftover + block).split(b"\n")
+            leftover = lines.pop()
+            end_keep = np.searchsorted(rows, first_row + len(lines))
+            if end_keep > next_keep:
+                fout.write(b"\n".join(lines[row - first_row]
+                                      for row in rows[next_keep:end_keep].tolist()) + b"\n")
+                n_written += end_keep - next_keep
+                next_keep = end_keep
+            first_row += len(lines)
+        if leftover and next_keep < len(rows) and rows[next_keep] == first_row:
+            fout.write(leftover + b"\n")
+            n_written += 1
+    return header, n_written
+
+def fingerprint_for(inputs, options):
+    return hashlib.blake2b(json.dumps({
+        "inputs" : [[row["path"], row["size"], row["mtime_ns"], row["checksum"]]
+                        for row in inputs],
+        "options" : options
+    }, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+def load_sidecar(sidecar_fname):
+    if not os.path.isfile(sidecar_fname):
+        return None
+    with np.load(sidecar_fname) as sidecar:
+        return json.loads(str(sidecar["info"]))
+
+def is_up_to_date(output_fname, fingerprint):
+    info = load_sidecar(sidecar_fname_for(output_fname))
+    if info is None or info["fingerprint"] != fingerprint or not os.path.isfile(output_fname):
+        return False
+    st = os.stat(output_fname)
+    return info["output_size"] == st.st_size and info["output_mtime_ns"] == st.st_mtime_ns
+
+def write_sidecar(output_fname, fingerprint, inputs, rows, n_events):
+    st = os.stat(output_fname)
+    info = {
+        "fingerprint" : fingerprint,
+        "output_size" : st.st_size,
+        "output_mtime_ns" : st.st_mtime_ns,
+        "n_events" : n_events,
+        "inputs" : [row["path"] for row in inputs]
+    }
+    arrays = {"rows_{}".format(i) : input_rows for i, input_rows in enumerate(rows)
+                  if input_rows is not None}
+    sidecar_fname = sidecar_fname_for(output_fname)
+    buffer = io.BytesIO()
+    np.savez(buffer, info=np.array(json.dumps(info)), **arrays)
+    with open(sidecar_fname + ".tmp", "wb") as fp:
+        fp.write(buffer.getvalue())
+    os.replace(sidecar_fname + ".tmp", sidecar_fname)
+
+# assemble the combined library of one mass into output_fname (see above) and
+# add it to the catalog; returns the number of events in it
+def assemble_library(catalog, output_fname, materials, mass, run_number,
+                     include_scaled=False, energies=None,
+                     max_events_per_energy=None, subsample_fraction=None,
+                     seed=1, n_workers=1, sidecar=True):
+    start = time.perf_counter()
+    inputs = find_inputs(catalog, materials, mass, run_number, include_scaled, energies)
+    if len(inputs) == 0:
+        raise ValueError("no catalogued libraries for mA {} run {} ({})".format(
+            mass, run_number, ", ".join(materials)))
+    options = {"max_events_per_energy" : max_events_per_energy,
+               "subsample_fraction" : subsample_fraction, "seed" : seed}
+    fingerprint = fingerprint_for(inputs, options)
+    if sidecar and is_up_to_date(output_fname, fingerprint):
+        n_events = load_sidecar(sidecar_fname_for(output_fname))["n_events"]
+        print("{}: up to date ({} events)".format(output_fname, n_events))
+        return n_events
+
+    rows = rows_to_keep(inputs, max_events_per_energy, subsample_fraction, seed)
+    # parts are named like the output (but start with '.'), so the catalog
+    # never takes them for libraries
+    parts_dir = os.path.join(os.path.dirname(output_fname),
+                             "." + os.path.basename(output_fname) + ".parts")
+    os.makedirs(parts_dir, exist_ok=True)
+    part_fnames = [os.path.join(parts_dir, "{:05d}.csv".format(i)) for i in range(len(inputs))]
+    jobs = [(row["path"], input_rows, part_fname)
+                for row, input_rows, part_fname in zip(inputs, rows, part_fnames)]
+    if n_workers <= 1:
+        results = [copy_rows(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(copy_rows, *zip(*jobs)))
+
+    header = results[0][0]
+    for row, (input_header, _) in zip(inputs, results):
+        if input_header != header:
+            raise ValueError("{} has a different header than {}".format(row["path"], inputs[0]["path"]))
+
+    # concatenate the parts, computing the catalog checksum on the way
+    n_events = int(sum(n_written for _, n_written in results))
+    digest = hashlib.blake2b(digest_size=16)
+    tmp_fname = os.path.join(os.path.dirname(output_fname), "." + os.path.basename(output_fname) + ".tmp")
+    with pipeline_stats.stage("merge_parts", rows=n_events, file=os.path.basename(output_fname)):
+        with open(tmp_fname, "wb") as fout:
+            fout.write(header)
+            digest.update(header)
+            for part_fname in part_fnames:
+                with open(part_fname, "rb") as fin:
+                    for block in iter(lambda: fin.read(1 << 22), b""):
+                        fout.write(block)
+                        digest.update(block)
+        os.replace(tmp_fname, output_fname)
+    shutil.rmtree(parts_dir)
+
+    dblib_catalog.add_file(catalog, output_fname, "combined",
+                           dblib_catalog.run_params_from_filename(output_fname),
+                           n_events, digest.hexdigest())
+    catalog.commit()
+    if sidecar:
+        write_sidecar(output_fname, fingerprint, inputs, rows, n_events)
+    print("{}: {} events from {} files in {:.1f} s".format(
+        output_fname, n_events, len(inputs), time.perf_counter() - start))
+    return n_events
+
+dblib_dir = "/standard/ldmxuva/data/dblib"
+# libraries of these target materials go into the combined library
+materials = ["tungsten"]
+masses = ["0.005", "0.01", "0.05", "0.1"]
+run_number = 4000
+# add the scaled libraries to the unscaled ones
+include_scaled = False
+# incident energies to include (None for all that are catalogued)
+energies = None
+# keep at most this many events of each incident energy (None for all)
+max_events_per_energy = None
+# keep this fraction of the events of each incident energy (None for all)
+subsample_fraction = None
+# seed of the random choice of events when subsampling or capping
+seed = 1
+# number of input files read at the same time
+n_workers = 4
+# write the sidecar, and skip the assembly when nothing has changed
+write_sidecar_file = True
+# catalog of the library files (see dblib_catalog)
+catalog_fname = dblib_dir + "/" + dblib_catalog.catalog_basename
+# record the time and memory of every stage next to the libraries (see
+# pipeline_stats)
+record_stats = False
+
+if __name__ == "__main__":
+    if record_stats:
+        pipeline_stats.enable(dblib_dir + "/.assemble_stats.jsonl")
+    catalog = dblib_catalog.open_catalog(catalog_fname)
+    dblib_catalog.update_catalog(catalog, [dblib_dir] + ([dblib_dir + "/scaled"] if include_scaled else []))
+    for mass in masses:
+        assemble_library(catalog, combined_fname_for(dblib_dir, mass, run_number),
+                         materials, mass, run_number, include_scaled, energies,
+                         max_events_per_energy, subsample_fraction, seed,
+                         n_workers, write_sidecar_file)
@@ -0,0 +1,313 @@
+import copy
+import datetime
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+import compile_dblib_into_df
+import dblib_dataset
+import fill_dblib_scaling_hists
+import pipeline_stats
+
+### Benchmarks of the dblib pipeline on a synthetic library, so that changes to
+### the compile (process_file, compile_dblib), load (load_dblib), derive
+### (setup_derived_columns) and histogram (make_comparison_hists,
+### make_scaling_hists_dict) stages can be timed without the real libraries.
+### For each number of events per file in sizes, a library is generated (once,
+### then reused) in
+###   {bench_dir}/dblib_{n_events}/
+### with the file names and csv columns of g4db-extract-library and
+### g4db-scale (see dblib_catalog and compile_dblib_into_df), and each stage is
+### run on it in a fresh process, the compile and histogram stages once for
+### each of worker_counts.
+### Every stage appends one json line to results_fname:
+###   {"run_id", "time", "commit", "host", "python", "n_cpus", "stage",
+###    "n_events", "n_files", "n_workers", "rows", "wall_s", "cpu_s",
+###    "max_rss_mb", "max_child_rss_mb", "repeat"}
+### where cpu_s includes the worker processes of the stage, max_rss_mb is the
+### peak RSS of the stage process (load, derive and comparison_hists run one
+### after the other in the same process, so theirs is the peak so far) and
+### max_child_rss_mb that of the largest of its workers.
+### compare_results prints, for each (stage, n_events, n_workers), the wall
+### time of the last run against the best of the earlier ones.
+
+# in the order of the csv files written by g4db-extract-library
+csv_columns = ["incident_energy"] + [name for name, _ in dblib_dataset.kinematic_fields]
+
+electron_mass = 0.000511
+
+# synthetic dark brem vertices at one incident energy [GeV]: the recoil
+# electron keeps a fraction of the energy and the A' (of mass mA) takes the
+# rest, both close to the beam axis and roughly back to back in phi; the
+# center momentum is the sum of the two, as in the real libraries
+def synthetic_vertices(rng, incident_energy, mA, n_events):
+    recoil_energy = np.maximum(incident_energy * rng.beta(1.2, 3.0, n_events), 2 * electron_mass)
+    ap_energy = np.maximum((incident_energy - recoil_energy) * rng.uniform(0.98, 1.0, n_events),
+                           1.001 * mA)
+    recoil_theta = rng.exponential(0.05, n_events)
+    ap_theta = rng.exponential(0.02, n_events)
+    recoil_phi = rng.uniform(-math.pi, math.pi, n_events)
+    ap_phi = recoil_phi + math.pi + rng.normal(0., 0.3, n_events)
+
+    recoil_p = np.sqrt(np.square(recoil_energy) - electron_mass**2)
+    ap_p = np.sqrt(np.square(ap_energy) - mA**2)
+    recoil = [recoil_energy,
+              recoil_p * np.sin(recoil_theta) * np.cos(recoil_phi),
+              recoil_p * np.sin(recoil_theta) * np.sin(recoil_phi),
+              recoil_p * np.cos(recoil_theta)]
+    ap = [ap_energy,
+          ap_p * np.sin(ap_theta) * np.cos(ap_phi),
+          ap_p * np.sin(ap_theta) * np.sin(ap_phi),
+          ap_p * np.cos(ap_theta)]
+    columns = [np.full(n_events, incident_energy)] + recoil + [r + a for r, a in zip(recoil, ap)]
+    return pa.table(dict(zip(csv_columns, columns)))
+
+def write_synthetic_csv(fname, table):
+    # the header is written by hand since pyarrow quotes column names
+    tmp_fname = os.path.join(os.path.dirname(fname), "." + os.path.basename(fname) + ".tmp")
+    with open(tmp_fname, "wb") as fp:
+        fp.write((",".join(csv_columns) + "\n").encode())
+        pacsv.write_csv(table, fp, pacsv.WriteOptions(include_header=False))
+    os.replace(tmp_fname, fname)
+
+# an unscaled library of n_events events for every material, mass and energy
+# of energy_pairs, and a scaled one for every (base energy, comparison
+# energy) pair, in dblib_dir and dblib_dir/scaled; files that already exist
+# are kept (they are the same for the same seed)
+# returns the number of files
+def make_synthetic_dblib(dblib_dir, materials, masses, energy_pairs, n_events,
+                         run_number=1, seed=1):
+    os.makedirs(dblib_dir + "/scaled", exist_ok=True)
+    energies = sorted(set([baseE for baseE, _ in energy_pairs]
+                          + [compE for _, compEs in energy_pairs for compE in compEs]))
+    fnames = []
+    for material in materials:
+        for mass in masses:
+            for energy in energies:
+                fnames.append(("{dblib_dir}/electron_{material}_mA_{mass}_E_{energy}_unscaled_run_{run_number}.csv".format(
+                    dblib_dir=dblib_dir, material=material, mass=mass, energy=energy,
+                    run_number=run_number), material, mass, energy))
+            for baseE, compEs in energy_pairs:
+                for compE in compEs:
+                    fnames.append(("{dblib_dir}/scaled/electron_{material}_mA_{mass}_E_{baseE}_scaledFrom_{compE}_run_{run_number}.csv".format(
+                        dblib_dir=dblib_dir, material=material, mass=mass, baseE=baseE,
+                        compE=compE, run_number=run_number), material, mass, baseE))
+    for i, (fname, material, mass, energy) in enumerate(fnames):
+        if os.path.isfile(fname):
+            continue
+        rng = np.random.default_rng([seed, i])
+        write_synthetic_csv(fname, synthetic_vertices(rng, float(energy), float(mass), n_events))
+    return len(fnames)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# wall, cpu (with that of the waited-for workers) and peak RSS since start
+# (from pipeline_stats.start_usage)
+def stage_stats(start, rows):
+    usage = pipeline_stats.usage_since(start)
+    return {
+        "rows" : int(rows),
+        "wall_s" : usage["wall_s"],
+        "cpu_s" : usage["cpu_s"] + usage["child_cpu_s"],
+        "max_rss_mb" : usage["max_rss_mb"],
+        "max_child_rss_mb" : usage["max_child_rss_mb"]
+    }
+
+def quiet_stdout():
+    # the stages print progress for every file and histogram; the workers
+    # write to the same file descriptor, so it is redirected rather than
+    # sys.stdout
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+
+def bench_compile(dblib_dir, dataset_path, materials, masses, n_workers, quiet=True):
+    if quiet:
+        quiet_stdout()
+    # start over, so that every file is compiled
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    start = pipeline_stats.start_usage()
+    compile_dblib_into_df.compile_dblib(dblib_dir, dataset_path, materials, masses, n_workers)
+    manifest = compile_dblib_into_df.load_manifest(
+        os.path.join(dataset_path, compile_dblib_into_df.manifest_basename))
+    rows = sum(entry["n_rows"] for entry in manifest["sources"].values())
+    return [("compile", stage_stats(start, rows))]
+
+# load every cell (all columns), add all the derived columns to it and make
+# the comparison histograms of every variable and energy pair from it
+def bench_load_derive(dataset_path, materials, masses, var_specs, energy_pairs, quiet=True):
+    if quiet:
+        quiet_stdout()
+    start = pipeline_stats.start_usage()
+    frames = []
+    for material in materials:
+        for mass in masses:
+            for scaled in [False, True]:
+                frames.append(fill_dblib_scaling_hists.load_dblib(dataset_path, scaled, material, mass))
+    rows = sum(len(df) for df in frames)
+    results = [("load", stage_stats(start, rows))]
+
+    start = pipeline_stats.start_usage()
+    for df in frames:
+        fill_dblib_scaling_hists.setup_derived_columns(df)
+    results.append(("derive", stage_stats(start, rows)))
+
+    start = pipeline_stats.start_usage()
+    for unscaled, scaled in zip(frames[0::2], frames[1::2]):
+        for var_name, kwargs in var_specs:
+            for baseE, compEs in energy_pairs:
+                fill_dblib_scaling_hists.make_comparison_unscaled_hists(
+                    unscaled, var_name, baseE, compEs, kwargs.get('minX'), kwargs.get('maxX'))
+                fill_dblib_scaling_hists.make_comparison_scaled_hists(
+                    unscaled, scaled, var_name, baseE, compEs, kwargs.get('minX'), kwargs.get('maxX'))
+    results.append(("comparison_hists", stage_stats(start, rows)))
+    return results
+
+def bench_hists(dataset_path, materials, masses, var_specs, energy_pairs, n_workers,
+                batch_size=None, quiet=True):
+    if quiet:
+        quiet_stdout()
+    start = pipeline_stats.start_usage()
+    # make_scaling_hists_dict keeps the bins it finds in the var_specs
+    fill_dblib_scaling_hists.make_scaling_hists_dict(
+        dataset_path, materials, masses, copy.deepcopy(var_specs), energy_pairs,
+        n_workers, None, batch_size)
+    rows = dblib_dataset.open_dblib(dataset_path).count_rows()
+    return [("hists", stage_stats(start, rows))]
+
+# run a stage function in a process of its own, so that its peak RSS is its own
+def run_stage(function, *args):
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(function, *args).result()
+
+def append_results(results_fname, records):
+    os.makedirs(os.path.dirname(os.path.abspath(results_fname)), exist_ok=True)
+    with open(results_fname, "a") as fp:
+        for record in records:
+            fp.write(json.dumps(record) + "\n")
+
+def load_results(results_fname):
+    if not os.path.isfile(results_fname):
+        return []
+    with open(results_fname) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+# time every stage for every size and worker count (see above), repeats times
+# each, appending the results to results_fname; returns the run id
+def run_benchmarks(bench_dir, results_fname, sizes, worker_counts, materials,
+                   masses, var_specs, energy_pairs, repeats=1, batch_size=None,
+                   quiet=True):
+    run_id = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    common = {
+        "run_id" : run_id,
+        "commit" : git_commit(),
+        "host" : platform.node(),
+        "python" : platform.python_version(),
+        "n_cpus" : os.cpu_count()
+    }
+    for n_events in sizes:
+        dblib_dir = "{bench_dir}/dblib_{n_events}".format(bench_dir=bench_dir, n_events=n_events)
+        dataset_path = dblib_dir + "_dataset"
+        start = time.perf_counter()
+        n_files = make_synthetic_dblib(dblib_dir, materials, masses, energy_pairs, n_events)
+        print("{n_files} files of {n_events} events in {dblib_dir} ({t:.1f} s)".format(
+            n_files=n_files, n_events=n_events, dblib_dir=dblib_dir, t=time.perf_counter() - start))
+
+        for repeat in range(repeats):
+            jobs = []
+            for n_workers in worker_counts:
+                jobs.append((n_workers, bench_compile, dblib_dir, dataset_path,
+                             materials, masses, n_workers, quiet))
+            jobs.append((1, bench_load_derive, dataset_path, materials, masses,
+                         var_specs, energy_pairs, quiet))
+            for n_workers in worker_counts:
+                jobs.append((n_workers, bench_hists, dataset_path, materials, masses,
+                             var_specs, energy_pairs, n_workers, batch_size, quiet))
+            for n_workers, function, *args in jobs:
+                records = []
+                for stage, stats in run_stage(function, *args):
+                    record = dict(common, time=datetime.datetime.now().isoformat(timespec="seconds"),
+                                  stage=stage, n_events=n_events, n_files=n_files,
+                                  n_workers=n_workers, repeat=repeat)
+                    record.update(stats)
+                    records.append(record)
+                    print("{stage:>16} {n_events:>9} events/file {n_workers:>2} workers: {wall:8.2f} s wall {cpu:8.2f} s cpu, peak RSS {rss:.0f} MB ({child_rss:.0f} MB in a worker)".format(
+                        stage=stage, n_events=n_events, n_workers=n_workers, wall=stats["wall_s"],
+                        cpu=stats["cpu_s"], rss=stats["max_rss_mb"], child_rss=stats["max_child_rss_mb"]))
+                append_results(results_fname, records)
+    return run_id
+
+# compare the fastest wall time of each (stage, n_events, n_workers) in run
+# run_id (the last run if None) with the fastest of the earlier runs on the
+# same host, flagging those more than tolerance slower
+def compare_results(results_fname, run_id=None, tolerance=0.1):
+    results = load_results(results_fname)
+    if len(results) == 0:
+        print("no results in {}".format(results_fname))
+        return
+    if run_id is None:
+        run_id = results[-1]["run_id"]
+    host = [record["host"] for record in results if record["run_id"] == run_id][0]
+    best = {}
+    for record in results:
+        if record["host"] != host:
+            continue
+        key = (record["stage"], record["n_events"], record["n_workers"])
+        which = "now" if record["run_id"] == run_id else ("before" if record["run_id"] < run_id else None)
+        if which is None:
+            continue
+        best.setdefault(key, {}).setdefault(which, record["wall_s"])
+        best[key][which] = min(best[key][which], record["wall_s"])
+    print("run {run_id} on {host}:".format(run_id=run_id, host=host))
+    for (stage, n_events, n_workers), walls in sorted(best.items()):
+        if "now" not in walls:
+            continue
+        line = "{stage:>16} {n_events:>9} events/file {n_workers:>2} workers: {now:8.2f} s".format(
+            stage=stage, n_events=n_events, n_workers=n_workers, now=walls["now"])
+        if "before" in walls:
+            change = walls["now"] / walls["before"] - 1.
+            line += " (best before {before:.2f} s, {change:+.0%}){flag}".format(
+                before=walls["before"], change=change,
+                flag=" SLOWER" if change > tolerance else "")
+        print(line)
+
+# the synthetic libraries and compiled datasets go here
+bench_dir = "./dblib_benchmark"
+# one json line per stage per run, kept across runs to track regressions
+results_fname = "./dblib_benchmark_results.jsonl"
+# events per library file
+sizes = [10000, 100000]
+# worker processes for the compile and histogram stages
+worker_counts = [1, 4]
+repeats = 1
+materials = ["tungsten", "lead"]
+masses = ["0.01", "0.1"]
+var_specs = fill_dblib_scaling_hists.var_specs
+energy_pairs = [
+    (1.0, [1.1, 1.2, 1.5, 2.0, 3.0, 4.0]),
+    (4.0, [4.2, 4.4, 4.8, 6.0, 7.0, 8.0])
+]
+# rows per record batch in the histogram stage (None loads each cell whole)
+batch_size = None
+# hide the progress printed by the stages
+quiet = True
+
+if __name__ == "__main__":
+    run_id = run_benchmarks(bench_dir, results_fname, sizes, worker_counts, materials,
+                            masses, var_specs, energy_pairs, repeats, batch_size, quiet)
+    compare_results(results_fname, run_id)
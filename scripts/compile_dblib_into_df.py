@@ -1,50 +1,199 @@
 import pandas as pd
 import numpy as np
-import glob
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import dblib_catalog
+import dblib_dataset
+import pipeline_stats
 
 dblib_path = "/standard/ldmxuva/data/dblib"
 
-### run params: ( lepton, material, mA [GeV], scaled [bool], 
+### run params: ( lepton, material, mA [GeV], scaled [bool],
 ###               incident_energy [GeV], scaled_from_E [GeV], run number )
-### if scaled == False, then incident_energy == scaled_from_E
-### unscaled filename: <lepton>_<material>_mA_<mA>_E_<incident_energy>_unscaled_run_<run number>.csv
-### scaled filename: <lepton>_<material>_mA_<mA>_E_<incident_energy>_scaledFrom_<scaled_from_E>_run_<run number>.csv
+### parsed from the file names (see dblib_catalog)
 def extract_run_params_from_filename(name):
-    run_params = {}
-    toks = name.split('_')
-    run_params["lepton"] = toks[0]
-    run_params["material"] = toks[1]
-    run_params["mA"] = float(toks[3])
-    run_params["incident_energy"] = float(toks[5])
-    run_params["scaled"] = "scaledFrom" in toks
-    if run_params["scaled"]:
-        run_params["scaled_from_E"] = float(toks[7])
-        run_params["run_number"] = int(toks[9][:-4])
-    else:
-        run_params["scaled_from_E"] = run_params["incident_energy"]
-        run_params["run_number"] = int(toks[8][:-4])
-    return run_params
+    return dblib_catalog.run_params_from_filename(name)
+
+### column types of the csv files written by g4db-extract-library and g4db-scale
+### (see dblib_dataset for why these types are used)
+dblib_csv_schema = pa.schema([("incident_energy", pa.float64())]
+                             + dblib_dataset.kinematic_fields)
 
+### lepton, material, mA, scaled and incident_energy are partition keys of the
+### compiled dataset, so only the other run params are added as columns
+### (as categoricals: one byte per row rather than full-width copies)
 def add_extra_columns(run_params, df):
-    df['lepton'] = run_params['lepton']
-    df['target'] = run_params['material']
-    df['mA'] = run_params['mA']
-    df['scaled'] = run_params['scaled']
-    df['scaled_from_E'] = run_params['scaled_from_E']
-    df['run_number'] = run_params['run_number']
-
-def process_file(name):
+    codes = np.zeros(len(df), dtype=np.int8)
+    df['scaled_from_E'] = pd.Categorical.from_codes(codes, categories=[run_params['scaled_from_E']])
+    df['run_number'] = pd.Categorical.from_codes(codes, categories=[run_params['run_number']])
+
+def read_dblib_csv(name):
+    table = pacsv.read_csv(name,
+        convert_options=pacsv.ConvertOptions(column_types=dblib_csv_schema))
+    return table.to_pandas()
+
+# with report, prints the rows, parse time and memory of the file: the memory
+# of its frame, how much the RSS of the process grew while reading it, and
+# the peak RSS of the process so far (of all the files a pool worker has
+# read, not just this one)
+def process_file(name, report=False):
+    start = pipeline_stats.start_usage()
+    startRss = pipeline_stats.current_rss_mb()
     run_params = extract_run_params_from_filename(name)
-    df = pd.read_csv(name)
-    add_extra_columns(run_params, df)
+    with pipeline_stats.stage("read_csv", file=os.path.basename(name),
+                              material=run_params["material"], mass=run_params["mA"]) as stats:
+        df = read_dblib_csv(name)
+        add_extra_columns(run_params, df)
+        stats["rows"] = len(df)
+    if report:
+        usage = pipeline_stats.usage_since(start)
+        print("{name}: {n} rows, parsed in {t:.2f} s, {mb:.1f} MB in memory, RSS {drss:+.0f} MB, process peak RSS so far {rss:.0f} MB".format(
+            name = os.path.basename(name),
+            n = len(df),
+            t = usage["wall_s"],
+            mb = df.memory_usage(deep=True).sum() / 1e6,
+            drss = pipeline_stats.current_rss_mb() - startRss,
+            rss = usage["max_rss_mb"]
+        ))
     return df
 
+### manifest of the source csv files that are in the compiled dataset:
+###   { "sources" : { <csv filename> : <source entry> } }
+###   <source entry> = { "path", "size", "mtime_ns", "run_params", "n_rows", "output" }
+### it is kept in the dataset directory; files starting with '_' are ignored
+### when the dataset is read
+manifest_basename = "_dblib_manifest.json"
+
+def load_manifest(manifest_fname):
+    if not os.path.isfile(manifest_fname):
+        return {"sources" : {}}
+    with open(manifest_fname) as fp:
+        return json.load(fp)
+
+def save_manifest(manifest, manifest_fname):
+    # write then rename, so an interrupted compile never leaves a broken manifest
+    tmp_fname = manifest_fname + ".tmp"
+    with open(tmp_fname, "w") as fp:
+        json.dump(manifest, fp, indent=1)
+    os.replace(tmp_fname, manifest_fname)
+
+# from the catalog row of a csv file (see dblib_catalog), so the file is not
+# touched
+def source_entry(row):
+    return {
+        "path" : row["path"],
+        "size" : row["size"],
+        "mtime_ns" : row["mtime_ns"],
+        "run_params" : extract_run_params_from_filename(row["path"])
+    }
+
+def is_unchanged(entry, old_entry):
+    return (old_entry is not None
+            and entry["size"] == old_entry["size"]
+            and entry["mtime_ns"] == old_entry["mtime_ns"]
+            and os.path.isfile(old_entry["output"]))
+
+# the catalog rows of the csv files of one material and mass
+def find_source_files(catalog, scaled, material, mA, lepton="electron"):
+    return dblib_catalog.find_files(catalog, "scaled" if scaled else "unscaled",
+                                    material, mA, lepton=lepton)
+
+# parse one csv file and write it into its partition of the dataset
+def compile_file(entry, dataset_path, report=False):
+    df = process_file(entry["path"], report)
+    entry["n_rows"] = len(df)
+    entry["output"] = dblib_dataset.partition_filename(
+        dataset_path, entry["run_params"], entry["path"])
+    with pipeline_stats.stage("write_parquet", rows=len(df), file=os.path.basename(entry["output"]),
+                              material=entry["run_params"]["material"],
+                              mass=entry["run_params"]["mA"]):
+        dblib_dataset.write_partition_file(df, entry["output"])
+    return entry
+
+# bring the dataset up to date with the csv files for the given materials and
+# masses: only csv files that are new or changed since the last compile are
+# parsed (using up to n_workers processes), and the files of csv files that
+# have disappeared are removed; the manifest is saved after every file, so an
+# interrupted compile picks up where it left off
+# the csv files are found through the catalog (see dblib_catalog), which is
+# brought up to date first, and the parquet files are added to it
+def compile_dblib(dblib_path, dataset_path, materials, masses,
+                  n_workers=1, report=False, catalog_fname=None):
+    os.makedirs(dataset_path, exist_ok=True)
+    manifest_fname = os.path.join(dataset_path, manifest_basename)
+    manifest = load_manifest(manifest_fname)
+    sources = manifest["sources"]
+    if catalog_fname is None:
+        catalog_fname = os.path.join(dblib_path, dblib_catalog.catalog_basename)
+    catalog = dblib_catalog.open_catalog(catalog_fname)
+    with pipeline_stats.stage("update_catalog"):
+        print("catalog: {} new or changed, {} removed, {} unchanged library files".format(
+            *dblib_catalog.update_catalog(catalog, [dblib_path, dblib_path + "/scaled"],
+                                          kinds=["unscaled", "scaled"])))
+
+    entries = []
+    for material in materials:
+        for mass in masses:
+            for scaled in [False, True]:
+                entries += [source_entry(row) for row in
+                            find_source_files(catalog, scaled, material, mass)]
+    todo = [entry for entry in entries
+                if not is_unchanged(entry, sources.get(entry["path"]))]
+
+    found = set(entry["path"] for entry in entries)
+    cells = set((material, float(mass)) for material in materials for mass in masses)
+    removed = [name for name, old_entry in sources.items()
+                   if name not in found
+                   and (old_entry["run_params"]["material"], old_entry["run_params"]["mA"]) in cells]
+    for name in removed:
+        if os.path.isfile(sources[name]["output"]):
+            os.remove(sources[name]["output"])
+        dblib_catalog.remove_file(catalog, sources[name]["output"])
+        del sources[name]
+    print("{n_new} new or changed, {n_removed} removed, {n_same} unchanged source files".format(
+        n_new = len(todo), n_removed = len(removed), n_same = len(entries) - len(todo)))
+
+    def record(entry):
+        sources[entry["path"]] = entry
+        save_manifest(manifest, manifest_fname)
+        dblib_catalog.add_compiled_file(catalog, entry["output"], entry["path"],
+                                        entry["n_rows"])
+        catalog.commit()
+
+    save_manifest(manifest, manifest_fname)
+    with pipeline_stats.stage("compile", n_files=len(todo), n_workers=n_workers) as stats:
+        if n_workers <= 1:
+            for entry in todo:
+                record(compile_file(entry, dataset_path, report))
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(compile_file, entry, dataset_path, report)
+                               for entry in todo]
+                for future in as_completed(futures):
+                    record(future.result())
+        stats["rows"] = sum(sources[entry["path"]]["n_rows"] for entry in todo)
+    catalog.commit()
+    catalog.close()
+
 materials = ["copper", "lead", "oxygen", "silicon", "tungsten"]
 masses = ["0.005", "0.01", "0.05", "0.1"]
+dataset_path = "./dblib_dataset"
+# number of processes used to parse csv files in parallel
+n_workers = 4
+# print parse time and memory for every csv file that is read
+report_ingest = True
+# catalog of the library files (see dblib_catalog); None keeps it in dblib_path
+catalog_fname = None
+# record the time and memory of every stage in the dataset directory (see
+# pipeline_stats)
+record_stats = False
 
-for material in materials:
-    for mass in masses:
-        unscaled = pd.concat(map(process_file, glob.iglob(dblib_path + "/electron_" + material + "_mA_" + mass + "_E_*_unscaled_run_*.csv")))
-        scaled = pd.concat(map(process_file, glob.iglob(dblib_path + "/scaled/electron_" + material + "_mA_" + mass + "_E_*_scaledFrom_*_run_*.csv")))
-        unscaled.reset_index().to_feather("dblib_unscaled_electron_" + material + "_mA_" + mass + ".feather")
-        scaled.reset_index().to_feather("dblib_scaled_electron_" + material + "_mA_" + mass + ".feather")
+if __name__ == "__main__":
+    if record_stats:
+        pipeline_stats.enable(os.path.join(dataset_path, "_pipeline_stats.jsonl"))
+    compile_dblib(dblib_path, dataset_path, materials, masses,
+                  n_workers, report_ingest, catalog_fname)
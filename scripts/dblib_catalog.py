@@ -0,0 +1,209 @@
+import hashlib
+import os
+import re
+import sqlite3
+
+### Catalog of the dark brem library files, so that the scripts look files up
+### (and get their number of events) with one query instead of globbing the
+### library directories and counting lines again in every stage.
+### It is one SQLite file, by default next to the unscaled libraries, with a
+### row per file:
+###   path, kind (unscaled, scaled, combined or compiled), lepton, material,
+###   mA [GeV], incident_energy [GeV], scaled_from_E [GeV], run_number,
+###   n_events, size, mtime_ns, checksum, source
+### where the combined libraries are the all_mA_<mA>_run_<run>.csv files used
+### for the signal samples (lepton, material and energies are null), the
+### compiled files are the parquet files of compile_dblib_into_df.py (source
+### is the csv file they were compiled from) and checksum is the blake2b
+### digest of the whole file.
+### update_catalog re-reads only the files whose size or modification time
+### changed since they were catalogued, in one pass that both counts the events
+### and computes the checksum.
+### SQLite locking is unreliable on some network filesystems, so only one
+### script should update a catalog at a time.
+
+catalog_basename = "dblib_catalog.sqlite"
+
+file_kinds = ["unscaled", "scaled", "combined", "compiled"]
+
+catalog_columns = [
+    ("path", "TEXT PRIMARY KEY"),
+    ("kind", "TEXT NOT NULL"),
+    ("lepton", "TEXT"),
+    ("material", "TEXT"),
+    ("mA", "REAL"),
+    ("incident_energy", "REAL"),
+    ("scaled_from_E", "REAL"),
+    ("run_number", "INTEGER"),
+    ("n_events", "INTEGER"),
+    ("size", "INTEGER"),
+    ("mtime_ns", "INTEGER"),
+    ("checksum", "TEXT"),
+    ("source", "TEXT")
+]
+
+### library file names:
+###   unscaled: <lepton>_<material>_mA_<mA>_E_<incident_energy>_unscaled_run_<run number>.csv
+###   scaled: <lepton>_<material>_mA_<mA>_E_<incident_energy>_scaledFrom_<scaled_from_E>_run_<run number>.csv
+###   combined: all_mA_<mA>_run_<run number>.csv
+### (compiled files are named after their csv file, with .parquet)
+unscaled_pattern = re.compile(r"([^_]+)_([^_]+)_mA_([^_]+)_E_([^_]+)_unscaled_run_([0-9]+)\.(csv|parquet)")
+scaled_pattern = re.compile(r"([^_]+)_([^_]+)_mA_([^_]+)_E_([^_]+)_scaledFrom_([^_]+)_run_([0-9]+)\.(csv|parquet)")
+combined_pattern = re.compile(r"all_mA_([^_]+)_run_([0-9]+)\.csv")
+
+### run params: ( kind, lepton, material, mA [GeV], scaled [bool],
+###               incident_energy [GeV], scaled_from_E [GeV], run_number )
+### if scaled == False, then incident_energy == scaled_from_E
+### returns None for a file that is not a library file
+def run_params_from_filename(name):
+    name = os.path.basename(name)
+    match = unscaled_pattern.fullmatch(name)
+    if match is not None:
+        return {"kind" : "unscaled", "lepton" : match.group(1), "material" : match.group(2),
+                "mA" : float(match.group(3)), "scaled" : False,
+                "incident_energy" : float(match.group(4)),
+                "scaled_from_E" : float(match.group(4)),
+                "run_number" : int(match.group(5))}
+    match = scaled_pattern.fullmatch(name)
+    if match is not None:
+        return {"kind" : "scaled", "lepton" : match.group(1), "material" : match.group(2),
+                "mA" : float(match.group(3)), "scaled" : True,
+                "incident_energy" : float(match.group(4)),
+                "scaled_from_E" : float(match.group(5)),
+                "run_number" : int(match.group(6))}
+    match = combined_pattern.fullmatch(name)
+    if match is not None:
+        return {"kind" : "combined", "lepton" : None, "material" : None,
+                "mA" : float(match.group(1)), "scaled" : None,
+                "incident_energy" : None, "scaled_from_E" : None,
+                "run_number" : int(match.group(2))}
+    return None
+
+def open_catalog(catalog_fname):
+    conn = sqlite3.connect(catalog_fname, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE IF NOT EXISTS files ({})".format(
+        ", ".join(name + " " + decl for name, decl in catalog_columns)))
+    conn.execute("CREATE INDEX IF NOT EXISTS files_by_point ON files "
+                 "(kind, lepton, material, mA, incident_energy)")
+    conn.commit()
+    return conn
+
+# (number of lines, checksum) of a file, read once in blocks; a last line
+# without a newline still counts
+def count_and_checksum(fname, block_size=1 << 22):
+    n_lines = 0
+    last = b"\n"
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fname, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            n_lines += block.count(b"\n")
+            digest.update(block)
+            last = block[-1:]
+    if last != b"\n":
+        n_lines += 1
+    return n_lines, digest.hexdigest()
+
+def checksum(fname):
+    return count_and_checksum(fname)[1]
+
+def add_file(conn, fname, kind, run_params, n_events, digest, source=None, st=None):
+    if st is None:
+        st = os.stat(fname)
+    row = {"path" : fname, "kind" : kind, "n_events" : n_events,
+           "size" : st.st_size, "mtime_ns" : st.st_mtime_ns,
+           "checksum" : digest, "source" : source}
+    for name in ["lepton", "material", "mA", "incident_energy", "scaled_from_E", "run_number"]:
+        row[name] = run_params[name]
+    names = [name for name, _ in catalog_columns]
+    conn.execute("INSERT OR REPLACE INTO files ({}) VALUES ({})".format(
+        ", ".join(names), ", ".join("?" * len(names))), [row[name] for name in names])
+
+# catalog a compiled parquet file (n_events is its number of rows)
+def add_compiled_file(conn, fname, source, n_events):
+    run_params = run_params_from_filename(source)
+    add_file(conn, fname, "compiled", run_params, n_events, checksum(fname), source)
+
+# catalog one csv library file (counting its events and computing its
+# checksum); returns False if it is not a library file
+def add_csv_file(conn, fname, st=None):
+    run_params = run_params_from_filename(fname)
+    if run_params is None:
+        return False
+    n_lines, digest = count_and_checksum(fname)
+    # one header line
+    add_file(conn, fname, run_params["kind"], run_params, max(n_lines - 1, 0), digest, st=st)
+    return True
+
+def remove_file(conn, fname):
+    conn.execute("DELETE FROM files WHERE path = ?", (fname,))
+
+# bring the catalog up to date with the csv library files directly in dirs
+# (each directory is listed once; files are only read if they are new or
+# changed) and drop the files of those directories that are gone; kinds
+# restricts which kinds of library files are catalogued
+# returns the number of (new or changed, removed, unchanged) files
+def update_catalog(conn, dirs, kinds=("unscaled", "scaled", "combined")):
+    n_new = n_removed = n_same = 0
+    for dirname in dirs:
+        known = {row["path"] : row for row in conn.execute(
+            "SELECT path, size, mtime_ns, kind FROM files WHERE kind != 'compiled' AND path LIKE ?",
+            (os.path.join(dirname, "%"),)) if os.path.dirname(row["path"]) == dirname}
+        found = set()
+        if os.path.isdir(dirname):
+            with os.scandir(dirname) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".csv") or not entry.is_file():
+                        continue
+                    run_params = run_params_from_filename(entry.name)
+                    if run_params is None or run_params["kind"] not in kinds:
+                        continue
+                    fname = os.path.join(dirname, entry.name)
+                    found.add(fname)
+                    st = entry.stat()
+                    old = known.get(fname)
+                    if old is not None and old["size"] == st.st_size and old["mtime_ns"] == st.st_mtime_ns:
+                        n_same += 1
+                        continue
+                    add_csv_file(conn, fname, st)
+                    n_new += 1
+                    if n_new % 100 == 0:
+                        conn.commit()
+        for fname, row in known.items():
+            if fname not in found and row["kind"] in kinds:
+                remove_file(conn, fname)
+                n_removed += 1
+    conn.commit()
+    return n_new, n_removed, n_same
+
+# the catalogued files of one kind matching the given run params (None
+# matches anything), ordered by path, as dicts
+# combined libraries have no lepton in their names (lepton is NULL), so
+# lepton is only a condition when it is given
+def find_files(conn, kind, material=None, mA=None, incident_energy=None,
+               scaled_from_E=None, run_number=None, lepton=None):
+    conditions = ["kind = ?"]
+    values = [kind]
+    for name, value in [("lepton", lepton), ("material", material), ("mA", mA),
+                        ("incident_energy", incident_energy),
+                        ("scaled_from_E", scaled_from_E), ("run_number", run_number)]:
+        if value is not None:
+            conditions.append(name + " = ?")
+            values.append(float(value) if name in ["mA", "incident_energy", "scaled_from_E"] else value)
+    return [dict(row) for row in conn.execute(
+        "SELECT * FROM files WHERE " + " AND ".join(conditions) + " ORDER BY path", values)]
+
+# the catalog entry of one file as a dict, or None if it is not catalogued
+def file_info(conn, fname):
+    row = conn.execute("SELECT * FROM files WHERE path = ?", (fname,)).fetchone()
+    return None if row is None else dict(row)
+
+# the number of events of a file if its catalog entry is up to date with it
+def n_events_of(conn, fname):
+    info = file_info(conn, fname)
+    if info is None or not os.path.isfile(fname):
+        return None
+    st = os.stat(fname)
+    if info["size"] != st.st_size or info["mtime_ns"] != st.st_mtime_ns:
+        return None
+    return info["n_events"]
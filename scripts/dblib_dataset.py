@@ -0,0 +1,223 @@
+import os
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import dblib_derived
+import pipeline_stats
+
+### The compiled dark brem library is a hive-partitioned parquet dataset:
+###   <dataset_path>/lepton=<lepton>/material=<material>/mA=<mA>/scaled=<scaled>/incident_energy=<E>/<csv stem>.parquet
+### with one parquet file per source csv file. The partition keys are not
+### stored in the parquet files themselves, so selecting on any of them only
+### opens the matching directories.
+
+### columns stored in every parquet file
+### the incident energy stays float64 so that it compares exactly to the
+### energies we select on (e.g. 1.1 GeV); the kinematics only need float32
+kinematic_fields = [
+    ("recoil_energy", pa.float32()),
+    ("recoil_px", pa.float32()),
+    ("recoil_py", pa.float32()),
+    ("recoil_pz", pa.float32()),
+    ("centerMomentum_energy", pa.float32()),
+    ("centerMomentum_px", pa.float32()),
+    ("centerMomentum_py", pa.float32()),
+    ("centerMomentum_pz", pa.float32())
+]
+### the run params that are not partition keys are the same for every row of a
+### file: parquet run-length encodes them to almost nothing on disk, their
+### row group statistics let selections on them skip whole files, and they are
+### loaded as categoricals in pandas
+run_param_fields = [
+    ("scaled_from_E", pa.float64()),
+    ("run_number", pa.int64())
+]
+### incident_energy is used in arithmetic (energy fractions), so it is read as
+### a plain float64 column rather than a categorical
+partition_fields = [
+    ("lepton", pa.dictionary(pa.int32(), pa.string())),
+    ("material", pa.dictionary(pa.int32(), pa.string())),
+    ("mA", pa.dictionary(pa.int32(), pa.float64())),
+    ("scaled", pa.dictionary(pa.int32(), pa.bool_())),
+    ("incident_energy", pa.float64())
+]
+
+file_schema = pa.schema(kinematic_fields + run_param_fields)
+partitioning = ds.partitioning(pa.schema(partition_fields), flavor="hive",
+                               dictionaries="infer")
+
+# run_params as returned by extract_run_params_from_filename
+# floats are written with repr, which round-trips exactly
+def partition_path(dataset_path, run_params):
+    return os.path.join(dataset_path,
+        "lepton={}".format(run_params["lepton"]),
+        "material={}".format(run_params["material"]),
+        "mA={}".format(repr(run_params["mA"])),
+        "scaled={}".format(run_params["scaled"]),
+        "incident_energy={}".format(repr(run_params["incident_energy"]))
+    )
+
+def partition_filename(dataset_path, run_params, source_fname):
+    stem = os.path.splitext(os.path.basename(source_fname))[0]
+    return os.path.join(partition_path(dataset_path, run_params), stem + ".parquet")
+
+# df must have the columns of file_schema; partition columns are dropped
+def write_partition_file(df, out_fname):
+    os.makedirs(os.path.dirname(out_fname), exist_ok=True)
+    table = pa.Table.from_pandas(df[file_schema.names], schema=file_schema,
+                                 preserve_index=False)
+    # files starting with '.' are ignored by dataset discovery, so a partially
+    # written file is never read
+    tmp_fname = os.path.join(os.path.dirname(out_fname),
+                             "." + os.path.basename(out_fname) + ".tmp")
+    pq.write_table(table, tmp_fname)
+    os.replace(tmp_fname, out_fname)
+
+def open_dblib(dataset_path):
+    return ds.dataset(dataset_path, format="parquet", partitioning=partitioning)
+
+def in_values(field, values):
+    return ds.field(field).isin(pa.array(values, type=pa.float64()))
+
+def selection_for(scaled, material, mA, incident_energies=None,
+                  scaled_from_Es=None, lepton="electron"):
+    selection = ((ds.field("lepton") == lepton)
+                 & (ds.field("material") == material)
+                 & (ds.field("mA") == float(mA))
+                 & (ds.field("scaled") == bool(scaled)))
+    if incident_energies is not None:
+        selection = selection & in_values("incident_energy", incident_energies)
+    if scaled_from_Es is not None:
+        selection = selection & in_values("scaled_from_E", scaled_from_Es)
+    return selection
+
+def to_pandas(table):
+    return table.to_pandas(categories=[name for name, _ in run_param_fields
+                                           if name in table.column_names])
+
+# load the part of the library needed for one histogram request
+# incident_energies and scaled_from_Es select on those energies (None means
+# all of them) and columns selects which columns to read (None means all);
+# only the matching partitions and columns are read from disk
+# derived is a list of derived columns (see dblib_derived) to add; with a
+# derived_path they are kept there next to the library, one file per parquet
+# file, and reused by later loads as long as the parquet file is unchanged
+def load_dblib_slice(dataset_path, scaled, material, mA,
+                     incident_energies=None, scaled_from_Es=None,
+                     columns=None, lepton="electron",
+                     derived=None, derived_path=None):
+    selection = selection_for(scaled, material, mA, incident_energies,
+                              scaled_from_Es, lepton)
+    dataset = open_dblib(dataset_path)
+    if derived is None:
+        with pipeline_stats.stage("read_parquet", material=material, mass=float(mA),
+                                  scaled=bool(scaled)) as stats:
+            df = to_pandas(dataset.to_table(columns=columns, filter=selection))
+            stats["rows"] = len(df)
+        return df
+
+    if columns is None:
+        columns = dataset.schema.names
+    tables = []
+    # the selections are all on partition keys or on columns that are the
+    # same for the whole file, so each file is either read whole or skipped
+    for fragment in dataset.get_fragments(filter=selection):
+        frame = {}
+        labels = {"material" : material, "mass" : float(mA), "scaled" : bool(scaled),
+                  "file" : os.path.basename(fragment.path)}
+        if derived_path is not None:
+            cache_fname = os.path.join(derived_path,
+                                       os.path.relpath(fragment.path, dataset_path))
+            with pipeline_stats.stage("read_derived_cache", **labels) as stats:
+                frame = load_derived_cache(cache_fname, fragment.path,
+                                           fragment.metadata.num_rows)
+                stats["columns"] = len(frame)
+        n_cached = len(frame)
+        # only read what is needed for the columns that are not cached
+        needed = dblib_derived.base_columns([name for name in derived if name not in frame])
+        with pipeline_stats.stage("read_parquet", **labels) as stats:
+            table = ds.Scanner.from_fragment(
+                fragment, schema=dataset.schema, filter=selection,
+                columns=columns + [column for column in needed if column not in columns]
+            ).to_table()
+            stats["rows"] = table.num_rows
+        if table.num_rows == 0:
+            continue
+        for column in needed:
+            frame[column] = table.column(column).to_numpy()
+        with pipeline_stats.stage("derive", rows=table.num_rows, **labels):
+            dblib_derived.derive(frame, derived)
+        computed = {name : frame[name] for name in frame
+                        if name in dblib_derived.derived_columns}
+        if derived_path is not None and len(computed) > n_cached:
+            with pipeline_stats.stage("write_derived_cache", rows=table.num_rows, **labels):
+                save_derived_cache(cache_fname, fragment.path, computed)
+
+        table = table.select(columns)
+        for name in derived:
+            table = table.append_column(name, pa.array(frame[name]))
+        tables.append(table)
+    if len(tables) == 0:
+        df = to_pandas(dataset.to_table(columns=columns, filter=selection))
+        for name in derived:
+            df[name] = np.zeros(0)
+        return df
+    return to_pandas(pa.concat_tables(tables))
+
+# iterate over the same selection as load_dblib_slice in record batches of at
+# most batch_size rows, each a dict of column name -> numpy array with the
+# derived columns added, so that only one batch is ever in memory; files are
+# read in the same order as load_dblib_slice reads them and each batch comes
+# from a single file (the derived columns are computed per batch, the on-disk
+# cache is not used)
+def iter_dblib_batches(dataset_path, scaled, material, mA,
+                       incident_energies=None, scaled_from_Es=None,
+                       columns=None, lepton="electron", derived=None,
+                       batch_size=1 << 20):
+    selection = selection_for(scaled, material, mA, incident_energies,
+                              scaled_from_Es, lepton)
+    dataset = open_dblib(dataset_path)
+    if columns is None:
+        columns = dataset.schema.names
+    if derived is None:
+        derived = []
+    to_read = columns + [column for column in dblib_derived.base_columns(derived)
+                             if column not in columns]
+    for fragment in dataset.get_fragments(filter=selection):
+        scanner = ds.Scanner.from_fragment(fragment, schema=dataset.schema,
+                                           columns=to_read, filter=selection,
+                                           batch_size=batch_size)
+        for batch in scanner.to_batches():
+            if batch.num_rows == 0:
+                continue
+            frame = {column : batch.column(column).to_numpy(zero_copy_only=False)
+                         for column in to_read}
+            yield dblib_derived.derive(frame, derived)
+
+### the derived columns of one parquet file are cached in a parquet file of the
+### same name under derived_path, tagged with the size and modification time
+### of the file they were computed from
+def source_tag(fname):
+    st = os.stat(fname)
+    return json.dumps({"size" : st.st_size, "mtime_ns" : st.st_mtime_ns}).encode()
+
+def load_derived_cache(cache_fname, source_fname, n_rows):
+    if not os.path.isfile(cache_fname):
+        return {}
+    table = pq.read_table(cache_fname)
+    metadata = table.schema.metadata or {}
+    if (metadata.get(b"dblib_source") != source_tag(source_fname)
+            or table.num_rows != n_rows):
+        return {}
+    return {name : table.column(name).to_numpy() for name in table.column_names}
+
+def save_derived_cache(cache_fname, source_fname, columns):
+    os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+    table = pa.table(columns).replace_schema_metadata(
+        {"dblib_source" : source_tag(source_fname)})
+    tmp_fname = cache_fname + ".tmp"
+    pq.write_table(table, tmp_fname)
+    os.replace(tmp_fname, cache_fname)
@@ -0,0 +1,74 @@
+import numpy as np
+
+### Derived kinematics of the dark brem vertices, computed on demand.
+### derived_columns maps each derived column to
+###   ([columns it is computed from], function of those columns as arrays)
+### derive() computes a column (and whatever it depends on) only if it is not
+### already in the frame, and keeps the result in the frame, so each column is
+### computed at most once per frame. A frame is anything that maps column
+### names to arrays: a DataFrame, or a dict of numpy arrays.
+### The kinematics are stored as float32 and the derived columns stay float32,
+### except for the angle between the recoil and the A', where float32 rounding
+### pushes the cosine of nearly collinear pairs above 1.
+
+def difference(a, b):
+    return np.subtract(a, b)
+
+def transverse(px, py):
+    out = np.square(px)
+    out += np.square(py)
+    return np.sqrt(out, out=out)
+
+def absolute_difference(a, b):
+    out = np.subtract(a, b)
+    return np.abs(out, out=out)
+
+def opening_angle(ax, ay, az, bx, by, bz):
+    ax, ay, az, bx, by, bz = [np.asarray(p, dtype=np.float64) for p in (ax, ay, az, bx, by, bz)]
+    dot = ax * bx + ay * by + az * bz
+    norms = (np.square(ax) + np.square(ay) + np.square(az)) * (np.square(bx) + np.square(by) + np.square(bz))
+    dot /= np.sqrt(norms, out=norms)
+    return np.arccos(dot, out=dot)
+
+derived_columns = {
+    "ap_energy" : (["centerMomentum_energy", "recoil_energy"], difference),
+    "ap_px" : (["centerMomentum_px", "recoil_px"], difference),
+    "ap_py" : (["centerMomentum_py", "recoil_py"], difference),
+    "ap_pz" : (["centerMomentum_pz", "recoil_pz"], difference),
+
+    "recoil_pt" : (["recoil_px", "recoil_py"], transverse),
+    "ap_pt" : (["ap_px", "ap_py"], transverse),
+    "recoil_phi" : (["recoil_py", "recoil_px"], np.arctan2),
+    "ap_phi" : (["ap_py", "ap_px"], np.arctan2),
+    "recoil_theta" : (["recoil_pt", "recoil_pz"], np.arctan2),
+    "ap_theta" : (["ap_pt", "ap_pz"], np.arctan2),
+
+    "recoil_energy_frac" : (["recoil_energy", "incident_energy"], np.divide),
+    "ap_energy_frac" : (["ap_energy", "incident_energy"], np.divide),
+    "delta_phi" : (["recoil_phi", "ap_phi"], absolute_difference),
+                   #np.minimum(np.abs(recoil_phi - ap_phi),
+                   #2*math.pi - np.abs(recoil_phi - ap_phi))
+
+    "angle_recoil_ap" : (["ap_px", "ap_py", "ap_pz",
+                          "recoil_px", "recoil_py", "recoil_pz"], opening_angle)
+}
+
+def derive(frame, names):
+    for name in names:
+        if name in frame:
+            continue
+        dependencies, function = derived_columns[name]
+        derive(frame, dependencies)
+        frame[name] = function(*[np.asarray(frame[dep]) for dep in dependencies])
+    return frame
+
+# the stored columns that the given columns are computed from
+def base_columns(names):
+    columns = []
+    for name in names:
+        if name in derived_columns:
+            new_columns = base_columns(derived_columns[name][0])
+        else:
+            new_columns = [name]
+        columns += [column for column in new_columns if column not in columns]
+    return columns
@@ -0,0 +1,201 @@
+import os
+import signal
+import subprocess
+import time
+
+import slurm_bundle
+import slurm_estimates
+
+### Where the points of gen_unscaled_library.py, gen_signal_samples.py and
+### perform_scalings.py run. A point is one call of a point function defined by
+### an env script (gen_unscaled_point in run_db_gen_then_extract.sh,
+### fire_point in setup_ldmx_and_fire.sh, scale_point in run_g4db_scale.sh),
+### given as a row [log stem, arguments...] as for slurm_bundle, with the
+### hours and memory (MB) it needs. Every backend takes
+###   (job_name, rows, hours, mems, output_path, env_script, point_function,
+###    env_args, **options)
+### and writes the output of each point to
+###   {output_path}/slurm/slurm_{log stem}.out and .err
+### ending the .err log with the timing line of slurm_estimates, so the
+### measurements and estimates work the same whichever backend ran the point.
+###   slurm: one job array (see slurm_bundle); options points_per_task,
+###          concurrent, bundle_script and cpus_per_point
+###   local: the points run on this machine, as many at a time as fit in
+###          max_cpus cpus and max_mem MB (all of the machine by default), each
+###          in its own bash that sources the env script and then calls the
+###          point function; each point is pinned to cpus_per_point cpus and,
+###          with enforce_limits, killed when its processes use more memory
+###          than its request or it runs longer than its hours, as slurm would
+
+def submit_slurm(job_name, rows, hours, mems, output_path, env_script, point_function,
+                 env_args=[], points_per_task=1, concurrent=False,
+                 bundle_script=slurm_bundle.bundle_script, cpus_per_point=1):
+    slurm_bundle.submit_job_array(job_name, rows, hours, mems, output_path, env_script,
+                                  point_function, points_per_task, concurrent, env_args,
+                                  bundle_script, cpus_per_point)
+
+def total_memory_mb():
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**20
+
+# resident memory (kB) of all the processes of each of the given sessions,
+# read from /proc in one pass
+def session_rss_kb(sessions):
+    page_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+    rss_kb = {session : 0 for session in sessions}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(pid)) as fp:
+                # the fields after the command name (which can contain spaces)
+                fields = fp.read().rsplit(")", 1)[1].split()
+            session = int(fields[3])
+            if session not in rss_kb:
+                continue
+            with open("/proc/{}/statm".format(pid)) as fp:
+                rss_kb[session] += int(fp.read().split()[1]) * page_kb
+        except (OSError, IndexError, ValueError):
+            # the process ended while being read
+            continue
+    return rss_kb
+
+def start_local_point(row, log_dir, env_script, point_function, env_args, cpus):
+    log_stem = str(row[0])
+    # the point function gets the arguments as they are, as run_param_bundle.sh
+    # passes them
+    script = "source {env_script} {env_args}\n{point_function} \"$@\"\n".format(
+        env_script=env_script, env_args=" ".join(str(arg) for arg in env_args),
+        point_function=point_function)
+    env = dict(os.environ)
+    # the point scripts size their own parallelism from this (e.g. the top-up
+    # runs of run_db_gen_then_extract.sh)
+    env["SLURM_CPUS_PER_TASK"] = str(len(cpus))
+    with open("{}/slurm_{}.out".format(log_dir, log_stem), "w") as out, \
+         open("{}/slurm_{}.err".format(log_dir, log_stem), "w") as err:
+        process = subprocess.Popen(
+            ["bash", "-c", script, "bash"] + [str(arg) for arg in row[1:]],
+            stdin=subprocess.DEVNULL, stdout=out, stderr=err, env=env,
+            start_new_session=True, preexec_fn=lambda: os.sched_setaffinity(0, cpus))
+    return process
+
+# end the .err log of a point with its timing, as write_timed_command and
+# run_param_bundle.sh do; the memory is the peak of the point's own processes
+def write_local_timing(err_fname, wall_s, max_rss_kb, exit_status, note=None):
+    with open(err_fname, "a") as fp:
+        if note is not None:
+            fp.write("### local backend: {}\n".format(note))
+        fp.write("{marker} wall_s={wall_s} max_rss_kb={rss}K rss_of=point concurrent=1 exit={exit}\n".format(
+            marker=slurm_estimates.timing_marker, wall_s=int(round(wall_s)),
+            rss=max_rss_kb, exit=exit_status))
+
+# the aggregate throughput of a local run, where busy_cpu_s is the sum over
+# the points of their wall time times the cpus they had
+def print_throughput(job_name, n_done, n, wall, busy_cpu_s, n_cpus):
+    print("{job_name}: {n_done} of {n} points done in {wall:.0f} s, {rate:.1f} points/hour, {util:.0%} of {n_cpus} cpus busy".format(
+        job_name=job_name, n_done=n_done, n=n, wall=wall,
+        rate=n_done / wall * 3600 if wall > 0 else 0., n_cpus=n_cpus,
+        util=busy_cpu_s / wall / n_cpus if wall > 0 else 0.))
+
+# run the points on this machine (see above) and print their aggregate
+# throughput; returns a list of (log stem, exit status, wall s, peak RSS MB),
+# in the order the points finished
+def run_local(job_name, rows, hours, mems, output_path, env_script, point_function,
+              env_args=[], max_cpus=None, max_mem=None, cpus_per_point=1,
+              enforce_limits=True, poll_interval=2.):
+    log_dir = output_path + "/slurm"
+    os.makedirs(log_dir, exist_ok=True)
+    all_cpus = sorted(os.sched_getaffinity(0))
+    if max_cpus is not None:
+        all_cpus = all_cpus[:max_cpus]
+    if max_mem is None:
+        max_mem = total_memory_mb()
+    free_cpus = list(all_cpus)
+    free_mem = max_mem
+
+    results = []
+    pending = []
+    for i in range(len(rows)):
+        if cpus_per_point > len(all_cpus) or mems[i] > max_mem:
+            print("{stem}: needs {cpus} cpus and {mem} MB, more than the {max_cpus} cpus and {max_mem:.0f} MB available, not run".format(
+                stem=rows[i][0], cpus=cpus_per_point, mem=mems[i],
+                max_cpus=len(all_cpus), max_mem=max_mem))
+            results.append((str(rows[i][0]), None, 0., None))
+        else:
+            pending.append(i)
+    print("{job_name}: {n} points on {n_cpus} cpus and {mem:.0f} MB".format(
+        job_name=job_name, n=len(pending), n_cpus=len(all_cpus), mem=max_mem))
+
+    startWall = time.perf_counter()
+    busy_cpu_s = 0.
+    running = {} # point index -> {process, cpus, start, max_rss_kb, note}
+    while len(pending) > 0 or len(running) > 0:
+        # start every pending point that fits, in order (a later, smaller
+        # point can start while an earlier one waits for room)
+        for i in list(pending):
+            if cpus_per_point <= len(free_cpus) and mems[i] <= free_mem:
+                cpus = free_cpus[:cpus_per_point]
+                del free_cpus[:cpus_per_point]
+                free_mem -= mems[i]
+                pending.remove(i)
+                running[i] = {
+                    "process" : start_local_point(rows[i], log_dir, env_script,
+                                                  point_function, env_args, cpus),
+                    "cpus" : cpus,
+                    "start" : time.perf_counter(),
+                    "max_rss_kb" : 0,
+                    "note" : None
+                }
+
+        time.sleep(poll_interval)
+        # each point is the leader of its own session
+        rss_kb_of = session_rss_kb([point["process"].pid for point in running.values()])
+        for i, point in list(running.items()):
+            process = point["process"]
+            wall_s = time.perf_counter() - point["start"]
+            if process.poll() is None:
+                rss_kb = rss_kb_of[process.pid]
+                point["max_rss_kb"] = max(point["max_rss_kb"], rss_kb)
+                if enforce_limits and point["note"] is None:
+                    if rss_kb > mems[i] * 1024:
+                        point["note"] = "killed at {:.0f} MB, over the {} MB requested".format(
+                            rss_kb / 1024, mems[i])
+                    elif wall_s > hours[i] * 3600:
+                        point["note"] = "killed, over the {} hours requested".format(hours[i])
+                    if point["note"] is not None:
+                        os.killpg(process.pid, signal.SIGKILL)
+                continue
+
+            exit_status = process.returncode
+            if exit_status < 0:
+                # killed by a signal, written the way bash reports it
+                exit_status = 128 - exit_status
+            write_local_timing("{}/slurm_{}.err".format(log_dir, rows[i][0]), wall_s,
+                               point["max_rss_kb"], exit_status, point["note"])
+            busy_cpu_s += wall_s * len(point["cpus"])
+            free_cpus += point["cpus"]
+            free_mem += mems[i]
+            del running[i]
+            results.append((str(rows[i][0]), exit_status, wall_s, point["max_rss_kb"] / 1024))
+            print("{state}: {stem} ({wall:.0f} s, peak RSS {rss:.0f} MB)".format(
+                state="done" if exit_status == 0 else "failed ({})".format(point["note"] or exit_status),
+                stem=rows[i][0], wall=wall_s, rss=point["max_rss_kb"] / 1024))
+
+    wall = time.perf_counter() - startWall
+    n_done = sum(1 for result in results if result[1] == 0)
+    print_throughput(job_name, n_done, len(rows), wall, busy_cpu_s, len(all_cpus))
+    return results
+
+backends = {
+    "slurm" : submit_slurm,
+    "local" : run_local
+}
+
+# run the points with the named backend; options are those of the backend
+def run_points(backend, job_name, rows, hours, mems, output_path, env_script,
+               point_function, env_args=[], options={}):
+    if backend not in backends:
+        raise ValueError("unknown backend {} (one of {})".format(backend, ", ".join(backends)))
+    if len(rows) == 0:
+        return None
+    return backends[backend](job_name, rows, hours, mems, output_path, env_script,
+                             point_function, env_args, **options)
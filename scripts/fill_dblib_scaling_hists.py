@@ -1,8 +1,41 @@
 import numpy as np
-import pandas as pd
 import math
 import json
-import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import dblib_dataset
+import dblib_derived
+import hist_store
+import pipeline_stats
+
+# baseSeq is the sequence that will be used to set the bin widths/edges
+# return the bin edges (in log units if logX)
+# NaNs are ignored when finding the range, as pandas does
+def make_comparison_bins(baseSeq, compSeqs, minX=None, maxX=None, logX=False):
+    minVal = np.nanmin(np.asarray(baseSeq))
+    maxVal = np.nanmax(np.asarray(baseSeq))
+    if len(compSeqs) > 0:
+        minVal = min(minVal, min([np.nanmin(np.asarray(seq)) for seq in compSeqs]))
+        maxVal = max(maxVal, max([np.nanmax(np.asarray(seq)) for seq in compSeqs]))
+    if minX is None:
+        minX = minVal - 0.05 * (maxVal - minVal)
+    if maxX is None:
+        maxX = maxVal + 0.05 * (maxVal - minVal)
+
+    if logX:
+        bins = np.histogram_bin_edges(np.log(baseSeq), bins='auto', range=(np.log(minX), np.log(maxX)))
+    else:
+        bins = np.histogram_bin_edges(baseSeq, bins='auto', range=(minX, maxX))
+
+    # sometimes histogram_bin_edges returns a huge number (30000+),
+    # so truncate
+    if len(bins) > 50:
+        if logX:
+            bins = np.histogram_bin_edges(np.log(baseSeq), bins=50, range=(np.log(minX), np.log(maxX)))
+        else:
+            bins = np.histogram_bin_edges(baseSeq, bins=50, range=(minX, maxX))
+    return bins
 
 # baseSeq is the sequence that will be used to set the bin widths/edges
 # assuming the bins are not passes as a parameter
@@ -12,33 +45,14 @@ def make_comparison_hists(baseSeq, compSeqs,
                           minX=None, maxX=None, bins=None,
                           logX=False, cumulative=False):
     if bins is None:
-        minVal = np.min(baseSeq)
-        maxVal = np.max(baseSeq)
-        if len(compSeqs) > 0:
-            minVal = min(minVal, min([np.min(seq) for seq in compSeqs]))
-            maxVal = max(maxVal, max([np.max(seq) for seq in compSeqs]))
-        if minX is None:
-            minX = minVal - 0.05 * (maxVal - minVal)
-        if maxX is None:
-            maxX = maxVal + 0.05 * (maxVal - minVal)
+        bins = make_comparison_bins(baseSeq, compSeqs, minX, maxX, logX)
+    elif logX: # bins are passed in the same units as they are returned
+        bins = np.log(bins)
 
-        if logX:
-            bins = np.histogram_bin_edges(np.log(baseSeq), bins='auto', range=(np.log(minX), np.log(maxX)))
-        else:
-            bins = np.histogram_bin_edges(baseSeq, bins='auto', range=(minX, maxX))
-
-        # sometimes histogram_bin_edges returns a huge number (30000+),
-        # so truncate
-        if len(bins) > 50:
-            if logX:
-                bins = np.histogram_bin_edges(np.log(baseSeq), bins=50, range=(np.log(minX), np.log(maxX)))
-            else:
-                bins = np.histogram_bin_edges(baseSeq, bins=50, range=(minX, maxX))
-    
-    baseHist = np.histogram(log(baseSeq) if logX else baseSeq, bins=bins,
+    baseHist = np.histogram(np.log(baseSeq) if logX else baseSeq, bins=bins,
                             weights=np.full(len(baseSeq), 1./len(baseSeq)))[0]
     compHists = [
-        np.histogram(log(seq) if logX else seq, bins=bins,
+        np.histogram(np.log(seq) if logX else seq, bins=bins,
                      weights=np.full(len(seq), 1./len(seq)))[0]
             for seq in compSeqs
     ]
@@ -74,95 +88,497 @@ def make_comparison_scaled_hists(unscaled, scaled, varName, baseE, compEs,
     return make_comparison_hists(baseESeq, compEsSeqs,
                                  minX, maxX, bins, logX, cumulative)
 
-# filename: dblib_[un]scaled_<lepton>_<material>_mA_<mA>.feather
-def load_dblib(dblib_path, scaled, material, mA, lepton="electron"):
-    filename = dblib_path + "/dblib_{sc}_{lep}_{mat}_mA_{m}.feather".format(
-        sc = "scaled" if scaled else "unscaled",
-        lep = lepton,
-        mat = material,
-        m = mA
-    )
-    return pd.read_feather(filename)
+# the compiled library is a partitioned parquet dataset (see dblib_dataset);
+# incident_energies / scaled_from_Es / columns restrict what is read from disk
+# derived / derived_path add derived kinematics and cache them on disk (see
+# dblib_derived)
+def load_dblib(dblib_path, scaled, material, mA, lepton="electron",
+               incident_energies=None, scaled_from_Es=None, columns=None,
+               derived=None, derived_path=None):
+    return dblib_dataset.load_dblib_slice(dblib_path, scaled, material, mA,
+                                          incident_energies, scaled_from_Es,
+                                          columns, lepton, derived, derived_path)
 
-# var_specs is a list of tuples:
-#    (variable name, kwargs dict which must match the keywords above
-# energy_pairs is also a list of tuples:
-#   (base energy, [list of comparison energies])
-# return dictionary organized like so:
-# material -> mass -> variable name -> base energy -> 
+# columns the histograms are grouped by
+hist_columns = ["incident_energy", "scaled_from_E"]
+
+# split the histogrammed variables into stored columns and derived ones, which
+# are computed (or read from the cache) only for the variables asked for
+def hist_load_columns(var_specs):
+    names = [var_spec[0] for var_spec in var_specs]
+    derived = [name for name in names if name in dblib_derived.derived_columns]
+    columns = hist_columns + [name for name in names
+                                  if name not in derived and name not in hist_columns]
+    return columns, derived
+
+# np.histogram fills its weighted histograms in blocks of this many entries;
+# fill_grouped_hists uses the same blocks, so that its sums are done in the
+# same order and agree with np.histogram bit for bit
+np_histogram_block = 65536
+
+# sort the rows once by the key columns (stably, so rows keep their original
+# order within each group) and return (order, {key : (start, stop)}), where
+# key is a float for one key column and a tuple of floats otherwise; the rows
+# of a group are then a contiguous slice of np.asarray(df[col])[order]
+def group_dblib(df, keyColumns):
+    keys = [np.asarray(df[column], dtype=np.float64) for column in keyColumns]
+    order = np.lexsort(keys[::-1])
+    sortedKeys = [key[order] for key in keys]
+    newGroup = np.zeros(len(order), dtype=bool)
+    newGroup[:1] = True
+    for key in sortedKeys:
+        newGroup[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(newGroup)
+    stops = np.append(starts[1:], len(order))
+    groups = {}
+    for start, stop in zip(starts, stops):
+        groupKey = tuple(float(key[start]) for key in sortedKeys)
+        groups[groupKey if len(keyColumns) > 1 else groupKey[0]] = (start, stop)
+    return order, groups
+
+# fill the normalized histograms of many slices of values in one pass
+# requests is a list of (start, stop, edges) and the result is, for each,
+#   np.histogram(seq, bins=edges, weights=np.full(len(seq), 1./len(seq)))[0]
+# with seq = values[start:stop], bit for bit: np.histogram sorts each block,
+# sums the weights cumulatively and reads the sums off at the bin edges; the
+# weights of a sequence are all equal, so the same sums follow from the number
+# of entries below each edge in each block, which is counted for all
+# sequences and blocks at once
+def fill_grouped_hists(values, requests):
+    hists = [None] * len(requests)
+    # requests sharing bin edges are counted together
+    byEdges = {}
+    for i, request in enumerate(requests):
+        byEdges.setdefault(id(request[2]), []).append(i)
+    for indices in byEdges.values():
+        edges = np.asarray(requests[indices[0]][2])
+        nEdges = len(edges)
+        starts = np.array([requests[i][0] for i in indices], dtype=np.intp)
+        lengths = np.array([requests[i][1] - requests[i][0] for i in indices], dtype=np.intp)
+        if np.any(lengths == 0):
+            raise ValueError("cannot make a normalized histogram of an empty sequence")
+        weights = 1. / lengths
+
+        # position of every entry within its sequence, and its block number
+        # counting over all sequences
+        seqOffsets = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) - np.repeat(seqOffsets, lengths)
+        x = values[np.repeat(starts, lengths) + positions]
+        nBlocks = (lengths + np_histogram_block - 1) // np_histogram_block
+        blockOffsets = np.cumsum(nBlocks) - nBlocks
+        blocks = np.repeat(blockOffsets, lengths) + positions // np_histogram_block
+
+        # below[b, j] = entries of block b below edge j (at or below the last)
+        rightOf = np.searchsorted(edges, x, side='right')
+        below = np.bincount(blocks * (nEdges + 1) + rightOf,
+                            minlength=nBlocks.sum() * (nEdges + 1)
+                           ).reshape(-1, nEdges + 1).cumsum(axis=1)[:, :nEdges]
+        below[:, -1] += np.bincount(blocks[x == edges[-1]], minlength=nBlocks.sum())
+
+        # cumulative sums of the (equal) weights within one block
+        blockLengths = np.minimum(lengths, np_histogram_block)
+        cumWeights = np.concatenate([
+            np.concatenate(([0.], np.full(n, w).cumsum())) for n, w in zip(blockLengths, weights)
+        ])
+        cumOffsets = np.cumsum(blockLengths + 1) - (blockLengths + 1)
+        blockSums = cumWeights[np.repeat(cumOffsets, nBlocks)[:, None] + below]
+
+        # add up the blocks of each sequence in order
+        cumHists = np.zeros((len(indices), nEdges))
+        for block in range(nBlocks.max(initial=0)):
+            hasBlock = np.flatnonzero(nBlocks > block)
+            cumHists[hasBlock] += blockSums[blockOffsets[hasBlock] + block]
+        for i, cumHist in zip(indices, cumHists):
+            hists[i] = np.diff(cumHist)
+    return hists
+
+# the make_comparison_*_hists results for every var_spec and energy pair of one
+# (material, mass), grouping each frame once and filling all of a variable's
+# histograms in one pass
+# as with make_comparison_*_hists, the bins found for the first energy pair
+# are stored in the var_spec and used from then on
+# returns variable name -> base energy ->
 #    (baseEHist, bins, compEs, compEHists_unscaled, compEHists_scaled)
-def make_scaling_hists_dict(dblib_path, materials, masses, 
-                            var_specs, energy_pairs):
+def make_scaling_hists_for_cell(unscaled, scaled, var_specs, energy_pairs,
+                                label=()):
+    unscaledOrder, unscaledGroups = group_dblib(unscaled, ['incident_energy'])
+    scaledOrder, scaledGroups = group_dblib(scaled, ['incident_energy', 'scaled_from_E'])
+    empty = (0, 0)
+
     retval = {}
-    for material in materials:
-        retval[material] = {}
-        for mass in masses:
-            retval[material][mass] = {}
+    for var_spec in var_specs:
+        varName = var_spec[0]
+        kwargs = var_spec[1]
+        logX = kwargs.get('logX', False)
+
+        unscaledValues = np.asarray(unscaled[varName])[unscaledOrder]
+        scaledValues = np.asarray(scaled[varName])[scaledOrder]
 
-            unscaled = load_dblib(dblib_path, False, material, mass)
-            scaled = load_dblib(dblib_path, True, material, mass)
+        requests = [] # (energy pair index, edges, unscaled slices, scaled slices)
+        for energy_pair in energy_pairs:
+            baseE = energy_pair[0]
+            compEs = energy_pair[1]
+            baseSlice = unscaledGroups.get(baseE, empty)
+            compSlices = [unscaledGroups.get(compE, empty) for compE in compEs]
 
-            setup_derived_columns(unscaled)
-            setup_derived_columns(scaled)
+            bins = kwargs.get('bins')
+            if bins is None:
+                edges = make_comparison_bins(
+                    unscaledValues[slice(*baseSlice)],
+                    [unscaledValues[slice(*compSlice)] for compSlice in compSlices],
+                    kwargs.get('minX'), kwargs.get('maxX'), logX)
+                bins = np.exp(edges) if logX else edges
+            else:
+                edges = np.log(bins) if logX else bins
+            print(*label, varName, baseE, len(bins))
+            kwargs['bins'] = bins
+            requests.append((baseE, compEs, bins, edges, [baseSlice] + compSlices,
+                             [scaledGroups.get((baseE, compE), empty) for compE in compEs]))
 
+        if logX:
+            unscaledValues = np.log(unscaledValues)
+            scaledValues = np.log(scaledValues)
+        unscaledHists = iter(fill_grouped_hists(unscaledValues, [
+            (start, stop, request[3]) for request in requests for start, stop in request[4]
+        ]))
+        scaledHists = iter(fill_grouped_hists(scaledValues, [
+            (start, stop, request[3]) for request in requests for start, stop in request[5]
+        ]))
+
+        retval[varName] = {}
+        for baseE, compEs, bins, edges, unscaledSlices, scaledSlices in requests:
+            hists = [next(unscaledHists) for _ in unscaledSlices]
+            compEHists_scaled = [next(scaledHists) for _ in scaledSlices]
+            if kwargs.get('cumulative', False):
+                hists = [np.cumsum(hist) for hist in hists]
+                compEHists_scaled = [np.cumsum(hist) for hist in compEHists_scaled]
+            retval[varName][baseE] = (
+                hists[0], bins, compEs, hists[1:], compEHists_scaled
+            )
+    return retval
+
+### a normalized histogram filled batch by batch, for sequences that are too
+### large to hold in memory; the result is, bit for bit,
+###   np.histogram(seq, bins=edges, weights=np.full(n, 1./n))[0]
+### with seq the concatenation of the batches, done the same way as
+### fill_grouped_hists: the entries below each edge are counted for each
+### np_histogram_block entries of the sequence, and the cumulative weights
+### at those counts are added up block by block
+### n, the length of the whole sequence, has to be known before filling
+def new_hist_stream(edges, n):
+    if n == 0:
+        raise ValueError("cannot make a normalized histogram of an empty sequence")
+    return {
+        'edges' : np.asarray(edges),
+        'n' : n,
+        'seen' : 0,
+        'blockStart' : 0,
+        'below' : np.zeros(len(edges), dtype=np.intp),
+        'cumHist' : np.zeros(len(edges))
+    }
+
+def fill_hist_stream(stream, x):
+    edges = stream['edges']
+    nEdges = len(edges)
+    pos = 0
+    while pos < len(x):
+        # don't let a batch run over the end of a block
+        take = min(len(x) - pos, stream['blockStart'] + np_histogram_block - stream['seen'])
+        chunk = x[pos:pos + take]
+        below = np.bincount(np.searchsorted(edges, chunk, side='right'),
+                            minlength=nEdges + 1).cumsum()[:nEdges]
+        below[-1] += np.count_nonzero(chunk == edges[-1])
+        stream['below'] += below
+        stream['seen'] += take
+        pos += take
+        if stream['seen'] - stream['blockStart'] == np_histogram_block or stream['seen'] == stream['n']:
+            blockLength = stream['seen'] - stream['blockStart']
+            cumWeights = np.concatenate(([0.], np.full(blockLength, 1. / stream['n']).cumsum()))
+            stream['cumHist'] += cumWeights[stream['below']]
+            stream['below'][:] = 0
+            stream['blockStart'] = stream['seen']
+
+def finish_hist_stream(stream):
+    if stream['seen'] != stream['n']:
+        raise ValueError("histogram filled with {} of {} entries".format(stream['seen'], stream['n']))
+    return np.diff(stream['cumHist'])
+
+# fill_grouped_hists and fill_hist_stream only agree with np.histogram bit for
+# bit as long as np.histogram sums in blocks of np_histogram_block entries,
+# which is internal to numpy: compare them on sequences longer than a block,
+# with NaNs, entries on the bin edges and log bins, and fail loudly if a numpy
+# version changes the results
+def check_against_np_histogram(seed=1):
+    rng = np.random.default_rng(seed)
+    lengths = [1, 1000, np_histogram_block, np_histogram_block + 1, 2 * np_histogram_block + 12345]
+    values = rng.exponential(2., sum(lengths))
+    values[rng.integers(0, len(values), 1000)] = np.nan
+    for logX in [False, True]:
+        finite = values[np.isfinite(values)]
+        edges = make_comparison_bins(finite, [], minX=finite.min(), maxX=finite.max(), logX=logX)
+        x = np.log(values) if logX else values.copy()
+        x[rng.integers(0, len(x), 2000)] = rng.choice(edges, 2000)
+        x[-3:] = [edges[0], edges[-1], np.nan]
+        starts = np.cumsum(lengths) - lengths
+        grouped = fill_grouped_hists(x, [(start, start + n, edges) for start, n in zip(starts, lengths)])
+        for start, n, hist in zip(starts, lengths, grouped):
+            seq = x[start:start + n]
+            expected = np.histogram(seq, bins=edges, weights=np.full(n, 1. / n))[0]
+            stream = new_hist_stream(edges, n)
+            for batch in range(0, n, 40000):
+                fill_hist_stream(stream, seq[batch:batch + 40000])
+            for name, result in [("fill_grouped_hists", hist), ("fill_hist_stream", finish_hist_stream(stream))]:
+                if not np.array_equal(result, expected):
+                    raise RuntimeError("{name} differs from np.histogram (numpy {version}, {n} entries{log}): "
+                                       "check np_histogram_block against np.histogram".format(
+                        name=name, version=np.__version__, n=n, log=", log bins" if logX else ""))
+
+# the library of one (material, mass) in record batches (see
+# dblib_dataset.iter_dblib_batches), restricted to the energies compared
+def iter_cell_batches(dblib_path, scaled, material, mass, energy_pairs,
+                      columns, derived, batch_size):
+    allBaseEs = [energy_pair[0] for energy_pair in energy_pairs]
+    allCompEs = sorted(set(compE for energy_pair in energy_pairs
+                               for compE in energy_pair[1]))
+    if scaled:
+        return dblib_dataset.iter_dblib_batches(
+            dblib_path, True, material, mass, incident_energies=allBaseEs,
+            scaled_from_Es=allCompEs, columns=columns, derived=derived,
+            batch_size=batch_size)
+    return dblib_dataset.iter_dblib_batches(
+        dblib_path, False, material, mass, incident_energies=allBaseEs + allCompEs,
+        columns=columns, derived=derived, batch_size=batch_size)
+
+# make_scaling_hists_for_cell for a (material, mass) that does not fit in
+# memory: the library is read in batches of batch_size rows, up to three times
+#   1. only the energy columns, to count the entries of each histogram
+#   2. if any bins are not given, the variables that need them: their range
+#      is kept for the comparison energies and their values at the base energy
+#      (one variable at one energy is much smaller than the cell), and the bins
+#      are found from those as make_comparison_bins does
+#   3. all the variables, filling every histogram batch by batch
+# the histograms (and bins) are the same as make_scaling_hists_for_cell's bit
+# for bit, including the weights, cumulative and logX options
+def make_scaling_hists_streaming(dblib_path, material, mass, var_specs,
+                                 energy_pairs, batch_size, label=()):
+    columns, derived = hist_load_columns(var_specs)
+    keyColumns = {False : ['incident_energy'], True : ['incident_energy', 'scaled_from_E']}
+
+    counts = {False : {}, True : {}}
+    for scaled in [False, True]:
+        for batch in iter_cell_batches(dblib_path, scaled, material, mass, energy_pairs,
+                                       hist_columns, [], batch_size):
+            for key, (start, stop) in group_dblib(batch, keyColumns[scaled])[1].items():
+                counts[scaled][key] = counts[scaled].get(key, 0) + stop - start
+
+    # as in make_scaling_hists_for_cell, missing bins are only ever found for
+    # the first energy pair and then stored in the var_spec
+    firstEdges = {}
+    binVarNames = [var_spec[0] for var_spec in var_specs if var_spec[1].get('bins') is None]
+    if len(binVarNames) > 0 and len(energy_pairs) > 0:
+        baseE = energy_pairs[0][0]
+        compEs = energy_pairs[0][1]
+        baseValues = {varName : [] for varName in binVarNames}
+        compRanges = {varName : {compE : [] for compE in compEs} for varName in binVarNames}
+        binColumns, binDerived = hist_load_columns([(varName, {}) for varName in binVarNames])
+        for batch in iter_cell_batches(dblib_path, False, material, mass, energy_pairs,
+                                       binColumns, binDerived, batch_size):
+            order, groups = group_dblib(batch, keyColumns[False])
+            for varName in binVarNames:
+                values = np.asarray(batch[varName])[order]
+                if baseE in groups:
+                    baseValues[varName].append(values[slice(*groups[baseE])])
+                for compE in compEs:
+                    if compE in groups:
+                        seq = values[slice(*groups[compE])]
+                        # fmin/fmax skip NaNs like nanmin/nanmax, without
+                        # warning on a batch that is all NaN
+                        compRanges[varName][compE] += [np.fmin.reduce(seq), np.fmax.reduce(seq)]
+        for var_spec in var_specs:
+            varName = var_spec[0]
+            kwargs = var_spec[1]
+            if varName not in baseValues:
+                continue
+            logX = kwargs.get('logX', False)
+            values = baseValues.pop(varName)
+            edges = make_comparison_bins(
+                np.concatenate(values) if len(values) > 0 else np.zeros(0),
+                [np.array(compRanges[varName][compE]) for compE in compEs],
+                kwargs.get('minX'), kwargs.get('maxX'), logX)
+            firstEdges[varName] = edges
+            kwargs['bins'] = np.exp(edges) if logX else edges
+
+    # streams[scaled][key][varName][id(edges)] is the histogram of a variable
+    # for one energy (or pair of energies); histograms with the same bins of
+    # the same energy are only filled once
+    streams = {False : {}, True : {}}
+    def get_stream(scaled, key, varName, edges):
+        byEdges = streams[scaled].setdefault(key, {}).setdefault(varName, {})
+        if id(edges) not in byEdges:
+            byEdges[id(edges)] = new_hist_stream(edges, counts[scaled].get(key, 0))
+        return byEdges[id(edges)]
+
+    requests = {} # variable name -> [(baseE, compEs, bins, unscaled streams, scaled streams)]
+    for var_spec in var_specs:
+        varName = var_spec[0]
+        kwargs = var_spec[1]
+        logX = kwargs.get('logX', False)
+        requests[varName] = []
+        for i, energy_pair in enumerate(energy_pairs):
+            baseE = energy_pair[0]
+            compEs = energy_pair[1]
+            bins = kwargs['bins']
+            if i == 0 and varName in firstEdges:
+                edges = firstEdges[varName]
+            else:
+                edges = np.log(bins) if logX else bins
+            print(*label, varName, baseE, len(bins))
+            requests[varName].append((baseE, compEs, bins,
+                [get_stream(False, E, varName, edges) for E in [baseE] + compEs],
+                [get_stream(True, (baseE, compE), varName, edges) for compE in compEs]))
+
+    for scaled in [False, True]:
+        if len(streams[scaled]) == 0:
+            continue
+        for batch in iter_cell_batches(dblib_path, scaled, material, mass, energy_pairs,
+                                       columns, derived, batch_size):
+            order, groups = group_dblib(batch, keyColumns[scaled])
             for var_spec in var_specs:
                 varName = var_spec[0]
+                values = np.asarray(batch[varName])[order]
+                if var_spec[1].get('logX', False):
+                    values = np.log(values)
+                for key, (start, stop) in groups.items():
+                    for stream in streams[scaled].get(key, {}).get(varName, {}).values():
+                        fill_hist_stream(stream, values[start:stop])
 
-                retval[material][mass][varName] = {}
+    retval = {}
+    for var_spec in var_specs:
+        varName = var_spec[0]
+        cumulative = var_spec[1].get('cumulative', False)
+        retval[varName] = {}
+        for baseE, compEs, bins, unscaledStreams, scaledStreams in requests[varName]:
+            hists = [finish_hist_stream(stream) for stream in unscaledStreams]
+            compEHists_scaled = [finish_hist_stream(stream) for stream in scaledStreams]
+            if cumulative:
+                hists = [np.cumsum(hist) for hist in hists]
+                compEHists_scaled = [np.cumsum(hist) for hist in compEHists_scaled]
+            retval[varName][baseE] = (
+                hists[0], bins, compEs, hists[1:], compEHists_scaled
+            )
+    return retval
+
+# all the histograms for one (material, mass), see make_scaling_hists_dict
+# returns (variable name -> base energy -> histograms, stats) where stats are
+# the wall time, cpu time and peak RSS of the process that made them
+# with a batch_size, the library is streamed rather than loaded into memory
+# (see make_scaling_hists_streaming)
+# with pipeline_stats enabled, the cell and its load and histogram stages are
+# recorded
+def make_scaling_hists_for_params(dblib_path, material, mass,
+                                  var_specs, energy_pairs, derived_path=None,
+                                  batch_size=None):
+    start = pipeline_stats.start_usage()
+    with pipeline_stats.stage("cell", material=material, mass=float(mass),
+                              streaming=batch_size is not None) as cellStats:
+        if batch_size is not None:
+            hists = make_scaling_hists_streaming(
+                dblib_path, material, mass, var_specs, energy_pairs, batch_size,
+                (material, mass)
+            )
+            return hists, pipeline_stats.usage_since(start)
+
+        # only read the energies that are compared
+        allBaseEs = [energy_pair[0] for energy_pair in energy_pairs]
+        allCompEs = sorted(set(compE for energy_pair in energy_pairs
+                                   for compE in energy_pair[1]))
+        columns, derived = hist_load_columns(var_specs)
+        with pipeline_stats.stage("load", material=material, mass=float(mass)) as stats:
+            unscaled = load_dblib(dblib_path, False, material, mass,
+                                  incident_energies=allBaseEs + allCompEs,
+                                  columns=columns, derived=derived,
+                                  derived_path=derived_path)
+            scaled = load_dblib(dblib_path, True, material, mass,
+                                incident_energies=allBaseEs,
+                                scaled_from_Es=allCompEs,
+                                columns=columns, derived=derived,
+                                derived_path=derived_path)
+            stats["rows"] = cellStats["rows"] = len(unscaled) + len(scaled)
 
-                for energy_pair in energy_pairs:
-                    baseE = energy_pair[0]
-                    compEs = energy_pair[1]
+        with pipeline_stats.stage("histogram", rows=len(unscaled) + len(scaled),
+                                  material=material, mass=float(mass)):
+            hists = make_scaling_hists_for_cell(
+                unscaled, scaled, var_specs, energy_pairs, (material, mass)
+            )
+    return hists, pipeline_stats.usage_since(start)
 
-                    baseEHist, bins, compEHists_unscaled = make_comparison_unscaled_hists(
-                        unscaled, varName, baseE, compEs, **var_spec[1]
-                    )
-                    print(material, mass, varName, baseE, len(bins))
+# var_specs is a list of tuples:
+#    (variable name, kwargs dict which must match the keywords above
+# energy_pairs is also a list of tuples:
+#   (base energy, [list of comparison energies])
+# return dictionary organized like so:
+# material -> mass -> variable name -> base energy -> 
+#    (baseEHist, bins, compEs, compEHists_unscaled, compEHists_scaled)
+# with n_workers > 1, each (material, mass) is done in its own worker process
+# (a fresh one per cell, so each only ever holds one cell's frames in memory)
+# and only the histograms are sent back
+# derived_path is where the derived kinematics are cached (None: no cache)
+# batch_size streams each cell in batches of that many rows (None: each cell
+# is loaded into memory at once, which is faster but needs the memory)
+def make_scaling_hists_dict(dblib_path, materials, masses, 
+                            var_specs, energy_pairs, n_workers=1,
+                            derived_path=None, batch_size=None):
+    check_against_np_histogram()
+    startWall = time.perf_counter()
+    retval = {material : {mass : None for mass in masses} for material in materials}
+    cells = [(material, mass) for material in materials for mass in masses]
+    cellWall = 0.
 
-                    var_spec[1]['bins'] = bins
-                    compEHists_scaled = make_comparison_scaled_hists(
-                        unscaled, scaled, varName, baseE, compEs, **var_spec[1]
-                    )[2]
+    def record(material, mass, result):
+        hists, stats = result
+        retval[material][mass] = hists
+        print("{material} {mass}: {wall:.1f} s wall, {cpu:.1f} s cpu, peak RSS {rss:.0f} MB".format(
+            material = material, mass = mass, wall = stats['wall_s'],
+            cpu = stats['cpu_s'], rss = stats['max_rss_mb']))
+        return stats['wall_s']
 
-                    retval[material][mass][varName][baseE] = (
-                        baseEHist, bins, compEs, compEHists_unscaled, compEHists_scaled
-                    )
-                # for energy_pair in energy_pairs
-            # for var_spec in var_specs
+    if n_workers <= 1:
+        for material, mass in cells:
+            cellWall += record(material, mass, make_scaling_hists_for_params(
+                dblib_path, material, mass, var_specs, energy_pairs, derived_path,
+                batch_size))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, max_tasks_per_child=1) as executor:
+            # bins that are not given are found from the first cell and then
+            # used for all the others (as in the serial loop), so that cell
+            # has to finish before the rest can start
+            if len(cells) > 0 and any(var_spec[1].get('bins') is None for var_spec in var_specs):
+                material, mass = cells.pop(0)
+                cellWall += record(material, mass, executor.submit(
+                    make_scaling_hists_for_params,
+                    dblib_path, material, mass, var_specs, energy_pairs,
+                    derived_path, batch_size).result())
+                for var_spec in var_specs:
+                    var_spec[1]['bins'] = retval[material][mass][var_spec[0]][energy_pairs[-1][0]][1]
+            futures = {
+                executor.submit(make_scaling_hists_for_params,
+                                dblib_path, material, mass, var_specs, energy_pairs,
+                                derived_path, batch_size) : (material, mass)
+                    for material, mass in cells
+            }
+            for future in as_completed(futures):
+                cellWall += record(*futures[future], future.result())
 
-            del unscaled
-            del scaled
-        # for mass in masses
-    # for material in materials
+    wall = time.perf_counter() - startWall
+    print("{n} cells in {wall:.1f} s with {n_workers} workers: {speedup:.2f}x speedup over one worker ({eff:.0%} efficiency)".format(
+        n = len(materials) * len(masses), wall = wall, n_workers = n_workers,
+        speedup = cellWall / wall, eff = cellWall / wall / n_workers))
     return retval
 
+# adds every derived column to df (see dblib_derived)
 def setup_derived_columns(df):
-    df["ap_energy"] = df["centerMomentum_energy"] - df["recoil_energy"]
-    df["ap_px"] = df["centerMomentum_px"] - df["recoil_px"]
-    df["ap_py"] = df["centerMomentum_py"] - df["recoil_py"]
-    df["ap_pz"] = df["centerMomentum_pz"] - df["recoil_pz"]
-
-    df["recoil_pt"] = np.sqrt(df["recoil_px"]**2 + df["recoil_py"]**2)
-    df["ap_pt"] = np.sqrt(df["ap_px"]**2 + df["ap_py"]**2)
-    df["recoil_phi"] = np.arctan2(df["recoil_py"], df["recoil_px"])
-    df["ap_phi"] = np.arctan2(df["ap_py"], df["ap_px"])
-    df["recoil_theta"] = np.arctan2(df["recoil_pt"], df["recoil_pz"])
-    df["ap_theta"] = np.arctan2(df["ap_pt"], df["ap_pz"])
-
-    df["recoil_energy_frac"] = df["recoil_energy"] / df["incident_energy"]
-    df["ap_energy_frac"] = df["ap_energy"] / df["incident_energy"]
-    df["delta_phi"] = np.abs(df["recoil_phi"] - df["ap_phi"])
-                     #np.minimum(np.abs(df["recoil_phi"] - df["ap_phi"]), 
-                     #2*math.pi - np.abs(df["recoil_phi"] - df["ap_phi"]))
-
-    df["angle_recoil_ap"] = np.arccos(
-        (df["ap_px"] * df["recoil_px"] + 
-         df["ap_py"] * df["recoil_py"] + 
-         df["ap_pz"] * df["recoil_pz"]) 
-        /
-        (np.sqrt((df["ap_pt"]**2 + df["ap_pz"]**2) *
-                 (df["recoil_pt"]**2 + df["recoil_pz"]**2))
-        ))
+    with pipeline_stats.stage("derive", rows=len(df)):
+        dblib_derived.derive(df, list(dblib_derived.derived_columns))
 
 materials = ["copper", "lead", "oxygen", "silicon", "tungsten"]
 masses = [0.005, 0.01, 0.05, 0.1]
@@ -186,14 +602,36 @@ energy_pairs = [
     #(7.0, [7.5, 8.0])
 ]
 
-theDict = make_scaling_hists_dict(
-    "/home/ram2aq/ldmx/data",
-    materials,
-    masses,
-    var_specs,
-    energy_pairs
-)
-
-outfile = "/home/ram2aq/ldmx/data/scaling_hists.pkl"
-with open(outfile, 'wb') as fp:
-    pickle.dump(theDict, fp)
\ No newline at end of file
+# number of (material, mass) cells histogrammed in parallel
+n_workers = 4
+# cache of the derived kinematics, reused as long as the library is unchanged
+derived_path = "/home/ram2aq/ldmx/data/dblib_derived"
+# rows per record batch when streaming cells that do not fit in memory
+# (None loads each cell whole)
+batch_size = None
+# add the histograms of this run to the existing store (e.g. new energies or
+# variables) rather than starting it over
+append_to_store = False
+outfile = "/home/ram2aq/ldmx/data/scaling_hists.hstore"
+# record the time and memory of every stage and cell next to the store (see
+# pipeline_stats)
+record_stats = False
+
+if __name__ == "__main__":
+    if record_stats:
+        pipeline_stats.enable(outfile + ".stats.jsonl")
+    with pipeline_stats.stage("make_scaling_hists_dict", n_workers=n_workers,
+                              streaming=batch_size is not None):
+        theDict = make_scaling_hists_dict(
+            "/home/ram2aq/ldmx/data/dblib_dataset",
+            materials,
+            masses,
+            var_specs,
+            energy_pairs,
+            n_workers,
+            derived_path,
+            batch_size
+        )
+
+    with pipeline_stats.stage("write_store"):
+        hist_store.write_hist_store(outfile, theDict, append_to_store)
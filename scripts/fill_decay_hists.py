@@ -0,0 +1,102 @@
+import glob
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import hist
+import uproot
+
+import ap_decay_analysis
+
+# the decay validation histograms, one per A' quantity (see ap_decay_analysis),
+# with the binning used in decay_validation.ipynb
+def make_decay_hists():
+    return {
+        "decay_distance" : hist.Hist.new.Reg(50, 0, 6000, name="dist", label="distance traveled [mm]").Int64(),
+        "parent_end_energy" : hist.Hist.new.Reg(50, 0, 8000, name="incident_e", label="incident energy [MeV]").Int64(),
+        "n_daughters" : hist.Hist.new.Reg(10, 0, 10, name="ndaughters", label="number of daughters").Int64(),
+        "daughter_invariant_mass" : hist.Hist.new.Reg(50, 0, 110, name="daughter_invariant_mass", label="invariant mass of daughters [MeV]").Int64(),
+        "start_z" : hist.Hist.new.Reg(50, 0, 6010, name="startZ", label="A' track start Z [mm]").Int64(),
+        "end_z" : hist.Hist.new.Reg(50, 0, 6010, name="endZ", label="A' track end Z [mm]").Int64(),
+        "px_imbalance" : hist.Hist.new.Reg(100, -1000, 1000, name="pxdiff", label="p_x imbalance [MeV]").Int64(),
+        "py_imbalance" : hist.Hist.new.Reg(100, -1000, 1000, name="pydiff", label="p_y imbalance [MeV]").Int64(),
+        "pz_imbalance" : hist.Hist.new.Reg(100, -1000, 1000, name="pzdiff", label="p_z imbalance [MeV]").Int64()
+    }
+
+# (fname, entry_start, entry_stop) for every chunk of at most chunk_size
+# events of the files
+def find_chunks(fnames, chunk_size):
+    chunks = []
+    for fname in fnames:
+        with uproot.open(fname) as f:
+            n_entries = f[ap_decay_analysis.events_tree].num_entries
+        chunks += [(fname, start, min(start + chunk_size, n_entries))
+                       for start in range(0, n_entries, chunk_size)]
+    return chunks
+
+# fill empty copies of hists (quantity -> hist.Hist) from one chunk, reading
+# only the branches those quantities need
+# returns (hists, number of events, seconds)
+def fill_chunk(fname, entry_start, entry_stop, hists):
+    start = time.perf_counter()
+    ap = ap_decay_analysis.analyze_file(fname, list(hists), entry_start, entry_stop)
+    partial = {name : h.copy().reset() for name, h in hists.items()}
+    for name, h in partial.items():
+        ap_decay_analysis.fill_hist(h, ap[name])
+    return partial, entry_stop - entry_start, time.perf_counter() - start
+
+# fill hists (quantity -> empty hist.Hist) from all the signal files matching
+# pattern, in chunks of chunk_size events; with n_workers > 1 the chunks are
+# filled in worker processes and the partial histograms are added up here
+# the events/s of each file and of the whole run are printed
+def fill_decay_hists(pattern, hists, chunk_size=10000, n_workers=1):
+    startWall = time.perf_counter()
+    fnames = sorted(glob.glob(pattern))
+    chunks = find_chunks(fnames, chunk_size)
+    print("{n_chunks} chunks of up to {chunk_size} events in {n_files} files".format(
+        n_chunks = len(chunks), chunk_size = chunk_size, n_files = len(fnames)))
+
+    merged = {name : h.copy() for name, h in hists.items()}
+    # fname -> [events, seconds]
+    fileStats = {fname : [0, 0.] for fname in fnames}
+    def record(fname, result):
+        partial, n_events, seconds = result
+        for name, h in partial.items():
+            merged[name] += h
+        fileStats[fname][0] += n_events
+        fileStats[fname][1] += seconds
+
+    if n_workers <= 1:
+        for chunk in chunks:
+            record(chunk[0], fill_chunk(*chunk, hists))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(fill_chunk, *chunk, hists) : chunk[0]
+                           for chunk in chunks}
+            for future in as_completed(futures):
+                record(futures[future], future.result())
+
+    for fname, (n_events, seconds) in fileStats.items():
+        print("{name}: {n} events in {t:.1f} s ({rate:.0f} events/s)".format(
+            name = os.path.basename(fname), n = n_events, t = seconds,
+            rate = n_events / seconds if seconds > 0 else 0.))
+    wall = time.perf_counter() - startWall
+    n_events = sum(stats[0] for stats in fileStats.values())
+    print("{n} events in {wall:.1f} s with {n_workers} workers ({rate:.0f} events/s)".format(
+        n = n_events, wall = wall, n_workers = n_workers,
+        rate = n_events / wall if wall > 0 else 0.))
+    return merged
+
+signal_files = "/home/ram2aq/ldmx/data/eat_vis_signal/category_signal_*_run_*.root"
+# events read at a time by a worker
+chunk_size = 10000
+# number of chunks filled in parallel
+n_workers = 4
+
+if __name__ == "__main__":
+    hists = fill_decay_hists(signal_files, make_decay_hists(), chunk_size, n_workers)
+
+    outfile = "/home/ram2aq/ldmx/data/decay_hists.pkl"
+    with open(outfile, 'wb') as fp:
+        pickle.dump(hists, fp)
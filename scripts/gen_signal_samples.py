@@ -1,35 +1,68 @@
 import math
 import os
+import re
+
+import dblib_catalog
+import executors
+import slurm_bundle
+import slurm_estimates
 
 # this needs to be a relative path from the base of the ldmx-sim-visdecay repo
 run_script = "scripts/setup_ldmx_and_fire.sh"
+# stem of the output file that ldmx fire writes for this library
+def output_fstem_for(path_to_mg_db_lib, n_events):
+    # Get A' mass and run number from the dark brem library name (the same
+    # way test_config.py does)
+    lib_parameters = dblib_catalog.run_params_from_filename(path_to_mg_db_lib)
+    ap_mass = lib_parameters["mA"]*1000.
+    run_num = lib_parameters["run_number"]
+    return "category_signal_Nevents_{n_events}_MaxTries_10k_mAMeV_{ap_mass:04d}_epsilon_0.01_minApE_4000_minPrimEatEcal_7000_run_{run_num}".format(
+        n_events = n_events,
+        ap_mass = int(ap_mass),
+        run_num = run_num
+    )
+
+def hours_for(n_events):
+    return math.ceil(n_events / 1000) # guessing 1000 events/hour
+
+# (material, mass, energy, events) of a finished sample from its log stem, for
+# slurm_estimates.collect_measurements; the events are counted in the output
+# if uproot is available and taken from the file name otherwise
+def point_for(stem):
+    match = re.fullmatch(r"category_signal_Nevents_([0-9]+)_.*_mAMeV_([0-9]+)_.*_run_[0-9]+", stem)
+    if match is None:
+        return None
+    root_fname = "{output_dir}/{stem}.root".format(output_dir=output_dir, stem=stem)
+    if not os.path.isfile(root_fname):
+        return None
+    if slurm_estimates.uproot is not None:
+        n_events = slurm_estimates.count_root_events(root_fname)
+    else:
+        n_events = int(match.group(1))
+    return "all", int(match.group(2)) / 1000., None, n_events
+
+# (hours, mem in MB) from the measured throughput of earlier samples of this
+# config, or the guesses above until some have been measured
+def resources_for(mass, n_events):
+    return slurm_estimates.estimate_resources(
+        measurements, config_path, "all", mass, None, n_events,
+        hours_for(n_events), 4000, safety_margin)
+
 # path_to_ldmx_sim_visdecay is an _absolute_ path
 def write_slurm_to_fh(fh, path_to_ldmx_sim_visdecay, 
                       path_to_config_script, path_to_mg_db_lib, n_events,
-                      output_path):
+                      output_path, mass):
+    hours, mem = resources_for(mass, n_events)
     fh.write("#!/bin/bash\n")
     fh.write("\n")
     fh.write("#SBATCH --ntasks=1\n")
-    fh.write("#SBATCH --mem=4000\n")
+    fh.write("#SBATCH --mem={mem}\n".format(mem=mem))
     fh.write("#SBATCH --partition=standard\n")
     fh.write("#SBATCH --account=ldmxuva\n")
 
-    hours = math.ceil(n_events / 1000) # guessing 1000 events/hour
     fh.write("#SBATCH --time={hours:02d}:00:00\n".format(hours=hours))
 
-    # Get A' mass from the dark brem library name
-    lib_parameters = os.path.splitext(
-
-            os.path.basename(path_to_mg_db_lib)
- 
-        )[0].split('_')
-    ap_mass = float(lib_parameters[lib_parameters.index('mA')+1])*1000.
-    run_num = int(lib_parameters[lib_parameters.index('run')+1])
-    output_fstem = "category_signal_Nevents_{n_events}_MaxTries_10k_mAMeV_{ap_mass:04d}_epsilon_0.01_minApE_4000_minPrimEatEcal_7000_run_{run_num}".format(
-        n_events = n_events,
-        ap_mass = int(ap_mass),
-        run_num = run_num
-    )
+    output_fstem = output_fstem_for(path_to_mg_db_lib, n_events)
 
     slurm_out = "{output_path}/slurm/slurm_{output_fstem}.out".format(
         output_path = output_path, output_fstem = output_fstem
@@ -40,7 +73,7 @@ def write_slurm_to_fh(fh, path_to_ldmx_sim_visdecay,
     fh.write("#SBATCH --output={slurm_out}\n".format(slurm_out=slurm_out))
     fh.write("#SBATCH --error={slurm_err}\n".format(slurm_err=slurm_err))
     fh.write("\n")
-    fh.write("{path_to_ldmx_sim_visdecay}/{run_script} {path_to_ldmx_sim_visdecay} {path_to_config_script} {path_to_mg_db_lib} {n_events}\n".format(
+    slurm_estimates.write_timed_command(fh, "{path_to_ldmx_sim_visdecay}/{run_script} {path_to_ldmx_sim_visdecay} {path_to_config_script} {path_to_mg_db_lib} {n_events}".format(
         run_script = run_script,
         path_to_ldmx_sim_visdecay = path_to_ldmx_sim_visdecay,
         path_to_config_script = path_to_config_script,
@@ -57,17 +90,59 @@ def write_slurm_to_fh(fh, path_to_ldmx_sim_visdecay,
 def run_for_params(run_number, mass, path_to_ldmx_sim_visdecay, 
                       path_to_config_script, db_lib_dir, n_events,
                       output_path):
-    db_lib_fname = "{db_lib_dir}/all_mA_{mass}_run_{run_number}.csv".format(
-        db_lib_dir = db_lib_dir, mass = mass, run_number = run_number
-    )
+    db_lib_fname = db_lib_fname_for(db_lib_dir, mass, run_number)
     slurm_fname = "{output_path}/all_mA_{mass}_run_{run_number}.slurm".format(
         output_path = output_path, mass = mass, run_number = run_number
     )
     with open(slurm_fname, "w") as fh:
         write_slurm_to_fh(fh, path_to_ldmx_sim_visdecay, path_to_config_script,
-                          db_lib_fname, n_events, output_path)
+                          db_lib_fname, n_events, output_path, mass)
     os.system("sbatch {slurm_fname}".format(slurm_fname=slurm_fname))
 
+def db_lib_fname_for(db_lib_dir, mass, run_number):
+    return "{db_lib_dir}/all_mA_{mass}_run_{run_number}.csv".format(
+        db_lib_dir = db_lib_dir, mass = mass, run_number = run_number
+    )
+
+# the (run number, mass) points whose library is in the catalog
+def points_with_library(points, db_lib_dir):
+    found = []
+    for run_number, mass in points:
+        info = dblib_catalog.file_info(catalog, db_lib_fname_for(db_lib_dir, mass, run_number))
+        if info is None or info["n_events"] == 0:
+            print("no library for mA {mass} run {run_number}, skipping".format(
+                mass = mass, run_number = run_number))
+            continue
+        found.append((run_number, mass))
+    return found
+
+# run all the (run number, mass) points with the given backend (see
+# executors.py): as one slurm job array, running points_per_task of them in
+# each allocation, or on this machine
+def run_as_job_array(points, path_to_ldmx_sim_visdecay, path_to_config_script,
+                     db_lib_dir, n_events, output_path,
+                     points_per_task=1, concurrent=False, backend="slurm",
+                     local_options={}):
+    rows = []
+    resources = []
+    for run_number, mass in points:
+        db_lib_fname = db_lib_fname_for(db_lib_dir, mass, run_number)
+        output_fstem = output_fstem_for(db_lib_fname, n_events)
+        rows.append([output_fstem, path_to_config_script, db_lib_fname,
+                     n_events, output_fstem, output_path])
+        resources.append(resources_for(mass, n_events))
+    if backend == "slurm":
+        options = {"points_per_task" : points_per_task, "concurrent" : concurrent,
+                   "bundle_script" : "{}/{}".format(path_to_ldmx_sim_visdecay, slurm_bundle.bundle_script)}
+    else:
+        options = local_options
+    executors.run_points(backend,
+        "category_signal_Nevents_{n_events}".format(n_events = n_events),
+        rows, [hours for hours, mem in resources], [mem for hours, mem in resources],
+        output_path,
+        "{}/{}".format(path_to_ldmx_sim_visdecay, run_script), "fire_point",
+        env_args = [path_to_ldmx_sim_visdecay], options = options)
+
 # you should modify the following:
 my_ldmx_sim_visdecay_path = "/home/ram2aq/test/ldmx-sim-visdecay"
 output_dir = "/scratch/ram2aq"
@@ -75,9 +150,42 @@ output_dir = "/scratch/ram2aq"
 config_path = "scripts/test_config.py"
 # note: this one is defined as an _absolute_ path
 db_lib_dir = "/standard/ldmxuva/data/dblib"
+# where the samples run (see executors.py): "slurm", or "local" to run them
+# on this machine
+backend = "slurm"
+# cpus and memory (MB) the local backend uses at most (None for all of the
+# machine), and cpus given to each sample
+local_options = {"max_cpus" : None, "max_mem" : None, "cpus_per_point" : 1}
+# submit the samples as one slurm job array rather than one job each
+use_job_array = True
+# samples run in each task of the array, where the environment is set up once
+points_per_task = 2
+# run the samples of a task at the same time, one cpu each, rather than one
+# after another
+concurrent_points = True
+# the time and memory of finished samples (from their slurm logs) are kept
+# here and used to size the requests of new ones (see slurm_estimates.py)
+measurements_fname = output_dir + "/slurm/measurements.jsonl"
+# requested = measured * safety_margin
+safety_margin = 1.5
+# catalog of the library files (see dblib_catalog)
+catalog_fname = db_lib_dir + "/" + dblib_catalog.catalog_basename
+
+os.makedirs(output_dir + "/slurm", exist_ok=True)
+measurements = slurm_estimates.collect_measurements(
+    measurements_fname, output_dir + "/slurm", config_path, point_for)
+catalog = dblib_catalog.open_catalog(catalog_fname)
+dblib_catalog.update_catalog(catalog, [db_lib_dir], kinds=["combined"])
 
-for mass in [0.005, 0.01, 0.05, 0.1]:
-    for run_number in [4000]:
+points = points_with_library([(run_number, mass) for mass in [0.005, 0.01, 0.05, 0.1]
+                                  for run_number in [4000]], db_lib_dir)
+if use_job_array or backend != "slurm":
+    run_as_job_array(points,
+                     my_ldmx_sim_visdecay_path, config_path, db_lib_dir,
+                     10000, output_dir, points_per_task, concurrent_points,
+                     backend, local_options)
+else:
+    for run_number, mass in points:
         run_for_params(run_number, mass, my_ldmx_sim_visdecay_path,
                        config_path, db_lib_dir,
                        10000, output_dir)
@@ -1,18 +1,64 @@
 import math
 import os
+import re
+
+import dblib_catalog
+import executors
+import slurm_estimates
 
 run_script = "scripts/run_db_gen_then_extract.sh"
+def output_fstem_for(run_number, material, mass, energy):
+    return "electron_{material}_mA_{mass}_E_{energy}_unscaled_run_{run_number}".format(
+        material=material, mass=mass, energy=energy, run_number=run_number)
+
+# estimated 80,000 events/hr at slowest
+def hours_for(events):
+    return math.ceil(events / 80000)
+
+# (material, mass, energy, events) of a finished point from its log stem, for
+# slurm_estimates.collect_measurements; the events come from the catalog
+def point_for(stem):
+    match = re.fullmatch(r"electron_(.+)_mA_(.+)_E_(.+)_unscaled_run_([0-9]+)", stem)
+    if match is None:
+        return None
+    n_events = dblib_catalog.n_events_of(catalog,
+        "{output_dir}/{stem}.csv".format(output_dir=output_dir, stem=stem))
+    if n_events is None:
+        return None
+    return match.group(1), match.group(2), match.group(3), n_events
+
+# the points whose library is not in the catalog yet (the generation refuses
+# to overwrite an existing library)
+def points_to_generate(run_number, points, output_path):
+    todo = [(material, mass, energy) for material, mass, energy in points
+                if dblib_catalog.file_info(catalog, "{output_path}/{stem}.csv".format(
+                    output_path=output_path,
+                    stem=output_fstem_for(run_number, material, mass, energy))) is None]
+    if len(todo) < len(points):
+        print("{n} points already generated".format(n=len(points) - len(todo)))
+    return todo
+
+# (hours, mem in MB) from the measured throughput of earlier points, or the
+# guesses above (MG/ME uses << 1 GB of RAM) until some have been measured;
+# the memory is for topup_cpus runs at the same time
+def resources_for(material, mass, energy, events):
+    hours, mem = slurm_estimates.estimate_resources(
+        measurements, estimate_config, material, mass, energy, events,
+        hours_for(events), 1000, safety_margin)
+    return hours, mem * topup_cpus
+
 def write_slurm_to_fh(fh, run_number, material, mass, energy, events, output_path):
     fh.write("#!/bin/bash\n")
     fh.write("\n")
+    hours, mem = resources_for(material, mass, energy, events)
     fh.write("#SBATCH --ntasks=1\n")
-    fh.write("#SBATCH --mem=1000\n") # testing shows MG/ME uses << 1 GB of RAM
+    if topup_cpus > 1:
+        fh.write("#SBATCH --cpus-per-task={n}\n".format(n=topup_cpus))
+    fh.write("#SBATCH --mem={mem}\n".format(mem=mem))
     fh.write("#SBATCH --partition=standard\n")
     fh.write("#SBATCH --account=ldmxuva\n")
-    hours = math.ceil(events / 80000) # estimated 80,000 events/hr at slowest
     fh.write("#SBATCH --time={hours:02d}:00:00\n".format(hours=hours))
-    output_fstem = "electron_{material}_mA_{mass}_E_{energy}_unscaled_run_{run_number}".format(
-        material=material, mass=mass, energy=energy, run_number=run_number)
+    output_fstem = output_fstem_for(run_number, material, mass, energy)
     slurm_out="{output_path}/slurm/slurm_{output_fstem}.out".format(
         output_path=output_path, output_fstem=output_fstem)
     slurm_err="{output_path}/slurm/slurm_{output_fstem}.err".format(
@@ -20,7 +66,7 @@ def write_slurm_to_fh(fh, run_number, material, mass, energy, events, output_pat
     fh.write("#SBATCH --output={slurm_out}\n".format(slurm_out=slurm_out))
     fh.write("#SBATCH --error={slurm_err}\n".format(slurm_err=slurm_err))
     fh.write("\n")
-    fh.write("{run_script} {run_number} {material} {mass} {energy} {events} {output_path}".format(
+    slurm_estimates.write_timed_command(fh, "{run_script} {run_number} {material} {mass} {energy} {events} {output_path}".format(
         run_script=run_script, run_number=run_number, material=material, mass=mass, 
         energy=energy, events=events, output_path=output_path
     ))
@@ -33,6 +79,28 @@ def run_for_params(run_number, material, mass, energy, events, output_path):
         write_slurm_to_fh(fh, run_number, material, mass, energy, events, output_path)
     os.system("sbatch {slurm_fname}".format(slurm_fname=slurm_fname))
 
+# run all the points with the given backend (see executors.py): as one slurm
+# job array, running points_per_task of them in each allocation, or on this
+# machine
+def run_as_job_array(run_number, points, events, output_path,
+                     points_per_task=1, concurrent=False, backend="slurm",
+                     local_options={}):
+    rows = [[output_fstem_for(run_number, material, mass, energy),
+             run_number, material, mass, energy, events, output_path]
+                for material, mass, energy in points]
+    resources = [resources_for(material, mass, energy, events)
+                     for material, mass, energy in points]
+    if backend == "slurm":
+        options = {"points_per_task" : points_per_task, "concurrent" : concurrent,
+                   "cpus_per_point" : topup_cpus}
+    else:
+        options = dict(local_options, cpus_per_point=topup_cpus)
+    executors.run_points(backend,
+        "electron_unscaled_run_{run_number}".format(run_number=run_number),
+        rows, [hours for hours, mem in resources], [mem for hours, mem in resources],
+        output_path,
+        run_script, "gen_unscaled_point", options=options)
+
 #with open("test.slurm", "w") as fh:
 #    write_slurm_to_fh(fh, 3003, "tungsten", "0.1", "2.0", 100000, "/home/ram2aq/ldmx/data")
 
@@ -45,8 +113,44 @@ energies = [ "1.0", "1.1", "1.2", "1.5" ]
 neventsPerPoint = 100000
 output_dir = "/standard/ldmxuva/data/dblib"
 run_number = 4000
+# where the points run (see executors.py): "slurm", or "local" to run them on
+# this machine
+backend = "slurm"
+# cpus and memory (MB) the local backend uses at most (None for all of the
+# machine)
+local_options = {"max_cpus" : None, "max_mem" : None}
+# cpus (and memory) requested for each point, so that this many top-up runs
+# of run_db_gen_then_extract.sh can run at the same time
+topup_cpus = 1
+# submit the points as one slurm job array rather than one job each
+use_job_array = True
+# points run in each task of the array, where the environment is set up once
+points_per_task = 4
+# run the points of a task at the same time, topup_cpus cpus each, rather than
+# one after another
+concurrent_points = False
+# the time and memory of finished points (from their slurm logs) are kept here
+# and used to size the requests of new ones (see slurm_estimates.py)
+measurements_fname = output_dir + "/slurm/measurements.jsonl"
+estimate_config = "madgraph_unscaled"
+# requested = measured * safety_margin
+safety_margin = 1.5
+# catalog of the library files (see dblib_catalog)
+catalog_fname = output_dir + "/" + dblib_catalog.catalog_basename
+
+os.makedirs(output_dir + "/slurm", exist_ok=True)
+catalog = dblib_catalog.open_catalog(catalog_fname)
+dblib_catalog.update_catalog(catalog, [output_dir], kinds=["unscaled"])
+measurements = slurm_estimates.collect_measurements(
+    measurements_fname, output_dir + "/slurm", estimate_config, point_for)
 
-for material in materials:
-    for mass in masses:
-        for energy in energies:
-            run_for_params(run_number, material, mass, energy, neventsPerPoint, output_dir)
+points = points_to_generate(run_number,
+                            [(material, mass, energy) for material in materials
+                                 for mass in masses for energy in energies],
+                            output_dir)
+if use_job_array or backend != "slurm":
+    run_as_job_array(run_number, points, neventsPerPoint, output_dir,
+                     points_per_task, concurrent_points, backend, local_options)
+else:
+    for material, mass, energy in points:
+        run_for_params(run_number, material, mass, energy, neventsPerPoint, output_dir)
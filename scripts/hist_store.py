@@ -0,0 +1,200 @@
+import os
+import json
+import struct
+import numpy as np
+
+### A binary store of the scaling histograms made by fill_dblib_scaling_hists:
+###   material -> mass -> variable name -> base energy ->
+###     (baseEHist, bins, compEs, compEHists_unscaled, compEHists_scaled)
+### kept in one file, so that the histograms of one cell can be read without
+### reading (or unpickling) the rest. The file is
+###   header: magic, format version
+###   the histogram arrays, each starting on a 64 byte boundary
+###   index: json, for each cell the comparison energies and where its arrays
+###          are (offset, dtype, shape)
+###   footer: offset and length of the index, magic
+### Cells are added by appending their arrays, a new index and a new footer at
+### the end of the file: nothing already written is rewritten, the previous
+### index is just no longer read. A cell that is added again replaces the old
+### one in the index. If an append is interrupted before its footer is
+### complete, the store is read from the last complete index before it (found
+### by scanning back for the magic), i.e. as it was before the append.
+### Starting the store over writes a new file next to it and renames it into
+### place, so a store that is open elsewhere keeps its (old) contents until it
+### is opened again.
+### The file is opened as a read-only memory map and the histograms of a cell
+### are numpy views into it, so a cell is only read from disk when it is used.
+
+store_magic = b"DBLHIST\n"
+store_version = 1
+header_format = "<8sQ"
+footer_format = "<QQ8s"
+array_alignment = 64
+
+def cell_key(material, mass, var_name, base_energy):
+    return (material, float(mass), var_name, float(base_energy))
+
+# the index of the footer that ends at footer_end, or None if there is no
+# complete footer and index there
+def read_footer_index(fp, footer_end):
+    footer_start = footer_end - struct.calcsize(footer_format)
+    if footer_start < struct.calcsize(header_format):
+        return None
+    fp.seek(footer_start)
+    index_offset, index_length, magic = struct.unpack(
+        footer_format, fp.read(struct.calcsize(footer_format)))
+    # the index is written just before its footer
+    if magic != store_magic or index_offset + index_length != footer_start:
+        return None
+    fp.seek(index_offset)
+    try:
+        index = json.loads(fp.read(index_length).decode())
+    except ValueError:
+        return None
+    if not isinstance(index, dict) or "cells" not in index:
+        return None
+    return index
+
+def read_index(fname, scan_block=2**20):
+    with open(fname, "rb") as fp:
+        magic, version = struct.unpack(header_format, fp.read(struct.calcsize(header_format)))
+        if magic != store_magic:
+            raise ValueError("{} is not a histogram store".format(fname))
+        if version > store_version:
+            raise ValueError("{} has format version {}, this code reads up to {}".format(
+                fname, version, store_version))
+        size = fp.seek(0, os.SEEK_END)
+        index = read_footer_index(fp, size)
+        if index is not None:
+            return index
+
+        # the last append was interrupted: scan back, a block at a time, for
+        # the last complete footer
+        end = size
+        while end > struct.calcsize(header_format):
+            start = max(struct.calcsize(header_format), end - scan_block)
+            fp.seek(start)
+            block = fp.read(end - start)
+            found = block.rfind(store_magic)
+            while found >= 0:
+                footer_end = start + found + len(store_magic)
+                index = read_footer_index(fp, footer_end)
+                if index is not None:
+                    print("{}: ignoring the {} bytes after the last complete index (interrupted write?)".format(
+                        fname, size - footer_end))
+                    return index
+                found = block.rfind(store_magic, 0, found)
+            # the blocks overlap so that a magic across their boundary is found
+            end = start + len(store_magic) - 1 if start > struct.calcsize(header_format) else start
+    raise ValueError("{} has no complete index (interrupted write?)".format(fname))
+
+def write_array(fp, array):
+    array = np.ascontiguousarray(array)
+    fp.write(b"\0" * (-fp.tell() % array_alignment))
+    offset = fp.tell()
+    fp.write(array.tobytes())
+    return [offset, array.dtype.str, list(array.shape)]
+
+# add every cell of histDict (organized as above) to the store in fname,
+# creating it if it does not exist; with append=False the store is started
+# over with just these cells
+def write_hist_store(fname, histDict, append=True):
+    if append and os.path.isfile(fname):
+        cells = read_index(fname)["cells"]
+        write_fname = fname
+        mode = "r+b"
+    else:
+        # a new file, renamed into place once complete: truncating the store
+        # in place would pull the data out from under anything that has it
+        # memory mapped
+        cells = []
+        write_fname = os.path.join(os.path.dirname(fname), "." + os.path.basename(fname) + ".tmp")
+        mode = "w+b"
+
+    with open(write_fname, mode) as fp:
+        if mode == "w+b":
+            fp.write(struct.pack(header_format, store_magic, store_version))
+        fp.seek(0, os.SEEK_END)
+        new_keys = set()
+        new_cells = []
+        for material, massDict in histDict.items():
+            for mass, varDict in massDict.items():
+                for var_name, energyDict in varDict.items():
+                    for base_energy, hists in energyDict.items():
+                        baseEHist, bins, compEs, compEHists_unscaled, compEHists_scaled = hists
+                        nBins = len(baseEHist)
+                        new_keys.add(cell_key(material, mass, var_name, base_energy))
+                        new_cells.append({
+                            "material" : material,
+                            "mass" : float(mass),
+                            "var_name" : var_name,
+                            "base_energy" : float(base_energy),
+                            "compEs" : [float(compE) for compE in compEs],
+                            "arrays" : {
+                                "baseEHist" : write_array(fp, baseEHist),
+                                "bins" : write_array(fp, bins),
+                                # one row per comparison energy
+                                "compEHists_unscaled" : write_array(fp,
+                                    np.reshape(compEHists_unscaled, (len(compEHists_unscaled), nBins))),
+                                "compEHists_scaled" : write_array(fp,
+                                    np.reshape(compEHists_scaled, (len(compEHists_scaled), nBins)))
+                            }
+                        })
+        cells = [cell for cell in cells
+                     if cell_key(cell["material"], cell["mass"], cell["var_name"],
+                                 cell["base_energy"]) not in new_keys] + new_cells
+
+        index = json.dumps({"version" : store_version, "cells" : cells}).encode()
+        index_offset = fp.tell()
+        fp.write(index)
+        # the footer goes last, once everything it points to is on disk
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.write(struct.pack(footer_format, index_offset, len(index), store_magic))
+        fp.flush()
+        os.fsync(fp.fileno())
+    if write_fname != fname:
+        os.replace(write_fname, fname)
+
+# returns the store to pass to read_cell: nothing but the index is read here
+def open_hist_store(fname):
+    index = read_index(fname)
+    return {
+        "fname" : fname,
+        "data" : np.memmap(fname, mode="r"),
+        "cells" : {cell_key(cell["material"], cell["mass"], cell["var_name"],
+                            cell["base_energy"]) : cell
+                       for cell in index["cells"]}
+    }
+
+# the keys (material, mass, variable name, base energy) of all the cells, in
+# the order they were written
+def cell_keys(store):
+    return list(store["cells"].keys())
+
+def read_array(store, location):
+    offset, dtype, shape = location
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=store["data"], offset=offset)
+
+# (baseEHist, bins, compEs, compEHists_unscaled, compEHists_scaled) of one
+# cell, as read-only views of the file
+def read_cell(store, material, mass, var_name, base_energy):
+    cell = store["cells"][cell_key(material, mass, var_name, base_energy)]
+    arrays = cell["arrays"]
+    return (
+        read_array(store, arrays["baseEHist"]),
+        read_array(store, arrays["bins"]),
+        cell["compEs"],
+        list(read_array(store, arrays["compEHists_unscaled"])),
+        list(read_array(store, arrays["compEHists_scaled"]))
+    )
+
+# the whole store as the nested dict that fill_dblib_scaling_hists makes
+# (still views of the file, so this reads nothing but the index either)
+def load_hist_dict(store):
+    histDict = {}
+    for key in cell_keys(store):
+        material, mass, var_name, base_energy = key
+        histDict.setdefault(material, {}).setdefault(mass, {}).setdefault(var_name, {})[base_energy] \
+            = read_cell(store, *key)
+    return histDict
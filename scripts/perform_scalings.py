@@ -1,21 +1,358 @@
+import json
 import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-run_script="scripts/run_g4db_scale.sh"
-def run_for_params(run_number, material, mass, scale_from_energy, scale_to_energy):
-    command = "{run_script} {run_number} {material} {mass} {scale_from_energy} {scale_to_energy}".format(
-        run_script=run_script,
-        run_number=run_number,
-        material=material,
-        mass=mass,
-        scale_from_energy=scale_from_energy,
-        scale_to_energy=scale_to_energy
-    )
-    print(command)
-    return os.system(command)
+import dblib_catalog
+import executors
+
+### Run the G4DarkBreM scaling of every material, A' mass and (from, to)
+### energy pair whose unscaled library exists, on up to n_workers workers at
+### a time. Each worker is one bash shell that sources run_g4db_scale.sh (so
+### ldmx is set up once per worker) and then runs scale_point for each of its
+### tasks, with the number of events of the unscaled library taken from the
+### catalog (see dblib_catalog) rather than counted by every scaling. As with
+### the local backend of executors.py, every worker is pinned to its own cpus,
+### a scaling that uses more memory or time than requested (scaling_mem,
+### scaling_hours) is killed, and the output of each scaling goes to
+###   {dblib_dir}/scaled/slurm/slurm_{output stem}.out/.err
+### ending with the timing line of slurm_estimates.
+### The state of every task is kept in {status_dir}/{output stem}.json:
+###   {"state" : "running", "done" or "failed", "exit", "seconds", "events",
+###    "max_rss_mb", "note",
+###    "unscaled" : {"path", "size", "mtime_ns"},
+###    "output" : {"path", "size", "mtime_ns"}}
+### A task that is done, with its output and unscaled library unchanged since,
+### is skipped, so an interrupted campaign resumes where it stopped.
+### With backend = "slurm" the scalings that are not done are instead submitted
+### as one job array (see executors.py), with their logs in the same place;
+### the libraries they make are catalogued, and marked done, the next time
+### this runs.
+
+run_script = "scripts/run_g4db_scale.sh"
+task_marker = "### task_exit"
+
+def unscaled_fname_for(dblib_dir, run_number, material, mass, energy):
+    return "{dblib_dir}/electron_{material}_mA_{mass}_E_{energy}_unscaled_run_{run_number}.csv".format(
+        dblib_dir=dblib_dir, material=material, mass=mass, energy=energy, run_number=run_number)
+
+def scaled_fname_for(dblib_dir, run_number, material, mass, scale_from_energy, scale_to_energy):
+    return "{dblib_dir}/scaled/electron_{material}_mA_{mass}_E_{scale_to_energy}_scaledFrom_{scale_from_energy}_run_{run_number}.csv".format(
+        dblib_dir=dblib_dir, material=material, mass=mass, scale_to_energy=scale_to_energy,
+        scale_from_energy=scale_from_energy, run_number=run_number)
+
+def file_entry(fname):
+    st = os.stat(fname)
+    return {"path" : fname, "size" : st.st_size, "mtime_ns" : st.st_mtime_ns}
+
+# one task per scaling whose unscaled library is in the catalog; energies is a
+# list of ([energies to scale from], energy to scale to)
+def build_tasks(catalog, dblib_dir, run_number, materials, masses, energies):
+    tasks = []
+    n_missing = 0
+    for material in materials:
+        for mass in masses:
+            unscaled_rows = {row["path"] : row for row in dblib_catalog.find_files(
+                catalog, "unscaled", material, mass, run_number=run_number,
+                lepton="electron")}
+            for energy_pair in energies:
+                energy_to = energy_pair[1]
+                for energy_from in energy_pair[0]:
+                    unscaled = unscaled_fname_for(dblib_dir, run_number, material, mass, energy_from)
+                    if unscaled not in unscaled_rows:
+                        n_missing += 1
+                        continue
+                    scaled = scaled_fname_for(dblib_dir, run_number, material, mass, energy_from, energy_to)
+                    tasks.append({
+                        "args" : [run_number, material, mass, energy_from, energy_to, dblib_dir],
+                        "unscaled" : unscaled,
+                        "events" : unscaled_rows[unscaled]["n_events"],
+                        "output" : scaled,
+                        "stem" : os.path.splitext(os.path.basename(scaled))[0]
+                    })
+    if n_missing > 0:
+        print("{n} scalings skipped: unscaled library missing".format(n=n_missing))
+    return tasks
+
+def load_status(status_fname):
+    if not os.path.isfile(status_fname):
+        return None
+    with open(status_fname) as fp:
+        return json.load(fp)
+
+def save_status(status, status_fname):
+    # write then rename, so an interrupted campaign never leaves a broken status
+    tmp_fname = status_fname + ".tmp"
+    with open(tmp_fname, "w") as fp:
+        json.dump(status, fp, indent=1)
+    os.replace(tmp_fname, status_fname)
+
+def is_done(task, status):
+    return (status is not None and status["state"] == "done"
+            and os.path.isfile(task["output"]) and os.path.isfile(task["unscaled"])
+            and status["output"] == file_entry(task["output"])
+            and status["unscaled"] == file_entry(task["unscaled"]))
+
+# a scaled library from before there were status files is kept if it has as
+# many events as its unscaled library (so was not cut short)
+def adopt_existing(catalog, task, status_fname):
+    if dblib_catalog.n_events_of(catalog, task["output"]) != task["events"]:
+        return False
+    save_status({"state" : "done", "exit" : None, "seconds" : None, "events" : task["events"],
+                 "unscaled" : file_entry(task["unscaled"]),
+                 "output" : file_entry(task["output"])}, status_fname)
+    return True
+
+# the worker shell of the calling thread, and the cpus it is pinned to
+worker_shells = threading.local()
+
+# a bash shell that has sourced run_script, pinned to cpus and in a session of
+# its own, so that the processes of the scaling it runs can be measured and
+# killed together (as executors.run_local does for each point)
+def start_worker_shell(workers, cpus):
+    with workers["lock"]:
+        worker = len(workers["shells"])
+        setup_log = os.path.join(workers["log_dir"], "worker_{n}_setup.log".format(n=worker))
+        env = dict(os.environ)
+        env["SLURM_CPUS_PER_TASK"] = str(len(cpus))
+        shell = subprocess.Popen(["bash"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 text=True, env=env, start_new_session=True,
+                                 preexec_fn=lambda: os.sched_setaffinity(0, cpus))
+        workers["shells"].append(shell)
+    shell.stdin.write("source {run_script} > {log} 2>&1 < /dev/null\n".format(
+        run_script=run_script, log=setup_log))
+    return shell
+
+# run scale_point for the task in the worker's shell (starting a new one if
+# there is none or the last one was killed); returns the point as the monitor
+# saw it: {"start", "hours", "mem", "max_rss_kb", "note" (why it was killed),
+# "exit" (None if the shell died), "seconds"}
+def run_in_worker_shell(task, events, workers, hours, mem):
+    if getattr(worker_shells, "cpus", None) is None:
+        with workers["lock"]:
+            worker_shells.cpus = workers["cpu_sets"].pop()
+    shell = getattr(worker_shells, "shell", None)
+    if shell is None or shell.poll() is not None:
+        shell = start_worker_shell(workers, worker_shells.cpus)
+        worker_shells.shell = shell
+    point = {"start" : time.perf_counter(), "hours" : hours, "mem" : mem,
+             "max_rss_kb" : 0, "note" : None, "exit" : None}
+    with workers["lock"]:
+        workers["running"][shell.pid] = point
+    log_stem = os.path.join(workers["log_dir"], "slurm_" + task["stem"])
+    shell.stdin.write('scale_point {args} {events} > {stem}.out 2> {stem}.err < /dev/null; echo "{marker} $?"\n'.format(
+        args=" ".join(str(arg) for arg in task["args"]), events=events,
+        stem=log_stem, marker=task_marker))
+    try:
+        shell.stdin.flush()
+        for line in shell.stdout:
+            if line.startswith(task_marker):
+                point["exit"] = int(line.split()[-1])
+                break
+    except BrokenPipeError:
+        pass
+    if point["exit"] is None:
+        # the shell ended (or was killed): reap it, so that the next task
+        # starts a new one
+        shell.wait()
+    with workers["lock"]:
+        del workers["running"][shell.pid]
+    point["seconds"] = time.perf_counter() - point["start"]
+    return point
+
+# sample the memory of the sessions of the running scalings (the scaling and
+# its worker shell) every poll_interval until stop is set and, with
+# enforce_limits, kill the session of a scaling that uses more memory than
+# its mem or runs longer than its hours, as executors.run_local does
+def monitor_workers(workers, enforce_limits, poll_interval, stop):
+    while not stop.wait(poll_interval):
+        with workers["lock"]:
+            running = dict(workers["running"])
+        rss_kb_of = executors.session_rss_kb(list(running))
+        for pid, point in running.items():
+            point["max_rss_kb"] = max(point["max_rss_kb"], rss_kb_of[pid])
+            if not enforce_limits or point["note"] is not None:
+                continue
+            if rss_kb_of[pid] > point["mem"] * 1024:
+                note = "killed at {:.0f} MB, over the {} MB requested".format(
+                    rss_kb_of[pid] / 1024, point["mem"])
+            elif time.perf_counter() - point["start"] > point["hours"] * 3600:
+                note = "killed, over the {} hours requested".format(point["hours"])
+            else:
+                continue
+            with workers["lock"]:
+                # unless the shell has moved on to its next scaling since
+                if workers["running"].get(pid) is point:
+                    point["note"] = note
+                    try:
+                        os.killpg(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+
+# the tasks that are not already done; with retry_failed=False tasks that
+# failed in an earlier campaign are left alone
+def tasks_to_run(catalog, tasks, status_fname_for, retry_failed=True):
+    todo = []
+    n_done = 0
+    n_failed_before = 0
+    for task in tasks:
+        status = load_status(status_fname_for(task))
+        if is_done(task, status):
+            n_done += 1
+        elif status is None and adopt_existing(catalog, task, status_fname_for(task)):
+            n_done += 1
+        elif status is not None and status["state"] == "failed" and not retry_failed:
+            n_failed_before += 1
+        else:
+            todo.append(task)
+    print("{n_todo} scalings to run, {n_done} already done, {n_failed} failed before and not retried".format(
+        n_todo=len(todo), n_done=n_done, n_failed=n_failed_before))
+    return todo
+
+# run every task that is not already done (see tasks_to_run) on this machine,
+# on as many workers as fit in max_cpus cpus and max_mem MB (all of the
+# machine by default) with cpus_per_point cpus and mem MB each, and at most
+# n_workers; as in executors.run_local, each worker is pinned to its cpus and,
+# with enforce_limits, a scaling that uses more than mem MB or runs longer than
+# hours is killed, and the output of each scaling goes to
+# {output_path}/slurm/slurm_{output stem}.out/.err, ending with the timing line
+# of slurm_estimates
+# with continue_on_fail=False no new tasks are started after a failure
+# the scaled libraries that are made are added to the catalog
+def run_scalings(catalog, tasks, status_dir, output_path, hours, mem, n_workers=1,
+                 continue_on_fail=False, retry_failed=True, max_cpus=None, max_mem=None,
+                 cpus_per_point=1, enforce_limits=True, poll_interval=2.):
+    os.makedirs(status_dir, exist_ok=True)
+    log_dir = output_path + "/slurm"
+    os.makedirs(log_dir, exist_ok=True)
+    status_fname_for = lambda task: os.path.join(status_dir, task["stem"] + ".json")
+    todo = tasks_to_run(catalog, tasks, status_fname_for, retry_failed)
+
+    all_cpus = sorted(os.sched_getaffinity(0))
+    if max_cpus is not None:
+        all_cpus = all_cpus[:max_cpus]
+    if max_mem is None:
+        max_mem = executors.total_memory_mb()
+    n_workers = min(n_workers, len(all_cpus) // cpus_per_point, int(max_mem // mem))
+    if n_workers < 1:
+        print("a scaling needs {cpus} cpus and {mem} MB, more than the {max_cpus} cpus and {max_mem:.0f} MB available".format(
+            cpus=cpus_per_point, mem=mem, max_cpus=len(all_cpus), max_mem=max_mem))
+        return False
+    workers = {
+        "log_dir" : log_dir,
+        "lock" : threading.Lock(),
+        "shells" : [],
+        "running" : {}, # worker shell pid -> point (see run_in_worker_shell)
+        "cpu_sets" : [all_cpus[i * cpus_per_point:(i + 1) * cpus_per_point]
+                          for i in range(n_workers)]
+    }
+
+    stop = threading.Event()
+    def run_task(task):
+        if stop.is_set():
+            return None
+        events = task["events"]
+        # whatever is left of an earlier, unfinished attempt
+        if os.path.isfile(task["output"]):
+            print("removing unfinished output {}".format(task["output"]))
+            os.remove(task["output"])
+        status = {"state" : "running", "exit" : None, "seconds" : None, "events" : events,
+                  "max_rss_mb" : None, "unscaled" : file_entry(task["unscaled"]), "output" : None}
+        save_status(status, status_fname_for(task))
+        point = run_in_worker_shell(task, events, workers, hours, mem)
+        exit_status = point["exit"]
+        if point["note"] is not None:
+            # killed, written the way bash reports it
+            exit_status = 128 + signal.SIGKILL
+        executors.write_local_timing(os.path.join(log_dir, "slurm_{}.err".format(task["stem"])),
+                                     point["seconds"], point["max_rss_kb"],
+                                     "unknown" if exit_status is None else exit_status,
+                                     point["note"])
+        status["exit"] = exit_status
+        status["seconds"] = point["seconds"]
+        status["max_rss_mb"] = point["max_rss_kb"] / 1024
+        if exit_status == 0 and os.path.isfile(task["output"]):
+            status["state"] = "done"
+            status["output"] = file_entry(task["output"])
+        else:
+            status["state"] = "failed"
+        status["note"] = point["note"]
+        save_status(status, status_fname_for(task))
+        return status
+
+    print("{n} scalings on {n_workers} workers of {cpus} cpus and {mem} MB each".format(
+        n=len(todo), n_workers=n_workers, cpus=cpus_per_point, mem=mem))
+    startWall = time.perf_counter()
+    busy_cpu_s = 0.
+    n_ran = 0
+    n_failed = 0
+    stop_monitor = threading.Event()
+    monitor = threading.Thread(target=monitor_workers,
+                               args=(workers, enforce_limits, poll_interval, stop_monitor))
+    monitor.start()
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(run_task, task) : task for task in todo}
+            for future in as_completed(futures):
+                status = future.result()
+                if status is None:
+                    continue
+                n_ran += 1
+                busy_cpu_s += status["seconds"] * cpus_per_point
+                task = futures[future]
+                print("{state}: {stem} ({events} events, {t:.0f} s, peak RSS {rss:.0f} MB)".format(
+                    state=status["state"] if status["note"] is None else "failed ({})".format(status["note"]),
+                    stem=task["stem"], events=status["events"], t=status["seconds"],
+                    rss=status["max_rss_mb"]))
+                if status["state"] == "done":
+                    dblib_catalog.add_csv_file(catalog, task["output"])
+                    catalog.commit()
+                else:
+                    n_failed += 1
+                    if not continue_on_fail and not stop.is_set():
+                        print("stopping after failure, see {}".format(
+                            os.path.join(log_dir, "slurm_{}.err".format(task["stem"]))))
+                        stop.set()
+    finally:
+        stop_monitor.set()
+        monitor.join()
+        for shell in workers["shells"]:
+            if shell.poll() is None:
+                shell.stdin.close()
+                shell.wait()
+    executors.print_throughput("scalings", n_ran - n_failed, len(todo),
+                               time.perf_counter() - startWall, busy_cpu_s, len(all_cpus))
+    return n_failed == 0
+
+# submit the scalings that are not already done (see tasks_to_run) as one
+# slurm job array, points_per_task of them in each task (see executors.py)
+# the status of a submitted task is removed (and an out of date output with
+# it), so that once its job has made the output, the next run adopts it as done
+def submit_scalings(catalog, tasks, status_dir, output_path, run_number, hours, mem,
+                    points_per_task=1, retry_failed=True):
+    os.makedirs(status_dir, exist_ok=True)
+    status_fname_for = lambda task: os.path.join(status_dir, task["stem"] + ".json")
+    todo = tasks_to_run(catalog, tasks, status_fname_for, retry_failed)
+    for task in todo:
+        if os.path.isfile(task["output"]):
+            print("removing out of date output {}".format(task["output"]))
+            os.remove(task["output"])
+            dblib_catalog.remove_file(catalog, task["output"])
+        if os.path.isfile(status_fname_for(task)):
+            os.remove(status_fname_for(task))
+    catalog.commit()
+    rows = [[task["stem"]] + task["args"] + [task["events"]] for task in todo]
+    executors.run_points("slurm", "electron_scaled_run_{run_number}".format(run_number=run_number),
+                         rows, [hours] * len(rows), [mem] * len(rows), output_path,
+                         run_script, "scale_point",
+                         options={"points_per_task" : points_per_task})
 
 materials = ["lead", "oxygen"] #["tungsten", "silicon", "copper", "lead", "oxygen"]
 masses = ["0.005", "0.01", "0.05", "0.1"]
-energies = [  
+energies = [
              (["1.1", "1.2", "1.5", "2.0", "3.0", "4.0"], "1.0"),
              (["2.2", "2.4", "2.5", "2.6", "2.8", "3.0", "4.0"], "2.0"),
              (["3.3", "3.6", "3.9", "4.0", "5.0", "6.0"], "3.0"),
@@ -27,14 +364,39 @@ energies = [
             ]
 
 run_number = 4000
+dblib_dir = "/standard/ldmxuva/data/dblib"
+# per-task status files
+status_dir = dblib_dir + "/scaled/status"
+# number of scalings run at the same time, each worker setting up ldmx once
+n_workers = 4
+# cpus and memory (MB) the local workers use at most (None for all of the
+# machine; fewer than n_workers run if they do not fit), and cpus given to
+# each worker
+local_options = {"max_cpus" : None, "max_mem" : None, "cpus_per_point" : 1}
 
 continue_on_fail = False
+# re-run scalings that failed in an earlier campaign
+retry_failed = True
+# catalog of the library files (see dblib_catalog)
+catalog_fname = dblib_dir + "/" + dblib_catalog.catalog_basename
+# where the scalings run: "local" (here, on n_workers workers) or "slurm"
+backend = "local"
+# time (hours) and memory (MB) requested for each scaling (with the local
+# backend, a scaling that goes over them is killed), and scalings run in each
+# task of the array, with the slurm backend
+scaling_hours = 1
+scaling_mem = 2000
+points_per_task = 10
 
-for material in materials:
-    for mass in masses:
-        for energy_pair in energies:
-            energy_to = energy_pair[1]
-            for energy_from in energy_pair[0]:
-                retval = run_for_params(run_number, material, mass, energy_from, energy_to)
-                if retval != 0 and not continue_on_fail:
-                    exit()
+if __name__ == "__main__":
+    catalog = dblib_catalog.open_catalog(catalog_fname)
+    dblib_catalog.update_catalog(catalog, [dblib_dir, dblib_dir + "/scaled"],
+                                 kinds=["unscaled", "scaled"])
+    tasks = build_tasks(catalog, dblib_dir, run_number, materials, masses, energies)
+    if backend == "slurm":
+        submit_scalings(catalog, tasks, status_dir, dblib_dir + "/scaled", run_number,
+                        scaling_hours, scaling_mem, points_per_task, retry_failed)
+    elif not run_scalings(catalog, tasks, status_dir, dblib_dir + "/scaled", scaling_hours,
+                          scaling_mem, n_workers, continue_on_fail, retry_failed,
+                          **local_options):
+        exit(1)
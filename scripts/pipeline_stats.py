@@ -0,0 +1,111 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+### Opt-in timing and memory records of the stages of the dblib scripts
+### (compile_dblib_into_df, fill_dblib_scaling_hists, assemble_combined_library
+### and the dblib_dataset functions they call), to see where the time of a long
+### run goes. Nothing is recorded until enable() is called; from then on every
+### stage() appends one json line to the stats file:
+###   {"time", "script", "pid", "stage", <labels, e.g. material, mass, file>,
+###    "rows", "wall_s", "cpu_s", "max_rss_mb", "failed"}
+### where cpu_s is the cpu time of the process during the stage and
+### max_rss_mb the peak RSS of the process up to the end of the stage (so it
+### only grows within a process). Stages can be nested, e.g. the load and
+### histogram stages of a (material, mass) cell are inside its cell stage.
+### The file name is passed to worker processes in the environment, so the
+### workers of a pool (forked or spawned) write to the same file; each record
+### is one write to a file opened for appending, so the lines of different
+### processes do not mix.
+### start_usage and usage_since are the wall/cpu/peak RSS measurement behind
+### stage(), also used directly where the numbers are printed or returned
+### rather than recorded (the per-file and per-cell reports, the benchmarks).
+
+env_var = "DBLIB_STATS_FNAME"
+
+stats_fname = os.environ.get(env_var)
+
+# record the stages of this process, and of the processes it starts from now
+# on, in fname (None stops recording)
+def enable(fname):
+    global stats_fname
+    if fname is None:
+        stats_fname = None
+        os.environ.pop(env_var, None)
+        return
+    stats_fname = os.path.abspath(fname)
+    os.makedirs(os.path.dirname(stats_fname), exist_ok=True)
+    os.environ[env_var] = stats_fname
+
+def write_record(record):
+    fd = os.open(stats_fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # numpy numbers (e.g. a number of rows) are written as plain numbers
+        os.write(fd, (json.dumps(record, default=lambda value: value.item()) + "\n").encode())
+    finally:
+        os.close(fd)
+
+# the starting point for usage_since
+def start_usage():
+    return (time.perf_counter(), resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+
+# wall time and cpu time since start (from start_usage), the cpu time split
+# into that of this process and that of its children that have been waited
+# for, and the peak RSS of this process and of the largest of those children
+# (peaks since they started, not since start)
+def usage_since(start):
+    startWall, startOwn, startChildren = start
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kB on linux
+    return {
+        "wall_s" : time.perf_counter() - startWall,
+        "cpu_s" : own.ru_utime + own.ru_stime - startOwn.ru_utime - startOwn.ru_stime,
+        "child_cpu_s" : (children.ru_utime + children.ru_stime
+                         - startChildren.ru_utime - startChildren.ru_stime),
+        "max_rss_mb" : own.ru_maxrss / 1e3,
+        "max_child_rss_mb" : children.ru_maxrss / 1e3
+    }
+
+# the resident memory of this process now, unlike ru_maxrss, which is its
+# peak since it started (so in a pool worker covers all of its earlier tasks)
+def current_rss_mb():
+    with open("/proc/self/statm") as fp:
+        return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+# time the code in the with block as one stage; labels are added to the
+# record as they are, and the yielded dict can be given the number of rows
+# (record["rows"] = ...) or other fields once they are known
+# when recording is not enabled this does nothing but yield a dict
+@contextlib.contextmanager
+def stage(name, rows=None, **labels):
+    record = {"rows" : rows}
+    if stats_fname is None:
+        yield record
+        return
+    start = start_usage()
+    failed = True
+    try:
+        yield record
+        failed = False
+    finally:
+        usage = usage_since(start)
+        stats = {
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "script" : os.path.basename(sys.argv[0]),
+            "pid" : os.getpid(),
+            "stage" : name
+        }
+        stats.update(labels)
+        stats.update(record)
+        stats.update({
+            "wall_s" : usage["wall_s"],
+            "cpu_s" : usage["cpu_s"],
+            "max_rss_mb" : usage["max_rss_mb"],
+            "failed" : failed
+        })
+        write_record(stats)
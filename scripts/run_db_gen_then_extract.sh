@@ -20,56 +20,147 @@ dbgen dest $dbgen_destdir
 ldmx_env_path=$base_dir/ldmx-sw/scripts/ldmx-env.sh
 source $ldmx_env_path
 
-### arguments: {run number} {target material} {A' mass} {incident energy} {number of events} {output path}
-run_number=$1
-material=$2
-mass=$3
-energy=$4
-events=$5
-output_path=$6
-output_filename=${output_path}/electron_${material}_mA_${mass}_E_${energy}_unscaled_run_${run_number}.csv
-
-if [[ -f ${output_filename} ]]; then
-  >&2 echo "Output file already exists: $output_filename"
-  exit 1
-fi
+### top-up runs when the first run of a point makes fewer events than asked for
+### (MadGraph sometimes fails to generate all of them): how many run at the
+### same time (one per cpu of the point: POINT_CPUS, set by run_param_bundle.sh
+### to the point's share of the allocation, or else the cpus of the allocation,
+### one unless --cpus-per-task was requested), the smallest number of events
+### worth a separate run, the extra percentage requested on top of the
+### estimated deficit, and how many rounds of top-up runs to try before giving
+### up on the point
+max_topup_runs=${SLURM_CPUS_PER_TASK:-1}
+min_topup_events=1000
+topup_margin_percent=10
+max_topup_rounds=5
 
-### run dbgen to generate lhe file
-dbgen run --run ${run_number} --nevents ${events} --max_energy ${energy} --min_energy ${energy} --apmass ${mass} --target ${material} --lepton electron
-dbgen_output=$dbgen_destdir/electron_${material}_MaxE_${energy}_MinE_${energy}_RelEStep_0.1_UndecayedAP_mA_${mass}_run_${run_number}
-### extract only relevant info (recoil e and A' kinematics) to csv file
-ldmx g4db-extract-library -o ${output_filename} ${dbgen_output}
-### delete the lhe file
-rm -rf ${dbgen_output}
+### run dbgen for one run number in its own work directory (so that several
+### runs can go at the same time) and extract it to a csv file
+### arguments: {run number} {target material} {A' mass} {incident energy} {number of events} {output csv}
+gen_dbgen_run() (
+  local run_number=$1
+  local material=$2
+  local mass=$3
+  local energy=$4
+  local events=$5
+  local output_filename=$6
+  local run_name=electron_${material}_mA_${mass}_E_${energy}_run_${run_number}
+  local dbgen_output=$dbgen_destdir/electron_${material}_MaxE_${energy}_MinE_${energy}_RelEStep_0.1_UndecayedAP_mA_${mass}_run_${run_number}
 
-let eventsSoFar=`wc -l ${output_filename} | awk -F" " '{print $1}'`-1
-orig_output_filename=${output_filename}
-### keep running, with increasing run numbers, until we get the desired events
-while [ ${eventsSoFar} -lt ${events} ]; do
-  let run_number=${run_number}+1
-  echo "Found only $eventsSoFar events of requested $events. Running again with run number $run_number."
+  mkdir -p $dbgen_workdir/$run_name
+  dbgen work $dbgen_workdir/$run_name || return 1
+  ### run dbgen to generate lhe file
+  dbgen run --run ${run_number} --nevents ${events} --max_energy ${energy} --min_energy ${energy} --apmass ${mass} --target ${material} --lepton electron
+  ### extract only relevant info (recoil e and A' kinematics) to csv file
+  ldmx g4db-extract-library -o ${output_filename} ${dbgen_output}
+  ### delete the lhe file and the work directory
+  rm -rf ${dbgen_output} $dbgen_workdir/$run_name
+  [[ -f ${output_filename} ]]
+)
 
+### generate one point in the environment set up above
+### arguments: {run number} {target material} {A' mass} {incident energy} {number of events} {output path}
+gen_unscaled_point() {
+  local run_number=$1
+  local material=$2
+  local mass=$3
+  local energy=$4
+  local events=$5
+  local output_path=$6
+  local output_filename orig_output_filename eventsSoFar firstEvents deficit needed
+  local n_runs run_events i topup_run topup_filenames finished_filenames pids added
+  local round=0
+  local point_topup_runs=${POINT_CPUS:-${max_topup_runs}}
   output_filename=${output_path}/electron_${material}_mA_${mass}_E_${energy}_unscaled_run_${run_number}.csv
 
   if [[ -f ${output_filename} ]]; then
     >&2 echo "Output file already exists: $output_filename"
-    exit 1
+    return 1
   fi
 
-  ### run dbgen to generate lhe file
-  dbgen run --run ${run_number} --nevents ${events} --max_energy ${energy} --min_energy ${energy} --apmass ${mass} --target ${material} --lepton electron
-  dbgen_output=$dbgen_destdir/electron_${material}_MaxE_${energy}_MinE_${energy}_RelEStep_0.1_UndecayedAP_mA_${mass}_run_${run_number}
-  ### extract only relevant info (recoil e and A' kinematics) to csv file
-  ldmx g4db-extract-library -o ${output_filename} ${dbgen_output}
-  ### delete the lhe file
-  rm -rf ${dbgen_output}
-  ### add the new events from the most recent run into the original run
-  tail -n +2 ${output_filename} >> ${orig_output_filename}
+  gen_dbgen_run ${run_number} ${material} ${mass} ${energy} ${events} ${output_filename}
+  if [[ ! -f ${output_filename} ]]; then
+    >&2 echo "No output from run $run_number: $output_filename"
+    return 1
+  fi
+
+  let eventsSoFar=`wc -l ${output_filename} | awk -F" " '{print $1}'`-1
+  firstEvents=${eventsSoFar}
+  orig_output_filename=${output_filename}
+  topup_run=${run_number}
+  ### keep topping up, with increasing run numbers, until we get the desired events
+  while [ ${eventsSoFar} -lt ${events} ]; do
+    if [ ${round} -ge ${max_topup_rounds} ]; then
+      >&2 echo "Giving up after $round rounds of top-up runs with $eventsSoFar events of requested $events"
+      return 1
+    fi
+    let round=${round}+1
+    ### the events still needed, scaled by the yield of the first run (all
+    ### of the deficit if it made none) plus a margin, split over up to
+    ### point_topup_runs runs at the same time
+    deficit=$(( events - eventsSoFar ))
+    if [ ${firstEvents} -gt 0 ]; then
+      needed=$(( (deficit * events + firstEvents - 1) / firstEvents ))
+    else
+      needed=${events}
+    fi
+    needed=$(( needed + (needed * topup_margin_percent + 99) / 100 ))
+    n_runs=$(( (needed + min_topup_events - 1) / min_topup_events ))
+    if [ ${n_runs} -gt ${point_topup_runs} ]; then
+      n_runs=${point_topup_runs}
+    fi
+    if [ ${n_runs} -lt 1 ]; then
+      n_runs=1
+    fi
+    run_events=$(( (needed + n_runs - 1) / n_runs ))
+    echo "Found only $eventsSoFar events of requested $events. Running $n_runs more runs of $run_events events at the same time."
 
-  let eventsSoFar=${eventsSoFar}+`wc -l ${output_filename} | awk -F" " '{print $1}'`-1
+    topup_filenames=()
+    pids=()
+    for (( i = 0; i < n_runs; i++ )); do
+      let topup_run=${topup_run}+1
+      output_filename=${output_path}/electron_${material}_mA_${mass}_E_${energy}_unscaled_run_${topup_run}.csv
+      if [[ -f ${output_filename} ]]; then
+        >&2 echo "Output file already exists: $output_filename"
+        [[ ${#pids[@]} -gt 0 ]] && wait "${pids[@]}"
+        rm -f "${topup_filenames[@]}"
+        return 1
+      fi
+      gen_dbgen_run ${topup_run} ${material} ${mass} ${energy} ${run_events} ${output_filename} &
+      pids+=($!)
+      topup_filenames+=(${output_filename})
+    done
+    wait "${pids[@]}"
 
-  ### remove the most recent run (which is now a duplicate)
-  rm ${output_filename}
-done
+    ### add the new events of all the top-up runs into the original run in
+    ### one pass, counting exactly the events added, then remove the top-up
+    ### runs (which are now duplicates)
+    finished_filenames=()
+    for output_filename in "${topup_filenames[@]}"; do
+      if [[ -f ${output_filename} ]]; then
+        finished_filenames+=(${output_filename})
+      else
+        >&2 echo "No output from top-up run: $output_filename"
+      fi
+    done
+    added=0
+    if [[ ${#finished_filenames[@]} -gt 0 ]]; then
+      added=$(awk -v out=${orig_output_filename} 'FNR > 1 { print >> out; n++ } END { print n + 0 }' "${finished_filenames[@]}")
+    fi
+    let eventsSoFar=${eventsSoFar}+${added}
+    rm -f "${topup_filenames[@]}"
+    ### a round that adds nothing would just be repeated with more run numbers
+    if [ ${added} -eq 0 ]; then
+      >&2 echo "No events from any of the $n_runs top-up runs, giving up with $eventsSoFar events of requested $events"
+      return 1
+    fi
+  done
 
-echo "Total events generated=${eventsSoFar}"
\ No newline at end of file
+  echo "Total events generated=${eventsSoFar}"
+}
+
+### when run as a script, generate the point given by the arguments; when
+### sourced (by run_param_bundle.sh), only set up the environment and define
+### gen_unscaled_point, so that a bundle of points shares one setup
+if [[ "${BASH_SOURCE[0]}" == "${0}" ]]; then
+  gen_unscaled_point "$@"
+fi
@@ -5,38 +5,58 @@ base_dir=${PWD}
 ldmx_env_path=$base_dir/ldmx-sw/scripts/ldmx-env.sh
 source $ldmx_env_path
 
-### arguments: {run number} {target material} {A' mass} {scale from energy} {scale to energy} {directory containing unscaled libs}
-run_number=$1
-material=$2
-mass=$3
-scale_from_energy=$4
-scale_to_energy=$5
-dblib_dir=$6
-
-if [[ `echo "${scale_from_energy} <= ${scale_to_energy}" | bc` == 1 ]]; then
+declare -A material_Z=( ["tungsten"]="74" ["copper"]="29" ["lead"]="82" ["oxygen"]="8" ["silicon"]="14")
+
+### scale one point in the environment set up above
+### arguments: {run number} {target material} {A' mass} {scale from energy} {scale to energy} {directory containing unscaled libs} [number of events in the unscaled lib]
+### the number of events is counted from the unscaled lib if it is not given
+scale_point() {
+  local run_number=$1
+  local material=$2
+  local mass=$3
+  local scale_from_energy=$4
+  local scale_to_energy=$5
+  local dblib_dir=$6
+  local events=$7
+  local unscaled_fname scaled_fname partial_fname massMeV
+
+  if [[ `echo "${scale_from_energy} <= ${scale_to_energy}" | bc` == 1 ]]; then
     >&2 echo "Cannot scale from $scale_from_energy to $scale_to_energy -- must scale from higher to lower energy."
-    exit 1
-fi
+    return 1
+  fi
 
-unscaled_fname=${dblib_dir}/electron_${material}_mA_${mass}_E_${scale_from_energy}_unscaled_run_${run_number}.csv
+  unscaled_fname=${dblib_dir}/electron_${material}_mA_${mass}_E_${scale_from_energy}_unscaled_run_${run_number}.csv
 
-if [[ ! -f ${unscaled_fname} ]]; then
+  if [[ ! -f ${unscaled_fname} ]]; then
     >&2 echo "Unscaled file missing: $unscaled_fname"
-    exit 1
-fi
+    return 1
+  fi
 
-mkdir -p ${dblib_dir}/scaled
-scaled_fname=${dblib_dir}/scaled/electron_${material}_mA_${mass}_E_${scale_to_energy}_scaledFrom_${scale_from_energy}_run_${run_number}.csv
+  mkdir -p ${dblib_dir}/scaled
+  scaled_fname=${dblib_dir}/scaled/electron_${material}_mA_${mass}_E_${scale_to_energy}_scaledFrom_${scale_from_energy}_run_${run_number}.csv
 
-if [[ -f ${scaled_fname} ]]; then
+  if [[ -f ${scaled_fname} ]]; then
     >&2 echo "Output file already exists: $scaled_fname"
-    exit 1
+    return 1
+  fi
+
+  if [[ -z ${events} ]]; then
+    let events=`wc -l ${unscaled_fname} | awk -F" " '{print $1}'`-1
+  fi
+
+  massMeV="$(echo "$mass * 1000" | bc)"
+
+  ### scale into a partial file and only give it the output name once it is
+  ### complete, so an interrupted scaling never leaves a truncated library
+  partial_fname=${dblib_dir}/scaled/partial_electron_${material}_mA_${mass}_E_${scale_to_energy}_scaledFrom_${scale_from_energy}_run_${run_number}.csv
+  rm -f ${partial_fname}
+  ldmx g4db-scale --scale-APrime -o ${partial_fname} -E ${scale_to_energy} -Z ${material_Z[${material}]} -N ${events} -M ${massMeV} ${unscaled_fname} || return 1
+  mv ${partial_fname} ${scaled_fname}
+}
+
+### when run as a script, scale the point given by the arguments; when sourced
+### (by perform_scalings.py), only set up the environment and define
+### scale_point, so that many scalings share one setup
+if [[ "${BASH_SOURCE[0]}" == "${0}" ]]; then
+  scale_point "$@"
 fi
-
-declare -A material_Z=( ["tungsten"]="74" ["copper"]="29" ["lead"]="82" ["oxygen"]="8" ["silicon"]="14")
-
-let events=`wc -l ${unscaled_fname} | awk -F" " '{print $1}'`-1
-
-massMeV="$(echo "$mass * 1000" | bc)"
-
-ldmx g4db-scale --scale-APrime -o ${scaled_fname} -E ${scale_to_energy} -Z ${material_Z[${material}]} -N ${events} -M ${massMeV} ${unscaled_fname}
\ No newline at end of file
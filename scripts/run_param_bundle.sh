@@ -0,0 +1,92 @@
+#!/bin/bash
+
+### run a bundle of points from a parameter table in one allocation (one task
+### of a slurm job array), setting up the environment only once for all of them
+### arguments: {env script} {point function} {parameter table} {points per task}
+###            {concurrent: 1 to run the points at the same time, 0 for one
+###            after another} {log dir} [arguments for the env script]
+### the env script is sourced with the extra arguments; it sets up the
+### environment and defines the point function (see run_db_gen_then_extract.sh
+### and setup_ldmx_and_fire.sh)
+### each line of the table is {log stem} {arguments of the point function}, and
+### the output of each point goes to {log dir}/slurm_{log stem}.out and .err,
+### the same files as when each point was its own job
+env_script=$1
+point_function=$2
+param_table=$3
+points_per_task=$4
+concurrent=$5
+log_dir=$6
+shift 6
+
+### read the table before sourcing, since the env script may change directory
+task=${SLURM_ARRAY_TASK_ID:-0}
+first=$(( task * points_per_task + 1 ))
+last=$(( first + points_per_task - 1 ))
+mapfile -t points < <(sed -n "${first},${last}p" ${param_table})
+
+source ${env_script} "$@"
+
+### how often the memory of a running point is sampled
+rss_poll_seconds=5
+
+### resident memory (kB) of a process and all of its descendants
+### arguments: {pid}
+tree_rss_kb() {
+  ps -e -o pid=,ppid=,rss= | awk -v root=$1 '
+    { parent[$1] = $2; rss[$1] = $3 }
+    END {
+      for (pid in parent) {
+        p = pid
+        while (p != root && p in parent) p = parent[p]
+        if (p == root) total += rss[pid]
+      }
+      print total + 0
+    }'
+}
+
+### run one point and end its .err log with its timing (the same line as
+### slurm_estimates.write_timed_command writes for single jobs); the memory is
+### the peak of the point's own processes, sampled every rss_poll_seconds
+### (sstat only knows the peak of the whole job step, which the other points
+### of the bundle, before or beside this one, are part of)
+### the point function gets its share of the cpus of the task in POINT_CPUS
+### (all of them, or 1/n of them when n points run at once)
+### arguments: {number of points running at once} {arguments of the point function}
+timed_point() {
+  local n_sharing=$1
+  shift
+  local point_start=$(date +%s)
+  local peak_kb=0 rss_kb
+  local point_cpus=$(( ${SLURM_CPUS_PER_TASK:-1} / n_sharing ))
+  (( point_cpus < 1 )) && point_cpus=1
+  POINT_CPUS=${point_cpus} ${point_function} "$@" &
+  local point_pid=$!
+  while kill -0 ${point_pid} 2> /dev/null; do
+    rss_kb=$(tree_rss_kb ${point_pid})
+    (( rss_kb > peak_kb )) && peak_kb=${rss_kb}
+    sleep ${rss_poll_seconds}
+  done
+  wait ${point_pid}
+  local point_status=$?
+  echo "### point_timing wall_s=$(( $(date +%s) - point_start )) max_rss_kb=${peak_kb}K rss_of=point concurrent=${n_sharing} exit=${point_status}" >&2
+  return ${point_status}
+}
+
+status=0
+pids=()
+for point in "${points[@]}"; do
+  read -r log_stem args <<< "${point}"
+  echo "Running ${point_function} ${args}"
+  if [[ ${concurrent} -eq 1 ]]; then
+    timed_point ${#points[@]} ${args} > ${log_dir}/slurm_${log_stem}.out 2> ${log_dir}/slurm_${log_stem}.err < /dev/null &
+    pids+=($!)
+  else
+    timed_point 1 ${args} > ${log_dir}/slurm_${log_stem}.out 2> ${log_dir}/slurm_${log_stem}.err < /dev/null || status=1
+  fi
+done
+for pid in "${pids[@]}"; do
+  wait ${pid} || status=1
+done
+
+exit ${status}
@@ -0,0 +1,334 @@
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+import matplotlib.pyplot as plt
+import mplhep
+import numpy as np
+
+import hist_store
+
+### Figures of the scaling validation (see scaling_studies.ipynb): for each
+### plot spec and each material and A' mass in the histogram store, the
+### unscaled and scaled comparisons made by make_hists_for_params, saved as
+###   {plots_dir}/{var_name}/{material}/mA_{mass}/electron_{material}_mA_{mass}_baseE_{base_energy}_{var_name}_unscaled.png
+### (and _scaled.png).
+### render_figures draws them on n_workers processes, each opening the store
+### once. A figure is only drawn again if the hash of its histograms (the
+### arrays of its cell of the store) and of its spec has changed since it was
+### last saved, or if one of its files is gone; the hashes are kept in
+### {plots_dir}/.render_hashes.json.
+
+# change this when make_hists_for_params changes how the figures look, so that
+# they are all drawn again
+render_version = 1
+hashes_basename = ".render_hashes.json"
+
+def make_hists_for_params(histStore, material, mass, var_name, base_energy, xlabel, ylabel, logX=False, logY=False,
+                          ylim_raw=None, ylim_unscaled_ratio=None, ylim_scaled_ratio=None,
+                          base_linewidth=2, other_linewidth=1, compEs_filter_out=[], fig_height=900, fig_width=1350):
+    baseEVals, bins, compEs, compEVals_unscaled, compEVals_scaled = hist_store.read_cell(histStore, material, mass, var_name, base_energy)
+
+    height_inches = fig_height / matplotlib.rcParams["figure.dpi"]
+    width_inches = fig_width / matplotlib.rcParams["figure.dpi"]
+
+    figureName = "{material}_mA_{mass}_baseE_{base_energy}_{var_name}".format(
+        material=material,
+        mass=mass,
+        base_energy=base_energy,
+        var_name=var_name
+    )
+
+    unscaled_raw, unscaled_ratio = plt.figure(figureName + "_unscaled", figsize=(width_inches, height_inches)
+                                             ).subplots(ncols = 1, nrows = 2, sharex = "col",
+                                                gridspec_kw = dict(hspace = 0.1,
+                                                                   height_ratios = [3,1],
+                                                                   left = 0.08, right = 0.63,
+                                                                   top = 0.99, bottom = 0.09))
+    #plt.figure(var_name + "unscaled").subplots_adjust(hspace = 0.1)
+    legend_title = "Electrons on {material}\n$m_{{A\'}} = {mass}$ GeV".format(
+        material=material, mass=mass
+    )
+
+    if logX:
+        unscaled_raw.set_xscale('log')
+        unscaled_ratio.set_xscale('log')
+    if logY:
+        unscaled_raw.set_yscale('log')
+        unscaled_ratio.ticklabel_format(style='plain')
+    unscaled_raw.set_ylabel(ylabel)
+    if ylim_raw is not None:
+        unscaled_raw.set_ylim(ylim_raw)
+    # plot the base energy in black
+    unscaled_raw.hist(bins[:-1], bins, weights=baseEVals,
+                      histtype='step', color='black', linewidth=base_linewidth,
+                      label='unscaled MG at {base_energy} GeV'.format(base_energy=base_energy))
+    # plot the other energies
+    for i, compE in enumerate(compEs):
+        if compE in compEs_filter_out:
+            continue
+        unscaled_raw.hist(bins[:-1], bins, weights=compEVals_unscaled[i],
+                          histtype='step', linewidth=other_linewidth,
+                          label='unscaled MG at {comp_energy} GeV'.format(comp_energy=compE))
+
+    unscaled_ratio.set_xlabel(xlabel)
+    unscaled_ratio.set_ylabel("Higher E / Base E", loc='center', fontsize='small')
+    if ylim_unscaled_ratio is not None:
+        unscaled_ratio.set_ylim(ylim_unscaled_ratio)
+    # add horizontal line at 1
+    unscaled_ratio.axhline(1., color='black', linewidth=base_linewidth)
+    # plot the ratios
+    for i, compE in enumerate(compEs):
+        if compE in compEs_filter_out:
+            continue
+        unscaled_ratio.hist(bins[:-1], bins, weights=np.divide(compEVals_unscaled[i], baseEVals,
+                                                               out=np.zeros_like(compEVals_unscaled[i]),
+                                                               where=baseEVals!=0),
+                            histtype='step', linewidth=other_linewidth, label='_nolegend_')
+
+    plt.figure(figureName + "_unscaled").legend(title=legend_title,
+                                             bbox_to_anchor=(0.63, 0.5), loc="center left")
+
+    scaled_raw, scaled_ratio = plt.figure(figureName + "_scaled", figsize=(width_inches, height_inches)
+                                             ).subplots(ncols = 1, nrows = 2, sharex = "col",
+                                                gridspec_kw = dict(hspace = 0.1,
+                                                                   height_ratios = [3,1],
+                                                                   left = 0.08, right = 0.63,
+                                                                   top = 0.99, bottom = 0.09))
+
+    if logX:
+        scaled_raw.set_xscale('log')
+        scaled_ratio.set_xscale('log')
+    if logY:
+        scaled_raw.set_yscale('log')
+        scaled_ratio.ticklabel_format(style='plain')
+    scaled_raw.set_ylabel(ylabel)
+    if ylim_raw is not None:
+        scaled_raw.set_ylim(ylim_raw)
+    # plot the base energy in black
+    scaled_raw.hist(bins[:-1], bins, weights=baseEVals,
+                      histtype='step', color='black', linewidth=base_linewidth,
+                      label='unscaled MG at {base_energy} GeV'.format(base_energy=base_energy))
+    # plot the other energies
+    for i, compE in enumerate(compEs):
+        if compE in compEs_filter_out:
+            continue
+        scaled_raw.hist(bins[:-1], bins, weights=compEVals_scaled[i],
+                        histtype='step', linewidth=other_linewidth,
+                        label='scaled from {comp_energy} GeV'.format(comp_energy=compE))
+    scaled_ratio.set_xlabel(xlabel)
+    scaled_ratio.set_ylabel("Scaled / Unscaled", loc='center', fontsize='small')
+    if ylim_scaled_ratio is not None:
+        scaled_ratio.set_ylim(ylim_scaled_ratio)
+    # add horizontal line at 1
+    scaled_ratio.axhline(1., color='black')
+    # plot the ratios
+    for i, compE in enumerate(compEs):
+        if compE in compEs_filter_out:
+            continue
+        scaled_ratio.hist(bins[:-1], bins, weights=np.divide(compEVals_scaled[i], baseEVals,
+                                                             out=np.zeros_like(compEVals_unscaled[i]),
+                                                             where=baseEVals!=0),
+                          histtype='step', linewidth=other_linewidth, label='_nolegend_')
+
+    plt.figure(figureName + "_scaled").legend(title=legend_title,
+                                           bbox_to_anchor=(0.63, 0.5), loc="center left")
+
+    return (plt.figure(figureName + "_unscaled"), plt.figure(figureName + "_scaled"))
+
+### one spec per (variable, base energy): the labels and the style arguments of
+### make_hists_for_params
+plot_specs = [
+    {"var_name" : 'recoil_energy_frac', "base_energy" : 1.0,
+     "xlabel" : 'Outgoing Electron Energy Fraction', "ylabel" : 'Fraction below Outgoing Energy',
+     "style" : {"compEs_filter_out" : [3.0, 4.0], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1)}},
+    {"var_name" : 'ap_energy_frac', "base_energy" : 1.0,
+     "xlabel" : "$A'$ Energy Fraction", "ylabel" : 'Fraction below Outgoing Energy',
+     "style" : {"compEs_filter_out" : [3.0, 4.0], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1), "logY" : True}},
+    {"var_name" : 'recoil_theta', "base_energy" : 1.0,
+     "xlabel" : 'Outgoing Electron Angle [rad]', "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [3.0, 4.0], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1), "logY" : True}},
+    {"var_name" : 'ap_theta', "base_energy" : 1.0,
+     "xlabel" : "$A'$ $\\theta$ [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [3.0, 4.0], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2), "logY" : True}},
+    {"var_name" : 'delta_phi', "base_energy" : 1.0,
+     "xlabel" : "$|\\Delta_{{\\phi,e,A'}}|$ [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [3.0, 4.0], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2)}},
+    {"var_name" : 'angle_recoil_ap', "base_energy" : 1.0,
+     "xlabel" : "Angle between $A'$ and Electron [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [3.0, 4.0], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2)}},
+    {"var_name" : 'recoil_energy_frac', "base_energy" : 2.0,
+     "xlabel" : 'Outgoing Electron Energy Fraction', "ylabel" : 'Fraction below Outgoing Energy',
+     "style" : {"compEs_filter_out" : [2.5, 3.0, 4.0], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1)}},
+    {"var_name" : 'ap_energy_frac', "base_energy" : 2.0,
+     "xlabel" : "$A'$ Energy Fraction", "ylabel" : 'Fraction below Outgoing Energy',
+     "style" : {"compEs_filter_out" : [2.5, 3.0, 4.0], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1), "logY" : True}},
+    {"var_name" : 'recoil_theta', "base_energy" : 2.0,
+     "xlabel" : 'Outgoing Electron Angle [rad]', "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [2.5, 3.0, 4.0], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1), "logY" : True}},
+    {"var_name" : 'ap_theta', "base_energy" : 2.0,
+     "xlabel" : "$A'$ $\\theta$ [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [2.5, 3.0, 4.0], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2), "logY" : True}},
+    {"var_name" : 'delta_phi', "base_energy" : 2.0,
+     "xlabel" : "$|\\Delta_{{\\phi,e,A'}}|$ [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [2.5, 3.0, 4.0], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2)}},
+    {"var_name" : 'angle_recoil_ap', "base_energy" : 2.0,
+     "xlabel" : "Angle between $A'$ and Electron [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [2.5, 3.0, 4.0], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2), "logY" : True}},
+    {"var_name" : 'recoil_energy_frac', "base_energy" : 4.0,
+     "xlabel" : 'Outgoing Electron Energy Fraction', "ylabel" : 'Fraction below Outgoing Energy',
+     "style" : {"compEs_filter_out" : [7.0, 8.0], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1)}},
+    {"var_name" : 'ap_energy_frac', "base_energy" : 4.0,
+     "xlabel" : "$A'$ Energy Fraction", "ylabel" : 'Fraction below Outgoing Energy',
+     "style" : {"compEs_filter_out" : [7.0, 8.0], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1), "logY" : True}},
+    {"var_name" : 'recoil_theta', "base_energy" : 4.0,
+     "xlabel" : 'Outgoing Electron Angle [rad]', "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [7.0, 8.0], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1), "logY" : True}},
+    {"var_name" : 'ap_theta', "base_energy" : 4.0,
+     "xlabel" : "$A'$ $\\theta$ [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [7.0, 8.0], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2), "logY" : True}},
+    {"var_name" : 'delta_phi', "base_energy" : 4.0,
+     "xlabel" : "$|\\Delta_{{\\phi,e,A'}}|$ [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [7.0, 8.0], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2)}},
+    {"var_name" : 'angle_recoil_ap', "base_energy" : 4.0,
+     "xlabel" : "Angle between $A'$ and Electron [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [7.0, 8.0], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2), "logY" : True}},
+    {"var_name" : 'recoil_energy_frac', "base_energy" : 6.0,
+     "xlabel" : 'Outgoing Electron Energy Fraction', "ylabel" : 'Fraction below Outgoing Energy',
+     "style" : {"compEs_filter_out" : [6.06, 6.12, 6.18, 6.24, 6.9, 7.5], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1)}},
+    {"var_name" : 'ap_energy_frac', "base_energy" : 6.0,
+     "xlabel" : "$A'$ Energy Fraction", "ylabel" : 'Fraction below Outgoing Energy',
+     "style" : {"compEs_filter_out" : [6.06, 6.12, 6.18, 6.24, 6.9, 7.5], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1), "logY" : True}},
+    {"var_name" : 'recoil_theta', "base_energy" : 6.0,
+     "xlabel" : 'Outgoing Electron Angle [rad]', "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [6.06, 6.12, 6.18, 6.24, 6.9, 7.5], "ylim_unscaled_ratio" : (0.9, 1.1), "ylim_scaled_ratio" : (0.9, 1.1), "logY" : True}},
+    {"var_name" : 'ap_theta', "base_energy" : 6.0,
+     "xlabel" : "$A'$ $\\theta$ [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [6.06, 6.12, 6.18, 6.24, 6.9, 7.5], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2), "logY" : True}},
+    {"var_name" : 'delta_phi', "base_energy" : 6.0,
+     "xlabel" : "$|\\Delta_{{\\phi,e,A'}}|$ [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [6.06, 6.12, 6.18, 6.24, 6.9, 7.5], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2)}},
+    {"var_name" : 'angle_recoil_ap', "base_energy" : 6.0,
+     "xlabel" : "Angle between $A'$ and Electron [rad]", "ylabel" : 'Normalized Rate',
+     "style" : {"compEs_filter_out" : [6.06, 6.12, 6.18, 6.24, 6.9, 7.5], "ylim_unscaled_ratio" : (0.8, 1.2), "ylim_scaled_ratio" : (0.8, 1.2), "logY" : True}},
+]
+
+def figure_fnames_for(plots_dir, material, mass, spec):
+    plots_path = "{plots_dir}/{var_name}/{material}/mA_{mass}".format(
+        plots_dir=plots_dir, var_name=spec["var_name"], material=material, mass=mass)
+    stem = "{plots_path}/electron_{material}_mA_{mass}_baseE_{base_energy}_{var_name}".format(
+        plots_path=plots_path, material=material, mass=mass,
+        base_energy=spec["base_energy"], var_name=spec["var_name"])
+    return stem + "_unscaled.png", stem + "_scaled.png"
+
+# hash of the histograms of a cell of the store and of the spec they are drawn with
+def figure_hash(histStore, material, mass, spec):
+    baseEVals, bins, compEs, compEVals_unscaled, compEVals_scaled = hist_store.read_cell(
+        histStore, material, mass, spec["var_name"], spec["base_energy"])
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps({"spec" : spec, "compEs" : compEs, "render_version" : render_version,
+                              "matplotlib" : matplotlib.__version__, "mplhep" : mplhep.__version__},
+                             sort_keys=True).encode())
+    for array in [baseEVals, bins] + compEVals_unscaled + compEVals_scaled:
+        digest.update(array.dtype.str.encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+def load_hashes(hashes_fname):
+    if not os.path.isfile(hashes_fname):
+        return {}
+    with open(hashes_fname) as fp:
+        return json.load(fp)
+
+def save_hashes(hashes, hashes_fname):
+    tmp_fname = hashes_fname + ".tmp"
+    with open(tmp_fname, "w") as fp:
+        json.dump(hashes, fp, indent=1, sort_keys=True)
+    os.replace(tmp_fname, hashes_fname)
+
+# the store opened by each worker process
+worker_store = None
+
+def start_worker(hist_store_fname):
+    global worker_store
+    matplotlib.use("Agg")
+    plt.style.use(mplhep.style.ROOT)
+    worker_store = hist_store.open_hist_store(hist_store_fname)
+
+def render_figure(material, mass, spec, fnames):
+    fig_unscaled, fig_scaled = make_hists_for_params(
+        worker_store, material, mass, spec["var_name"], spec["base_energy"],
+        spec["xlabel"], spec["ylabel"], **spec["style"])
+    os.makedirs(os.path.dirname(fnames[0]), exist_ok=True)
+    fig_unscaled.savefig(fnames[0])
+    fig_scaled.savefig(fnames[1])
+    plt.close(fig_unscaled)
+    plt.close(fig_scaled)
+
+# draw the figures of every spec for the given materials and masses (all of
+# those in the store if None) that have changed since they were last drawn;
+# with force=True they are all drawn again
+# returns the number of figures drawn
+def render_figures(hist_store_fname, specs, plots_dir, materials=None, masses=None,
+                   n_workers=1, force=False):
+    start = time.perf_counter()
+    histStore = hist_store.open_hist_store(hist_store_fname)
+    keys = hist_store.cell_keys(histStore)
+    if materials is None:
+        materials = list(dict.fromkeys(key[0] for key in keys))
+    if masses is None:
+        masses = list(dict.fromkeys(key[1] for key in keys))
+
+    os.makedirs(plots_dir, exist_ok=True)
+    hashes_fname = os.path.join(plots_dir, hashes_basename)
+    hashes = load_hashes(hashes_fname)
+    todo = []
+    n_same = 0
+    n_missing = 0
+    for spec in specs:
+        for material in materials:
+            for mass in masses:
+                if hist_store.cell_key(material, mass, spec["var_name"], spec["base_energy"]) not in histStore["cells"]:
+                    n_missing += 1
+                    continue
+                fnames = figure_fnames_for(plots_dir, material, mass, spec)
+                figure_key = os.path.relpath(fnames[0], plots_dir)
+                new_hash = figure_hash(histStore, material, mass, spec)
+                if (not force and hashes.get(figure_key) == new_hash
+                        and os.path.isfile(fnames[0]) and os.path.isfile(fnames[1])):
+                    n_same += 1
+                    continue
+                todo.append((material, mass, spec, fnames, figure_key, new_hash))
+    if n_missing > 0:
+        print("{n} figures skipped: not in the histogram store".format(n=n_missing))
+    print("{n_todo} figures to draw, {n_same} unchanged".format(n_todo=len(todo), n_same=n_same))
+
+    # the hashes are saved after every figure, so an interrupted run keeps
+    # what it has drawn
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=start_worker,
+                             initargs=(hist_store_fname,)) as executor:
+        futures = {executor.submit(render_figure, *job[:4]) : job for job in todo}
+        for future in as_completed(futures):
+            future.result()
+            figure_key, new_hash = futures[future][4:]
+            hashes[figure_key] = new_hash
+            save_hashes(hashes, hashes_fname)
+    print("{n} figures drawn on {n_workers} workers in {t:.1f} s".format(
+        n=len(todo), n_workers=n_workers, t=time.perf_counter() - start))
+    return len(todo)
+
+hist_store_fname = "/home/ram2aq/data/scaling_hists.hstore"
+plots_dir = "/home/ram2aq/plots"
+# materials and masses to draw (None for all of those in the store)
+materials = None
+masses = None
+# number of figures drawn at the same time
+n_workers = 8
+# draw every figure again, even if it has not changed
+force = False
+
+if __name__ == "__main__":
+    render_figures(hist_store_fname, plot_specs, plots_dir, materials, masses, n_workers, force)
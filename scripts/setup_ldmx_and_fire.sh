@@ -14,4 +14,19 @@ module load apptainer # needed to load container
 alias singularity="apptainer" # needed to load container
 source ldmx-sw/scripts/ldmx-env.sh
 
-ldmx fire ${PATH_TO_CONFIG_SCRIPT} ${PATH_TO_MG_DB_LIB} ${N_EVENTS}
\ No newline at end of file
+# fire one signal sample in the environment set up above
+# arguments: {config script} {MG db lib} {number of events} [{output file stem} {output path}]
+# if an output file stem and path are given, the output file is moved there
+fire_point() {
+  ldmx fire $1 $2 $3 || return 1
+  if [[ $# -ge 5 ]]; then
+    mv ${PATH_TO_LDMX_SIM_VISDECAY}/$4.root $5
+  fi
+}
+
+# when run as a script, fire the sample given by the arguments; when sourced
+# (by run_param_bundle.sh, with only the first argument), only set up the
+# environment and define fire_point, so that a bundle of samples shares one setup
+if [[ "${BASH_SOURCE[0]}" == "${0}" ]]; then
+  fire_point ${PATH_TO_CONFIG_SCRIPT} ${PATH_TO_MG_DB_LIB} ${N_EVENTS}
+fi
@@ -0,0 +1,95 @@
+import math
+import os
+import tempfile
+import time
+
+### Submit many points as one slurm job array instead of one job per point.
+### The points are written to a parameter table, one line per point:
+###   {log stem} {arguments for the point function}
+### and each task of the array runs points_per_task lines of it with
+### run_param_bundle.sh, which sets up the environment once per task (by
+### sourcing env_script) and then runs the points one after another or, with
+### concurrent, all at the same time; each point gets cpus_per_point cpus (for
+### the runs it makes at the same time, e.g. the top-up runs of
+### run_db_gen_then_extract.sh), and its memory estimate has to cover them.
+### Every submission gets its own parameter table (and sbatch script), since the
+### tasks of an array only read their lines of the table when they start: a
+### later submission of the same job name must not change what the pending
+### tasks of an earlier one run.
+### The output of each point still goes to
+###   {output_path}/slurm/slurm_{log stem}.out and .err
+### and that of the bundle itself to slurm_{job name}_{array job}_{task}.out/.err
+
+# relative to the directory sbatch is run from
+bundle_script = "scripts/run_param_bundle.sh"
+
+def write_param_table(table_fname, rows):
+    with open(table_fname, "w") as fh:
+        for row in rows:
+            fh.write(" ".join(str(value) for value in row) + "\n")
+
+def split_into_tasks(values, points_per_task):
+    return [values[i:i + points_per_task] for i in range(0, len(values), points_per_task)]
+
+# hours and mems (MB) are the estimates for each point; a task needs the
+# longest of its points when they run concurrently and their sum otherwise,
+# and the memory of all of its points when they run concurrently, and
+# cpus_per_point cpus for each point running at once
+def write_array_slurm_to_fh(fh, job_name, hours, mems, output_path, table_fname,
+                            env_script, point_function, points_per_task=1,
+                            concurrent=False, env_args=[],
+                            bundle_script=bundle_script, cpus_per_point=1):
+    tasks = split_into_tasks(hours, points_per_task)
+    task_mems = split_into_tasks(mems, points_per_task)
+    fh.write("#!/bin/bash\n")
+    fh.write("\n")
+    fh.write("#SBATCH --ntasks=1\n")
+    if concurrent:
+        fh.write("#SBATCH --cpus-per-task={n}\n".format(n=points_per_task * cpus_per_point))
+        fh.write("#SBATCH --mem={mem}\n".format(mem=max(sum(task) for task in task_mems)))
+    else:
+        if cpus_per_point > 1:
+            fh.write("#SBATCH --cpus-per-task={n}\n".format(n=cpus_per_point))
+        fh.write("#SBATCH --mem={mem}\n".format(mem=max(mems)))
+    fh.write("#SBATCH --partition=standard\n")
+    fh.write("#SBATCH --account=ldmxuva\n")
+    task_hours = max(max(task) if concurrent else sum(task) for task in tasks)
+    fh.write("#SBATCH --time={hours:02d}:00:00\n".format(hours=task_hours))
+    fh.write("#SBATCH --array=0-{last}\n".format(last=len(tasks) - 1))
+    slurm_out = "{output_path}/slurm/slurm_{job_name}_%A_%a.out".format(
+        output_path=output_path, job_name=job_name)
+    slurm_err = "{output_path}/slurm/slurm_{job_name}_%A_%a.err".format(
+        output_path=output_path, job_name=job_name)
+    fh.write("#SBATCH --output={slurm_out}\n".format(slurm_out=slurm_out))
+    fh.write("#SBATCH --error={slurm_err}\n".format(slurm_err=slurm_err))
+    fh.write("\n")
+    fh.write("{bundle_script} {env_script} {point_function} {table_fname} {points_per_task} {concurrent} {log_dir} {env_args}\n".format(
+        bundle_script=bundle_script, env_script=env_script,
+        point_function=point_function, table_fname=table_fname,
+        points_per_task=points_per_task, concurrent=int(concurrent),
+        log_dir=output_path + "/slurm", env_args=" ".join(env_args)
+    ))
+
+# rows are [log stem, arguments of point_function...], hours and mems are the
+# time and memory estimates of each point
+def submit_job_array(job_name, rows, hours, mems, output_path, env_script,
+                     point_function, points_per_task=1, concurrent=False,
+                     env_args=[], bundle_script=bundle_script, cpus_per_point=1):
+    if len(rows) == 0:
+        return
+    os.makedirs(output_path + "/slurm", exist_ok=True)
+    fd, table_fname = tempfile.mkstemp(
+        prefix="{job_name}_{time}_".format(job_name=job_name, time=time.strftime("%Y%m%d_%H%M%S")),
+        suffix=".params", dir=output_path + "/slurm")
+    os.close(fd)
+    slurm_fname = table_fname[:-len(".params")] + ".slurm"
+    write_param_table(table_fname, rows)
+    with open(slurm_fname, "w") as fh:
+        write_array_slurm_to_fh(fh, job_name, hours, mems, output_path,
+                                table_fname, env_script, point_function,
+                                points_per_task, concurrent, env_args,
+                                bundle_script, cpus_per_point)
+    print("{n_points} points in {n_tasks} array tasks: {slurm_fname}".format(
+        n_points=len(rows), n_tasks=math.ceil(len(rows) / points_per_task),
+        slurm_fname=slurm_fname))
+    os.system("sbatch {slurm_fname}".format(slurm_fname=slurm_fname))
@@ -0,0 +1,147 @@
+import glob
+import json
+import math
+import os
+import re
+
+try:
+    import uproot # only needed to count the events of ROOT outputs
+except ImportError:
+    uproot = None
+
+### Right-sized --time and --mem requests from the measured throughput and
+### memory of earlier runs.
+### Every point (a single job, or one point of a bundle run by
+### run_param_bundle.sh) ends its slurm .err log with a line
+###   ### point_timing wall_s=<s> max_rss_kb=<peak RSS> [rss_of=point] concurrent=<n> exit=<status>
+### where the peak RSS is that of the point's own processes with rss_of=point
+### (points of a bundle, and the local backend of executors) and otherwise
+### that of the whole job step (single jobs, where the step is the point).
+### collect_measurements reads these from the logs of finished points, counts
+### the events in their outputs and keeps one measurement per point, as json
+### lines in a measurements file:
+###   {"config", "material", "mass", "energy", "events", "wall_s",
+###    "max_rss_mb", "log", "log_mtime_ns"}
+### estimate_resources then turns the measurements of the same config,
+### material, mass and energy (or the closest match) into a request.
+
+timing_marker = "### point_timing"
+
+# shell lines that run command and log its timing, for single-job scripts
+# (run_param_bundle.sh logs the same line for each point of a bundle)
+def write_timed_command(fh, command):
+    fh.write("point_start=$(date +%s)\n")
+    fh.write(command + "\n")
+    fh.write("point_status=$?\n")
+    fh.write('echo "' + timing_marker + ' wall_s=$(( $(date +%s) - point_start ))'
+             ' max_rss_kb=$(sstat --noheader --parsable2 --format=MaxRSS -j ${SLURM_JOB_ID}.batch 2> /dev/null)'
+             ' concurrent=1 exit=${point_status}" >&2\n')
+
+# sstat reports memory like 123456K, 1.5M or 2G (or nothing if unavailable)
+def parse_memory_kb(value):
+    match = re.fullmatch(r"([0-9.]+)([KMGT]?)", value.strip())
+    if match is None:
+        return None
+    scale = {"" : 1. / 1024, "K" : 1., "M" : 1024., "G" : 1024. ** 2, "T" : 1024. ** 3}
+    return float(match.group(1)) * scale[match.group(2)]
+
+# the last timing line of an .err log, as a dict, or None if the point has not
+# finished (or ran before the timing was logged)
+def parse_timing(err_fname):
+    timing = None
+    with open(err_fname, errors="replace") as fp:
+        for line in fp:
+            if line.startswith(timing_marker):
+                timing = dict(token.split("=", 1) for token in line.split()[2:] if "=" in token)
+    return timing
+
+def count_csv_events(fname):
+    n_lines = 0
+    with open(fname, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            n_lines += block.count(b"\n")
+    return n_lines - 1 # header
+
+def count_root_events(fname, tree="LDMX_Events"):
+    with uproot.open(fname) as f:
+        return f[tree].num_entries
+
+def load_measurements(measurements_fname):
+    if not os.path.isfile(measurements_fname):
+        return []
+    with open(measurements_fname) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+# add the points that finished since the last call to the measurements file
+# and return all the measurements
+# point_for(log stem) returns (material, mass, energy, events) for the point
+# whose logs are slurm_<log stem>.out/.err, or None if it is not one of the
+# points this config makes (or its events cannot be counted)
+def collect_measurements(measurements_fname, slurm_dir, config, point_for):
+    measurements = load_measurements(measurements_fname)
+    seen = set((m["log"], m["log_mtime_ns"]) for m in measurements)
+    new_measurements = []
+    for err_fname in sorted(glob.glob(os.path.join(slurm_dir, "slurm_*.err"))):
+        mtime_ns = os.stat(err_fname).st_mtime_ns
+        if (err_fname, mtime_ns) in seen:
+            continue
+        timing = parse_timing(err_fname)
+        if timing is None or timing.get("exit") != "0":
+            continue
+        log_stem = os.path.basename(err_fname)[len("slurm_"):-len(".err")]
+        point = point_for(log_stem)
+        if point is None:
+            continue
+        material, mass, energy, events = point
+        max_rss_kb = parse_memory_kb(timing.get("max_rss_kb", ""))
+        if timing.get("rss_of") != "point" and int(timing.get("concurrent", 1)) > 1:
+            # the peak of a step shared by concurrent points (logs from before
+            # the points were measured on their own) is not that of this point
+            max_rss_kb = None
+        new_measurements.append({
+            "config" : config,
+            "material" : material,
+            "mass" : float(mass),
+            "energy" : None if energy is None else float(energy),
+            "events" : events,
+            "wall_s" : float(timing["wall_s"]),
+            "max_rss_mb" : None if max_rss_kb is None else max_rss_kb / 1024,
+            "log" : err_fname,
+            "log_mtime_ns" : mtime_ns
+        })
+    if len(new_measurements) > 0:
+        with open(measurements_fname, "a") as fp:
+            for measurement in new_measurements:
+                fp.write(json.dumps(measurement) + "\n")
+        print("{n} new measurements in {fname}".format(
+            n=len(new_measurements), fname=measurements_fname))
+    return measurements + new_measurements
+
+# (hours, mem in MB) to request for a point of events events
+# uses the measurements of the same config, material, mass and energy, or if
+# there are none of the same config, material and mass, or of the same config;
+# the slowest throughput and largest memory of those, times safety_margin, are
+# requested, and the defaults if nothing has been measured
+def estimate_resources(measurements, config, material, mass, energy, events,
+                       default_hours, default_mem, safety_margin=1.5):
+    same_config = [m for m in measurements if m["config"] == config and m["wall_s"] > 0]
+    same_point = [m for m in same_config
+                      if m["material"] == material and m["mass"] == float(mass)]
+    same_energy = [m for m in same_point
+                       if m["energy"] == (None if energy is None else float(energy))]
+    matches = same_energy or same_point or same_config
+    if len(matches) == 0:
+        return default_hours, default_mem
+
+    events_per_s = min(m["events"] / m["wall_s"] for m in matches)
+    if events_per_s > 0:
+        hours = max(1, math.ceil(events / events_per_s / 3600. * safety_margin))
+    else:
+        hours = default_hours
+    rss_mb = [m["max_rss_mb"] for m in matches if m["max_rss_mb"] is not None]
+    if len(rss_mb) > 0:
+        # in steps of 100 MB
+        mem = max(100, int(math.ceil(max(rss_mb) * safety_margin / 100.)) * 100)
+    else:
+        mem = default_mem
+    return hours, mem